@@ -70,6 +70,9 @@ class DeviceHandler:
             print("Aucuns bus configures")
             
         await self._configurer_devices(configuration['devices'])
+
+        # Deadbands, battement et limite de frequence de l'emission de l'etat (optionnel)
+        self.__appareil.filtre_etat.configurer(configuration.get('emission'))
         
     async def _configurer_busses(self, busses):
         # busses = self.__configuration['bus']
@@ -1,6 +1,23 @@
+import time
+
 from collections import OrderedDict
 
 
+def taux_heure(stats: dict, champs) -> dict:
+    """
+    Taux par heure des compteurs de stats depuis stats['debut'] (time.time(), les ticks bouclent apres ~6 jours).
+    @return {champ + '_heure': taux}
+    """
+    duree_s = max(time.time() - stats['debut'], 1)
+    return {champ + '_heure': stats[champ] * 3600 // duree_s for champ in champs}
+
+
+def recaler_debut(decalage_s: int, *stats):
+    """ Applique un ajustement de l'horloge (NTP) a stats['debut'] pour conserver la duree ecoulee. """
+    for s in stats:
+        s['debut'] += decalage_s
+
+
 def comparer_dict(d1, d2):
     """
     Deep compare de 2 dicts
@@ -8,20 +8,64 @@ https://github.com/aaugustin/websockets/blob/master/websockets/client.py
 import logging
 import usocket as socket
 import ubinascii as binascii
-import urandom as random
-import ussl
+from uerrno import EINPROGRESS
 
-from .protocol import Websocket, urlparse
+from millegrilles.aleatoire import DRBG
+from millegrilles.attente_socket import attendre_ecriture, attendre_lecture, verifier_connexion
+from millegrilles.contexte_tls import wrap_socket
+from millegrilles.resolveur_dns import resoudre
+
+from .protocol import Websocket, urlparse, deflate, DEFLATE_CLIENT_WBITS, DEFLATE_SERVEUR_WBITS
 
 LOGGER = logging.getLogger(__name__)
 
+TIMEOUT_HANDSHAKE_S = const(10)  # Borne le handshake bloquant (TLS + upgrade) apres connect_tcp
+
 
 class WebsocketClient(Websocket):
     is_client = True
 
-def connect(uri):
+
+class ErreurDeflate(Exception):
+    """ Le serveur accepte permessage-deflate avec des parametres non supportes, reconnecter sans compression. """
+    pass
+
+
+def parse_extension_deflate(valeur):
     """
-    Connect a websocket.
+    Parse la reponse Sec-WebSocket-Extensions du serveur.
+    @return (wbits client, wbits serveur) si permessage-deflate est accepte, None si absent
+    @raises ErreurDeflate si le serveur accepte avec des parametres differents de l'offre (RFC 7692 5)
+    """
+    for extension in valeur.split(','):
+        params = [p.strip() for p in extension.split(';')]
+        if params[0] != 'permessage-deflate':
+            continue
+        wbits_client = DEFLATE_CLIENT_WBITS
+        wbits_serveur = None
+        sans_contexte = False
+        try:
+            for param in params[1:]:
+                if param.startswith('client_max_window_bits='):
+                    wbits_client = min(wbits_client, int(param.split('=')[1]))
+                elif param.startswith('server_max_window_bits='):
+                    wbits_serveur = int(param.split('=')[1])
+                elif param == 'server_no_context_takeover':
+                    sans_contexte = True
+        except ValueError:
+            raise ErreurDeflate(valeur)
+        # Fenetre serveur bornee (heap) et decompression message par message requises
+        if not sans_contexte or wbits_serveur is None or wbits_serveur > DEFLATE_SERVEUR_WBITS:
+            raise ErreurDeflate(valeur)
+        return wbits_client, wbits_serveur
+    return None
+
+
+async def connect(uri, compression=False):
+    """
+    Connect a websocket. DNS et connexion TCP non-bloquants (connect_tcp), puis TLS et upgrade (handshake).
+
+    compression : offre permessage-deflate (RFC 7692), utilise seulement si le serveur l'accepte.
     """
 
     uri = urlparse(uri)
@@ -30,19 +74,70 @@ def connect(uri):
     if __debug__: LOGGER.debug("open connection %s:%s",
                                 uri.hostname, uri.port)
 
+    sock = await connect_tcp(uri)
+    try:
+        return await handshake(sock, uri, compression)
+    except ErreurDeflate as e:
+        print("Websocket %s : permessage-deflate refuse (%s), reconnexion sans compression" % (uri.hostname, e))
+        sock = await connect_tcp(uri)
+        return await handshake(sock, uri, False)
+
+
+async def connect_tcp(uri):
+    """
+    Ouvre la connexion TCP sans bloquer la boucle uasyncio (reveil par poll en ecriture).
+    Annulable : le socket est ferme si la tache est annulee.
+    Un refus de connexion (RST) rend aussi le socket pret en ecriture : verifie avec POLLHUP/POLLERR.
+
+    @return socket connecte, en mode bloquant avec timeout TIMEOUT_HANDSHAKE_S
+    """
+    addr = socket.getaddrinfo(await resoudre(uri.hostname), uri.port)  # DNS non-bloquant
     sock = socket.socket()
-    addr = socket.getaddrinfo(uri.hostname, uri.port)
-    sock.connect(addr[0][4])
-    if uri.protocol == 'wss':
-        sock = ussl.wrap_socket(sock)
+    try:
+        sock.setblocking(False)
+        try:
+            sock.connect(addr[0][4])
+        except OSError as e:
+            if e.errno != EINPROGRESS:
+                raise e
+        await attendre_ecriture(sock)
+        verifier_connexion(sock)
+    except BaseException as e:
+        sock.close()
+        raise e
+    sock.settimeout(TIMEOUT_HANDSHAKE_S)
+    return sock
+
+
+async def handshake(sock, uri, compression=False):
+    """
+    TLS (wss) et upgrade websocket sur un socket connecte par connect_tcp.
+    Le handshake TLS est bloquant (firmware), l'attente de la reponse 101 ne l'est pas.
 
+    uri : resultat de urlparse()
+    """
+    try:
+        if uri.protocol == 'wss':
+            sock = wrap_socket(sock, uri.hostname)
+        compression = envoyer_upgrade(sock, uri, compression)
+        await attendre_lecture(sock)
+        return lire_upgrade(sock, compression)
+    except BaseException as e:
+        sock.close()
+        raise e
+
+
+def envoyer_upgrade(sock, uri, compression=False):
+    """
+    Emet la requete d'upgrade websocket.
+    @return True si permessage-deflate est offert
+    """
     def send_header(header, *args):
         if __debug__: LOGGER.debug(str(header), *args)
         sock.write(header % args + '\r\n')
 
     # Sec-WebSocket-Key is 16 bytes of random base64 encoded
-    key = binascii.b2a_base64(bytes(random.getrandbits(8)
-                                    for _ in range(16)))[:-1]
+    key = binascii.b2a_base64(DRBG.bytes(16))[:-1]
 
     send_header(b'GET %s HTTP/1.1', uri.path or '/')
     send_header(b'Host: %s:%s', uri.hostname, uri.port)
@@ -50,19 +145,33 @@ def connect(uri):
     send_header(b'Upgrade: websocket')
     send_header(b'Sec-WebSocket-Key: %s', key)
     send_header(b'Sec-WebSocket-Version: 13')
+    compression = compression and deflate is not None
+    if compression:
+        send_header(b'Sec-WebSocket-Extensions: permessage-deflate; client_no_context_takeover; '
+                    b'server_no_context_takeover; client_max_window_bits=%d; server_max_window_bits=%d',
+                    DEFLATE_CLIENT_WBITS, DEFLATE_SERVEUR_WBITS)
     send_header(b'Origin: http://{hostname}:{port}'.format(
         hostname=uri.hostname,
         port=uri.port)
     )
     send_header(b'')
+    return compression
 
+
+def lire_upgrade(sock, compression=False):
+    """ Lit la reponse 101 du serveur. """
     header = sock.readline()[:-2]
     assert header.startswith(b'HTTP/1.1 101 '), header
 
-    # We don't (currently) need these headers
     # FIXME: should we check the return key?
+    deflate_wbits = None
     while header:
         if __debug__: LOGGER.debug(str(header))
+        if compression and header.lower().startswith(b'sec-websocket-extensions:'):
+            deflate_wbits = parse_extension_deflate(header[25:].decode('utf-8').strip())
         header = sock.readline()[:-2]
 
-    return WebsocketClient(sock)
+    if __debug__ and deflate_wbits is not None:
+        LOGGER.debug("permessage-deflate actif (wbits client %d, serveur %d)", *deflate_wbits)
+
+    return WebsocketClient(sock, deflate_wbits=deflate_wbits)
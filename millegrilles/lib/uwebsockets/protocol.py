@@ -3,12 +3,21 @@ Websockets protocol
 """
 
 import logging
+import oryx_crypto
 import ure as re
 import ustruct as struct
-import urandom as random
 import usocket as socket
+from io import IOBase
 from ucollections import namedtuple
-from uasyncio import sleep_ms
+from uasyncio import Event, Lock, create_task, wait_for_ms, TimeoutError
+
+try:
+    import deflate
+except ImportError:
+    deflate = None  # Firmware sans module deflate, permessage-deflate non offert
+
+from millegrilles.aleatoire import DRBG
+from millegrilles import attente_socket
 
 LOGGER = logging.getLogger(__name__)
 
@@ -31,6 +40,21 @@ CLOSE_TOO_BIG = const(1009)
 CLOSE_MISSING_EXTN = const(1010)
 CLOSE_BAD_CONDITION = const(1011)
 
+# Delai max d'attente de la suite d'une frame deja commencee
+TIMEOUT_LECTURE_FRAME_MS = const(5000)
+# Delai max d'attente du socket (backpressure) pendant l'ecriture d'une frame
+TIMEOUT_ECRITURE_FRAME_MS = const(10000)
+
+# permessage-deflate (RFC 7692) : fenetres bornees pour le heap du Pico
+DEFLATE_CLIENT_WBITS = const(9)
+DEFLATE_SERVEUR_WBITS = const(10)
+DEFLATE_TAILLE_MIN = const(64)  # Messages plus petits envoyes sans compression
+# Bloc stocke vide (RFC 7692 7.2.2) suivi d'un bloc final vide : termine le flux deflate du message
+DEFLATE_FIN_MESSAGE = const(b'\x00\x00\xff\xff\x03\x00')
+
+# Compteurs permessage-deflate (bytes de payload, messages compresses seulement)
+STATS_DEFLATE = {'emis_bruts': 0, 'emis_compresses': 0, 'recus_bruts': 0, 'recus_compresses': 0}
+
 URL_RE = re.compile(r'(wss|ws)://([A-Za-z0-9-\.]+)(?:\:([0-9]+))?(/.+)?')
 URI = namedtuple('URI', ('protocol', 'hostname', 'port', 'path'))
 
@@ -40,6 +64,10 @@ class NoDataException(Exception):
 class ConnectionClosed(Exception):
     pass
 
+class MessageTooBig(Exception):
+    """ Message (fragments inclus) plus gros que le buffer de reception. Message ignore, la connexion reste ouverte. """
+    pass
+
 def urlparse(uri):
     """Parse ws:// URLs"""
     match = URL_RE.match(uri)
@@ -61,6 +89,40 @@ def urlparse(uri):
         return URI(protocol, host, int(port), path)
 
 
+class TamponOctets(IOBase):
+    """ Stream d'ecriture vers un bytearray (sortie du compresseur deflate). """
+
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data.extend(data)
+        return len(data)
+
+
+class LecteurMessageDeflate(IOBase):
+    """ Stream de lecture d'un message compresse suivi de DEFLATE_FIN_MESSAGE, sans concatenation. """
+
+    def __init__(self, data):
+        super().__init__()
+        self.__sources = (memoryview(data), memoryview(DEFLATE_FIN_MESSAGE))
+        self.__index = 0
+        self.__position = 0
+
+    def readinto(self, buf):
+        while self.__index < 2:
+            source = self.__sources[self.__index]
+            if self.__position < len(source):
+                taille = min(len(buf), len(source) - self.__position)
+                buf[:taille] = source[self.__position:self.__position+taille]
+                self.__position += taille
+                return taille
+            self.__index += 1
+            self.__position = 0
+        return 0
+
+
 class Websocket:
     """
     Basis of the Websocket protocol.
@@ -70,9 +132,23 @@ class Websocket:
     """
     is_client = False
 
-    def __init__(self, sock):
+    def __init__(self, sock, deflate_wbits=None):
         self.sock = sock
         self.open = True
+        # permessage-deflate negocie : (wbits client, wbits serveur) ou None
+        self.__deflate_wbits = deflate_wbits
+        self.__rsv1 = False  # Bit RSV1 (message compresse) de la derniere frame lue
+        # Header de frame preallouee : 2 bytes + longueur (max 8) + masque (4)
+        self.__header = bytearray(14)
+        # Toutes les frames de la connexion (messages, PONG, CLOSE) passent par ecrire_frame sous ce verrou
+        self.__verrou_ecriture = Lock()
+        self.__frame_incomplete = False  # Ecriture interrompue : le flux est corrompu, aucune autre frame
+        # Une seule tache (veille) attend la lecture sur le socket et n'est jamais annulee en cours de connexion :
+        # annuler une attente d'I/O uasyncio retire le socket de la file dans les deux sens (ecrivain inclus).
+        self.__veille = None
+        self.__lecture_demandee = Event()
+        self.reveil = Event()  # Socket pret en lecture ou reveil externe (e.g. etat a emettre)
+        self.nb_reveils = 0  # Nombre de reveils sur disponibilite du socket (metrique)
 
     def __enter__(self):
         return self
@@ -86,6 +162,51 @@ class Websocket:
     def setblocking(self, blocking):
         self.sock.setblocking(blocking)
 
+    async def attendre_lecture(self):
+        """
+        Attend que le socket soit pret en lecture (ou self.reveil.set()). Le reveil est fait par le poll
+        de uasyncio des l'arrivee de bytes (aucun sleep). Annulable (e.g. wait_for_ms) : seule l'attente
+        de self.reveil est annulee, la tache de veille reste en attente sur le socket.
+        """
+        self.reveil.clear()
+        if self.__veille is None:
+            self.__veille = create_task(self.__veiller())
+        self.__lecture_demandee.set()
+        await self.reveil.wait()
+
+    async def __veiller(self):
+        """ Tache de veille : attend la lecture sur le socket a chaque demande de attendre_lecture(). """
+        while True:
+            await self.__lecture_demandee.wait()
+            self.__lecture_demandee.clear()
+            await attente_socket.attendre_lecture(self.sock)
+            self.nb_reveils += 1
+            self.reveil.set()
+
+    async def attendre_ecriture(self):
+        """ Attend que le socket accepte des bytes (backpressure de l'emetteur). """
+        await attente_socket.attendre_ecriture(self.sock)
+
+    async def _attendre_suite_frame(self):
+        try:
+            await wait_for_ms(self.attendre_lecture(), TIMEOUT_LECTURE_FRAME_MS)
+        except TimeoutError:
+            raise Exception("Erreur lecture (timeout)")
+
+    async def _lire(self, nb_bytes):
+        """ Lit exactement nb_bytes d'une frame commencee. """
+        data = b''
+        while len(data) < nb_bytes:
+            recu = self.sock.read(nb_bytes - len(data))
+            if recu is None:
+                await self._attendre_suite_frame()
+            elif not recu:
+                self._close()
+                raise ConnectionClosed()  # EOF
+            else:
+                data += recu
+        return data
+
     async def read_frame(self, max_size=None, buffer=None):
         """
         Read a frame from the socket.
@@ -95,13 +216,20 @@ class Websocket:
         # Frame header
         two_bytes = self.sock.read(2)
 
-        if not two_bytes:
+        if two_bytes is None:
             raise NoDataException
+        elif not two_bytes:
+            # EOF, connexion fermee par le serveur
+            self._close()
+            raise ConnectionClosed()
+        elif len(two_bytes) < 2:
+            two_bytes += await self._lire(1)
 
         byte1, byte2 = struct.unpack('!BB', two_bytes)
 
-        # Byte 1: FIN(1) _(1) _(1) _(1) OPCODE(4)
+        # Byte 1: FIN(1) RSV1(1) _(1) _(1) OPCODE(4)
         fin = bool(byte1 & 0x80)
+        self.__rsv1 = bool(byte1 & 0x40)
         opcode = byte1 & 0x0f
 
         # Byte 2: MASK(1) LENGTH(7)
@@ -109,96 +237,209 @@ class Websocket:
         length = byte2 & 0x7f
 
         if length == 126:  # Magic number, length header is 2 bytes
-            length, = struct.unpack('!H', self.sock.read(2))
+            length, = struct.unpack('!H', await self._lire(2))
         elif length == 127:  # Magic number, length header is 8 bytes
-            length, = struct.unpack('!Q', self.sock.read(8))
+            length, = struct.unpack('!Q', await self._lire(8))
 
         # print("Websockets Payload length : %d" % length)
 
         if mask:  # Mask is 4 bytes
-            mask_bits = self.sock.read(4)
+            mask_bits = await self._lire(4)
+
+        if buffer is not None and len(buffer) < length:
+            if opcode & 0x8 and length <= 125:
+                buffer = None  # Frame de controle (125 bytes max) apres des fragments, lue hors du buffer
+            else:
+                # Rejeter sans allouer, le buffer de l'appelant est la limite : payload lu et ignore
+                print("Websocket frame %d bytes > buffer %d, ignoree" % (length, len(buffer)))
+                await self._ignorer(length, buffer)
+                return fin, opcode, None
 
         total_lu = 0
-        if buffer is not None and len(buffer) >= length:
+        if buffer is not None:
             while total_lu < length:
                 mv = memoryview(buffer)[total_lu:length]
                 # print("Taille mv buffer reception : %d" % len(mv))
 
-                res_len = None
-                for _ in range(0, 100):
-                    res_len = self.sock.readinto(mv)
-                    try:
-                        total_lu += res_len
-                        break
-                    except TypeError:
-                        # Rien recu, attendre et reessayer
-                        await sleep_ms(20)
-
-                # print("Batch lu : %s, total lu : %s" % (res_len, total_lu))
+                res_len = self.sock.readinto(mv)
                 if res_len is None:
-                    raise Exception("Erreur lecture (0 bytes)")
-
-                if total_lu < length:
-                    await sleep_ms(5)  # Attendre reception
+                    # Rien recu, reveil a l'arrivee des prochains bytes
+                    await self._attendre_suite_frame()
+                elif res_len == 0:
+                    self._close()
+                    raise ConnectionClosed()  # EOF
+                else:
+                    total_lu += res_len
 
             data = memoryview(buffer)[:length]
         else:
             try:
-                data = self.sock.read(length)
+                data = await self._lire(length)
             except MemoryError:
                 # We can't receive this many bytes, close the socket
                 if __debug__: LOGGER.debug("Frame of length %s too big. Closing",
                                            length)
-                self.close(code=CLOSE_TOO_BIG)
+                await self.fermer(code=CLOSE_TOO_BIG)
                 return True, OP_CLOSE, None
 
         if mask:
-            data = bytes(b ^ mask_bits[i % 4]
-                         for i, b in enumerate(data))
+            if isinstance(data, bytes):
+                data = bytearray(data)
+            oryx_crypto.websocketmask(data, mask_bits)
 
         return fin, opcode, data
 
-    def write_frame(self, opcode, data=b''):
+    async def _ignorer(self, nb_bytes, buffer):
+        """ Lit et jette nb_bytes du payload d'une frame par blocs de buffer (aucune allocation). """
+        mv = memoryview(buffer)
+        while nb_bytes > 0:
+            res_len = self.sock.readinto(mv[:min(nb_bytes, len(mv))])
+            if res_len is None:
+                await self._attendre_suite_frame()
+            elif res_len == 0:
+                self._close()
+                raise ConnectionClosed()  # EOF
+            else:
+                nb_bytes -= res_len
+
+    def _preparer_frame(self, opcode, data):
         """
-        Write a frame to the socket.
+        Prepare le header de frame (compression et masquage de data en place).
         See https://tools.ietf.org/html/rfc6455#section-5.2 for the details.
+        @return (header, data, mask_bits), mask_bits None si la frame n'est pas masquee
         """
         fin = True
         mask = self.is_client  # messages sent by client are masked
 
+        rsv1 = 0
+        if self.__deflate_wbits is not None and opcode in (OP_TEXT, OP_BYTES) and len(data) >= DEFLATE_TAILLE_MIN:
+            data = self._compresser(data)
+            rsv1 = 0x40
+
         length = len(data)
+        header = self.__header
 
         # Frame header
-        # Byte 1: FIN(1) _(1) _(1) _(1) OPCODE(4)
+        # Byte 1: FIN(1) RSV1(1) _(1) _(1) OPCODE(4)
         byte1 = 0x80 if fin else 0
-        byte1 |= opcode
+        byte1 |= rsv1 | opcode
 
         # Byte 2: MASK(1) LENGTH(7)
         byte2 = 0x80 if mask else 0
 
         if length < 126:  # 126 is magic value to use 2-byte length header
             byte2 |= length
-            self.sock.write(struct.pack('!BB', byte1, byte2))
+            struct.pack_into('!BB', header, 0, byte1, byte2)
+            len_header = 2
 
         elif length < (1 << 16):  # Length fits in 2-bytes
             byte2 |= 126  # Magic code
-            self.sock.write(struct.pack('!BBH', byte1, byte2, length))
+            struct.pack_into('!BBH', header, 0, byte1, byte2, length)
+            len_header = 4
 
         elif length < (1 << 64):
             byte2 |= 127  # Magic code
-            self.sock.write(struct.pack('!BBQ', byte1, byte2, length))
+            struct.pack_into('!BBQ', header, 0, byte1, byte2, length)
+            len_header = 10
 
         else:
             raise ValueError()
 
+        mask_bits = None
         if mask:  # Mask is 4 bytes
-            mask_bits = struct.pack('!I', random.getrandbits(32))
-            self.sock.write(mask_bits)
+            mask_bits = memoryview(header)[len_header:len_header+4]
+            DRBG.fill(mask_bits)
+            len_header += 4
+
+            try:
+                oryx_crypto.websocketmask(data, mask_bits)
+            except TypeError:
+                # bytes ou memoryview en lecture seule (e.g. sur bytes) : copie requise
+                data = bytearray(data)
+                oryx_crypto.websocketmask(data, mask_bits)
 
-            data = bytes(b ^ mask_bits[i % 4]
-                         for i, b in enumerate(data))
+        return memoryview(header)[:len_header], data, mask_bits
+
+    def write_frame(self, opcode, data=b''):
+        """
+        Write a frame to the socket (socket bloquant, hors boucle asyncio seulement).
+        Une connexion utilisee par des taches asyncio ecrit avec ecrire_frame (verrou d'ecriture).
+        Le masquage est fait en place dans data (bytearray/memoryview), puis retire apres l'envoi.
+        """
+        header, data, mask_bits = self._preparer_frame(opcode, data)
+        self.sock.write(header)
+        try:
+            self.sock.write(data)
+        finally:
+            if mask_bits is not None:
+                # Retirer le masque, le buffer de l'appelant peut etre reutilise
+                oryx_crypto.websocketmask(data, mask_bits)
 
-        self.sock.write(data)
+    async def ecrire_frame(self, opcode, data=b''):
+        """
+        Ecrit une frame au complet sur le socket non-bloquant : ecritures partielles et EAGAIN (None)
+        reprises apres attente du socket. Les frames des differentes taches (emetteur, PONG de recv, CLOSE)
+        sont serialisees par le verrou d'ecriture, jamais entrelacees.
+        """
+        async with self.__verrou_ecriture:
+            if self.__frame_incomplete:
+                raise ConnectionClosed()  # Frame precedente interrompue, flux corrompu
+            header, data, mask_bits = self._preparer_frame(opcode, data)
+            self.__frame_incomplete = True
+            try:
+                await self._ecrire(header)
+                await self._ecrire(data)
+                self.__frame_incomplete = False
+            finally:
+                if mask_bits is not None:
+                    oryx_crypto.websocketmask(data, mask_bits)
+
+    async def _ecrire(self, data):
+        mv = memoryview(data)
+        position = 0
+        while position < len(mv):
+            n = self.sock.write(mv[position:])
+            if not n:
+                try:
+                    await wait_for_ms(self.attendre_ecriture(), TIMEOUT_ECRITURE_FRAME_MS)
+                except TimeoutError:
+                    raise OSError(110)  # ETIMEDOUT
+                continue
+            position += n
+
+    def _compresser(self, data):
+        """ Compresse un message (permessage-deflate, sans reprise de contexte). @return bytearray """
+        tampon = TamponOctets()
+        flux = deflate.DeflateIO(tampon, deflate.RAW, self.__deflate_wbits[0])
+        flux.write(data)
+        flux.close()  # Bloc final (BFINAL), permis par RFC 7692 7.2.3.4
+        STATS_DEFLATE['emis_bruts'] += len(data)
+        STATS_DEFLATE['emis_compresses'] += len(tampon.data)
+        return tampon.data
+
+    def _decompresser(self, data, sortie=None):
+        """
+        Decompresse un message recu. Si sortie (memoryview) est fournie, le message y est ecrit.
+        @return memoryview de sortie ou bytes
+        """
+        flux = deflate.DeflateIO(LecteurMessageDeflate(data), deflate.RAW, self.__deflate_wbits[1])
+        if sortie is None:
+            resultat = flux.read()
+            taille = len(resultat)
+        else:
+            taille = 0
+            while True:
+                lu = flux.readinto(sortie[taille:])
+                if not lu:
+                    break
+                taille += lu
+                if taille == len(sortie) and flux.read(1):
+                    raise MessageTooBig(taille)
+            resultat = sortie[:taille]
+
+        STATS_DEFLATE['recus_compresses'] += len(data)
+        STATS_DEFLATE['recus_bruts'] += taille
+        return resultat
 
     async def recv(self, buffer=None):
         """
@@ -208,28 +449,38 @@ class Websocket:
         fire off a routine to process frames and put the data in a queue.
         If you don't call recv() sufficiently often you won't process control
         frames.
+
+        Les messages fragmentes (OP_CONT) sont reassembles en place dans buffer. Un message
+        plus gros que buffer est lu et ignore jusqu'a son dernier fragment, puis MessageTooBig est lance :
+        la connexion reste utilisable.
         """
         assert self.open
 
+        opcode_message = None  # Opcode du premier fragment
+        compresse = False  # RSV1 du premier fragment (permessage-deflate)
+        position = 0  # Position d'ecriture du prochain fragment dans buffer
+        fragments = None  # Sans buffer : liste des fragments
+        ignore = False  # Message plus gros que buffer, fragments ignores jusqu'a FIN
+
         while self.open:
+            buffer_frame = None
+            if buffer is not None:
+                buffer_frame = memoryview(buffer)[0 if ignore else position:]
+
             try:
-                fin, opcode, data = await self.read_frame(buffer=buffer)
+                fin, opcode, data = await self.read_frame(buffer=buffer_frame)
             except NoDataException:
-                return ''
+                if opcode_message is None:
+                    return ''
+                # Fragments en cours, attendre la suite du message
+                await self._attendre_suite_frame()
+                continue
             except ValueError:
                 LOGGER.debug("Failed to read frame. Socket dead.")
                 self._close()
                 raise ConnectionClosed()
 
-            if not fin:
-                # Ajouter au buffer
-                raise NotImplementedError()
-
-            if opcode == OP_TEXT:
-                return data.decode('utf-8')
-            elif opcode == OP_BYTES:
-                return data
-            elif opcode == OP_CLOSE:
+            if opcode == OP_CLOSE:
                 self._close()
                 return
             elif opcode == OP_PONG:
@@ -238,46 +489,111 @@ class Websocket:
             elif opcode == OP_PING:
                 # We need to send a pong frame
                 if __debug__: LOGGER.debug("Sending PONG")
-                self.write_frame(OP_PONG, data)
+                await self.ecrire_frame(OP_PONG, data)
                 # And then wait to receive
                 continue
             elif opcode == OP_CONT:
                 # This is a continuation of a previous frame
-                raise NotImplementedError(opcode)
+                if opcode_message is None:
+                    await self.fermer(code=CLOSE_PROTOCOL_ERROR)
+                    raise ConnectionClosed()
+            elif opcode in (OP_TEXT, OP_BYTES):
+                if opcode_message is not None:
+                    # Nouveau message avant la fin du precedent
+                    await self.fermer(code=CLOSE_PROTOCOL_ERROR)
+                    raise ConnectionClosed()
+                opcode_message = opcode
+                compresse = self.__rsv1 and self.__deflate_wbits is not None
             else:
                 raise ValueError(opcode)
 
+            if data is None or ignore:
+                # Fragment plus gros que l'espace restant (payload ignore par read_frame), ignorer le message
+                ignore = True
+                if fin:
+                    raise MessageTooBig(len(buffer))
+                continue
+            elif buffer is not None:
+                # Le fragment est deja en place dans buffer
+                position += len(data)
+            elif fin is False or fragments is not None:
+                if fragments is None:
+                    fragments = list()
+                fragments.append(bytes(data))
+
+            if not fin:
+                continue
+
+            if buffer is not None:
+                data = memoryview(buffer)[:position]
+                if compresse:
+                    # Copie du message compresse (plus petit), decompression en place dans buffer
+                    data = self._decompresser(bytes(data), memoryview(buffer))
+            else:
+                if fragments is not None:
+                    data = b''.join(fragments)
+                if compresse:
+                    data = self._decompresser(data)
+
+            if opcode_message == OP_TEXT:
+                return str(data, 'utf-8')
+            return data
+
     def send(self, buf):
         """Send data to the websocket."""
 
         assert self.open
+        opcode, buf = self._opcode(buf)
+        self.write_frame(opcode, buf)
 
+    async def envoyer(self, buf):
+        """ Comme send(), sans bloquer et sans ecriture partielle (voir ecrire_frame). """
+        assert self.open
+        opcode, buf = self._opcode(buf)
+        await self.ecrire_frame(opcode, buf)
+
+    @staticmethod
+    def _opcode(buf):
         if isinstance(buf, str):
-            opcode = OP_TEXT
-            buf = buf.encode('utf-8')
+            return OP_TEXT, buf.encode('utf-8')
         elif isinstance(buf, bytes):
-            opcode = OP_BYTES
+            return OP_BYTES, buf
         elif isinstance(buf, memoryview):
-            opcode = OP_BYTES
-        else:
-            raise TypeError()
-
-        self.write_frame(opcode, buf)
+            return OP_BYTES, buf
+        raise TypeError()
 
     def close(self, code=CLOSE_OK, reason=''):
-        """Close the websocket."""
+        """Close the websocket. Hors boucle asyncio, voir fermer()."""
         if not self.open:
             return
 
-        buf = struct.pack('!H', code) + reason.encode('utf-8')
+        try:
+            if not self.__verrou_ecriture.locked() and not self.__frame_incomplete:
+                self.write_frame(OP_CLOSE, struct.pack('!H', code) + reason.encode('utf-8'))
+        finally:
+            self._close()
+
+    async def fermer(self, code=CLOSE_OK, reason=''):
+        """
+        Ferme le websocket. La frame CLOSE est emise par ecrire_frame (apres la frame en cours),
+        au mieux : la connexion est fermee meme si l'emission echoue ou expire.
+        """
+        if not self.open:
+            return
 
         try:
-            self.write_frame(OP_CLOSE, buf)
+            buf = bytearray(struct.pack('!H', code) + reason.encode('utf-8'))
+            await wait_for_ms(self.ecrire_frame(OP_CLOSE, buf), TIMEOUT_ECRITURE_FRAME_MS)
+        except (OSError, TimeoutError, ConnectionClosed) as e:
+            if __debug__: LOGGER.debug("Frame CLOSE non emise : %s", e)
         finally:
             self._close()
 
     def _close(self):
         if __debug__: LOGGER.debug("Connection closed")
         self.open = False
+        if self.__veille is not None:
+            self.__veille.cancel()
+            self.__veille = None
         self.sock.close()
         self.sock = None
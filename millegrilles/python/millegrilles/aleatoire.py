@@ -0,0 +1,87 @@
+import oryx_crypto
+
+from struct import unpack_from
+
+try:
+    from os import urandom  # RP2040 : ROSC
+except ImportError:
+    urandom = None
+
+# Pool de keystream ChaCha20. Les 44 premiers bytes de chaque remplissage servent de
+# cle/nonce suivants (effacement rapide de la cle), le reste est servi aux appelants.
+CONST_TAILLE_POOL = const(300)
+CONST_TAILLE_CLE_NONCE = const(44)
+CONST_RESEED_REMPLISSAGES = const(1024)
+
+
+def lire_entropie(nb_bytes) -> bytes:
+    """ Lit de l'entropie du materiel (os.urandom). Fallback sur random.getrandbits. """
+    if urandom is not None:
+        return urandom(nb_bytes)
+
+    from random import getrandbits
+    valeur = bytearray(nb_bytes)
+    for i in range(0, nb_bytes):
+        valeur[i] = getrandbits(8)
+    return valeur
+
+
+class Drbg:
+    """
+    Generateur pseudo-aleatoire (DRBG) base sur un keystream ChaCha20, avec pool.
+    Un nonce de 12 bytes coute une copie du pool.
+    """
+
+    def __init__(self):
+        self.__contexte = None
+        self.__pool = bytearray(CONST_TAILLE_POOL)
+        self.__position = CONST_TAILLE_POOL
+        self.__remplissages = 0
+
+    def reseed(self, entropie=None):
+        """ Recharge la cle ChaCha20 a partir de l'entropie materielle (et optionnellement de l'appelant). """
+        graine = oryx_crypto.blake2s(lire_entropie(32) + (entropie or b''))
+        self.__contexte = oryx_crypto.chacha20init(graine, lire_entropie(12))
+        self.__remplissages = 0
+        self.__remplir()
+
+    def __remplir(self):
+        if self.__contexte is None or self.__remplissages >= CONST_RESEED_REMPLISSAGES:
+            self.reseed()
+            return
+
+        pool = self.__pool
+        oryx_crypto.chacha20keystream(self.__contexte, pool)
+        mv_pool = memoryview(pool)
+        self.__contexte = oryx_crypto.chacha20init(mv_pool[:32], mv_pool[32:CONST_TAILLE_CLE_NONCE])
+        pool[:CONST_TAILLE_CLE_NONCE] = bytes(CONST_TAILLE_CLE_NONCE)  # Effacer cle/nonce du pool
+        self.__position = CONST_TAILLE_CLE_NONCE
+        self.__remplissages += 1
+
+    def fill(self, buf):
+        """ Remplit buf (bytearray/memoryview) avec des bytes aleatoires. """
+        mv_buf = memoryview(buf)
+        taille = len(mv_buf)
+        position_buf = 0
+        while position_buf < taille:
+            if self.__position >= CONST_TAILLE_POOL:
+                self.__remplir()
+            n = min(taille - position_buf, CONST_TAILLE_POOL - self.__position)
+            # Chaque byte du pool n'est servi qu'une fois (position avance)
+            mv_buf[position_buf:position_buf+n] = memoryview(self.__pool)[self.__position:self.__position+n]
+            self.__position += n
+            position_buf += n
+        return buf
+
+    def bytes(self, nb_bytes) -> bytes:
+        return bytes(self.fill(bytearray(nb_bytes)))
+
+    def u32(self) -> int:
+        if self.__position + 4 > CONST_TAILLE_POOL:
+            self.__remplir()
+        valeur = unpack_from('<I', self.__pool, self.__position)[0]
+        self.__position += 4
+        return valeur
+
+
+DRBG = Drbg()
@@ -1,5 +1,4 @@
 # Programme appareil millegrille
-import json
 import time
 
 import machine
@@ -28,6 +27,8 @@ from millegrilles.certificat import entretien_certificat as __entretien_certific
 from millegrilles.message_inscription import run_inscription, recuperer_ca, \
      verifier_renouveler_certificat as __verifier_renouveler_certificat, parse_url, charger_fiche
 from millegrilles.chiffrage import ChiffrageMessages
+from millegrilles.journal_lectures import JournalLectures
+from millegrilles.filtre_etat import FiltreEtat
 
 from millegrilles.webutils import reboot
 from millegrilles.garbage_collector import garbage_collection_thread, garbage_collection_update
@@ -36,10 +37,11 @@ from millegrilles.garbage_collector import garbage_collection_thread, garbage_co
 # from dev import config
 from millegrilles.config import \
      set_time, detecter_mode_operation, get_tz_offset, initialisation, initialiser_wifi, get_relais, \
-     get_timezone_transition, transition_timezone, sauvegarder_relais
+     get_timezone_transition, transition_timezone, sauvegarder_relais, ordonner_relais, \
+     get_configuration_display
 
 from millegrilles.constantes import  CONST_MODE_INIT, CONST_MODE_RECUPERER_CA, CONST_MODE_CHARGER_URL_RELAIS, \
-     CONST_MODE_SIGNER_CERTIFICAT, CONST_MODE_POLLING, CONST_PATH_FICHIER_DISPLAY
+     CONST_MODE_SIGNER_CERTIFICAT, CONST_MODE_POLLING
 
 CONST_INFO_SEP = const(' ---- INFO ----')
 CONST_NB_ERREURS_RESET = const(10)
@@ -84,6 +86,7 @@ class Runner:
         self.__lectures_event = asyncio.Event()  # Utilise pour attendre une maj de lectures
         self.__rtc_pret = asyncio.Event()       # Indique que WIFI et l'heure interne (RTC) sont prets.
         self.__websocket_pret = asyncio.Event() # Indique que l'appareil est connecte et pret.
+        self.__reveil_websocket = None  # Event de reveil du poll websocket (connecte seulement)
         self.__url_relais = None
         self.__ui_lock = None  # Lock pour evenements UI (led, ecrans)
         
@@ -100,16 +103,30 @@ class Runner:
         # Information de chiffrage
         self.__chiffrage_messages = ChiffrageMessages()
 
+        # Lectures prises pendant que le relai est injoignable
+        self.__journal_lectures = JournalLectures()
+
+        # Emission de l'etat sur changement significatif des lectures ou battement
+        self.__filtre_etat = FiltreEtat()
+
     def set_rtc_pret(self):
         if self.__rtc_pret.is_set() is not True:
             self.__rtc_pret.set()
 
-    def set_websocket_pret(self):
+    def set_websocket_pret(self, reveil=None):
+        """ @param reveil: Event de reveil du poll, signale avec emit_event """
+        self.__reveil_websocket = reveil
         if self.__websocket_pret.is_set() is not True:
             self.__websocket_pret.set()
 
     def reset_websocket_pret(self):
         self.__websocket_pret.clear()
+        self.__reveil_websocket = None
+
+    def __signaler_emission(self):
+        self.__emit_event.set()
+        if self.__reveil_websocket is not None:
+            self.__reveil_websocket.set()
 
     @property
     def rtc_pret(self) -> asyncio.Event:
@@ -132,11 +149,19 @@ class Runner:
         self.__stale_event.set()
 
     async def trigger_emit_event(self):
-        self.__emit_event.set()
+        self.__signaler_emission()
 
     @property
     def chiffrage_messages(self) -> ChiffrageMessages:
         return self.__chiffrage_messages
+
+    @property
+    def journal_lectures(self) -> JournalLectures:
+        return self.__journal_lectures
+
+    @property
+    def filtre_etat(self) -> FiltreEtat:
+        return self.__filtre_etat
     
     async def configurer_devices(self):
         self.__ui_lock = asyncio.Lock()
@@ -149,6 +174,16 @@ class Runner:
         self._lectures_courantes = lectures
         self.__lectures_event.set()
 
+        if self.__websocket_pret.is_set() is True:
+            if self.__filtre_etat.changement(lectures) is True:
+                self.__signaler_emission()  # Changement au-dela des deadbands
+        elif self.__rtc_pret.is_set() is True:
+            # Hors ligne, conserver les lectures pour televersement a la reconnexion
+            try:
+                self.__journal_lectures.ajouter(lectures)
+            except Exception as e:
+                print("Erreur journal lectures : %s" % e)
+
     def recevoir_lectures_externes(self, lectures: dict):
         # print("recevoir_lectures: %s" % lectures)
         self._lectures_externes.update(lectures)
@@ -465,19 +500,16 @@ class Runner:
             print('charger_urls rtc non pret')
 
     def get_configuration_display(self):
-        try:
-            with open(CONST_PATH_FICHIER_DISPLAY, 'rb') as fichier:
-                return json.load(fichier)
-        except OSError:
-            pass  # Fichier absent
+        return get_configuration_display()  # Cache RAM, None si displays.json absent
 
     def set_relais(self, relais: list):
         if relais is not None:
-            self.__url_relais = relais
+            # Relai le plus rapide (scores persistes) en premier
+            self.__url_relais = ordonner_relais(relais)
         print("URL relais : %s" % self.__url_relais)
         
-    def pop_relais(self):
-        return self.__url_relais.pop()
+    def get_url_relais(self) -> list:
+        return self.__url_relais
     
     async def _polling(self):
         """
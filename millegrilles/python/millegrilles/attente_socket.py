@@ -0,0 +1,28 @@
+import uselect as select
+
+from uasyncio import core
+from uerrno import ECONNREFUSED
+
+# Attente non-bloquante sur un socket : la tache est reveillee par le poll de uasyncio (aucun sleep).
+# Partage par uwebsockets, urequests2 et resolveur_dns. Annulable, e.g. avec wait_for_ms.
+# Attention : l'annulation retire le socket de la file d'I/O dans les deux sens.
+
+
+async def attendre_ecriture(sock):
+    yield core._io_queue.queue_write(sock)
+
+
+async def attendre_lecture(sock):
+    yield core._io_queue.queue_read(sock)
+
+
+def verifier_connexion(sock):
+    """
+    Un connect() non-bloquant refuse (RST) rend aussi le socket pret en ecriture.
+    @raises OSError(ECONNREFUSED) si le socket est en erreur ou raccroche (POLLERR/POLLHUP)
+    """
+    poller = select.poll()
+    poller.register(sock, select.POLLOUT)
+    for _, evenements in poller.poll(0):
+        if evenements & (select.POLLERR | select.POLLHUP):
+            raise OSError(ECONNREFUSED)
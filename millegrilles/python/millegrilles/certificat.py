@@ -5,13 +5,16 @@ import oryx_crypto
 import time
 import uasyncio as asyncio
 
+from json import dumps
 from os import mkdir, remove
 from math import floor
 from struct import pack
-from random import getrandbits
 
 from multiformats import multihash, multibase
 
+from millegrilles.aleatoire import DRBG
+from millegrilles.mgthreads import executer_crypto
+
 MARQUEUR_END_CERTIFICATE = const(b'-----END CERTIFICATE-----')
 CONST_HACHAGE_FINGERPRINT = const('blake2s-256')
 
@@ -20,9 +23,9 @@ OID_ROLES = bytearray([0x2a, 0x03, 0x04, 0x01])
 OID_DOMAINES = bytearray([0x2a, 0x03, 0x04, 0x02])
 OID_USER_ID = bytearray([0x2a, 0x03, 0x04, 0x03])
 
-# CONST_CACHE_ACCES = const('_cache_acces')
-# CONST_CACHE_HIGH_LEN = const(7)
-# CONST_CACHE_MAX_LEN = const(20)
+CONST_CACHE_HIGH_LEN = const(7)
+CONST_CACHE_MAX_LEN = const(20)
+CONST_ROLES_CACHE = const(('senseurspassifs', 'senseurspassifs_relai', 'maitredescles', 'core'))
 
 PATHNAME_RENOUVELER = const('/renouveler')
 
@@ -34,19 +37,180 @@ PATH_CERT = const('certs/cert.pem')
 IDMG_VERSION_ACTIVE = const(2)
 
 
-# Cache pour certains certificats
-# CACHE_DICT = dict()
+# Cache LRU des certificats valides. cle: fingerprint, valeur: [compteur acces, enveloppe]
+CACHE_DICT = dict()
+CACHE_STATS = {'hit': 0, 'miss': 0}
+_compteur_acces_cache = 0
+_cache_ca_der = None
+
+
+def get_cache_certificat(fingerprint: str, date_validation: int):
+    """ Retourne l'enveloppe du certificat en cache si presente et non expiree. """
+    global _compteur_acces_cache
+
+    entree = CACHE_DICT.get(fingerprint)
+    if entree is None:
+        CACHE_STATS['miss'] += 1
+        return None
+
+    enveloppe = entree[1]
+    if enveloppe['expiration'] < date_validation:
+        # Certificat expire, retirer du cache
+        del CACHE_DICT[fingerprint]
+        CACHE_STATS['miss'] += 1
+        return None
+
+    _compteur_acces_cache += 1
+    entree[0] = _compteur_acces_cache
+    CACHE_STATS['hit'] += 1
+    return enveloppe
+
+
+def conserver_cache_certificat(enveloppe: dict):
+    global _compteur_acces_cache
+
+    if enveloppe.get('err') is not None:
+        return  # Chaine incomplete (e.g. CA absent), ne pas conserver
+
+    roles = enveloppe.get('roles') or list()
+    for role in roles:
+        if role in CONST_ROLES_CACHE:
+            break
+    else:
+        return  # Role non conserve en cache
+
+    if enveloppe['expiration'] <= time.time():
+        return  # Le certificat doit etre presentement valide
+
+    if len(CACHE_DICT) >= CONST_CACHE_MAX_LEN:
+        # Retirer l'entree la moins recemment utilisee
+        fingerprint_lru = None
+        acces_lru = None
+        for fingerprint, entree in CACHE_DICT.items():
+            if acces_lru is None or entree[0] < acces_lru:
+                fingerprint_lru = fingerprint
+                acces_lru = entree[0]
+        del CACHE_DICT[fingerprint_lru]
+
+    _compteur_acces_cache += 1
+    CACHE_DICT[enveloppe['fingerprint']] = [_compteur_acces_cache, enveloppe]
+
+
+def entretien_cache_certificats():
+    """ Retire les certificats expires et reduit le cache aux entrees les plus recemment utilisees. """
+    global CACHE_DICT
+
+    now = time.time()
+    for fingerprint in [f for f, e in CACHE_DICT.items() if e[1]['expiration'] < now]:
+        del CACHE_DICT[fingerprint]
+
+    if len(CACHE_DICT) > CONST_CACHE_HIGH_LEN:
+        entrees = sorted(CACHE_DICT.items(), reverse=True, key=cache_sort_key)
+        CACHE_DICT = dict(entrees[:CONST_CACHE_HIGH_LEN])
+
+
+def clear_cache_certificats():
+    global _cache_ca_der
+    CACHE_DICT.clear()
+    _cache_ca_der = None
+
+
+def charger_ca_der() -> bytes:
+    """ Certificat CA (DER) conserve en memoire apres la premiere lecture. """
+    global _cache_ca_der
+    if _cache_ca_der is None:
+        with open(PATH_CA_CERT, 'rb') as fichier:
+            _cache_ca_der = fichier.read()
+    return _cache_ca_der
+
+
+class IdentiteLocale:
+    """
+    Cache en memoire de l'identite de l'appareil (cle privee, cle publique, chaine de certificats).
+    Evite de relire la flash pour chaque message signe. Doit etre invalide lorsque les fichiers changent.
+    """
+
+    def __init__(self):
+        self.__cle_privee = None
+        self.__cle_publique = None
+        self.__pubkey = None
+        self.__chaine_pem = None
+        self.__chaine_pem_json = None
+
+    def invalider(self):
+        self.__cle_privee = None
+        self.__cle_publique = None
+        self.__pubkey = None
+        self.__chaine_pem = None
+        self.__chaine_pem_json = None
+
+    def __charger_cles(self):
+        try:
+            with open(PATH_CLE_PRIVEE, 'rb') as fichier:
+                cle_privee = fichier.read()
+        except OSError:
+            with open(PATH_CLE_PRIVEE + '.new', 'rb') as fichier:
+                cle_privee = fichier.read()
+
+        if len(cle_privee) == 64:
+            # La cle publique est deja calculee
+            cle_publique = cle_privee[32:]
+        else:
+            cle_publique = oryx_crypto.ed25519generatepubkey(cle_privee[:32])
+
+        self.__cle_privee = cle_privee[:32]
+        self.__cle_publique = cle_publique
+        self.__pubkey = binascii.hexlify(cle_publique).decode('utf-8')
+
+    @property
+    def cle_privee(self) -> bytes:
+        if self.__cle_privee is None:
+            self.__charger_cles()
+        return self.__cle_privee
+
+    @property
+    def cle_publique(self) -> bytes:
+        if self.__cle_publique is None:
+            self.__charger_cles()
+        return self.__cle_publique
+
+    @property
+    def pubkey(self) -> str:
+        """ Cle publique en hex (fingerprint) """
+        if self.__pubkey is None:
+            self.__charger_cles()
+        return self.__pubkey
+
+    @property
+    def chaine_pem(self):
+        """ Chaine de certificats PEM (list de str). None si le certificat est absent. """
+        if self.__chaine_pem is None:
+            pem = get_certificat_local()
+            if pem is None:
+                return None  # Pas de cache, le certificat n'est pas encore recu
+            self.__chaine_pem = split_pem(pem, format_str=True)
+        return self.__chaine_pem
+
+    @property
+    def chaine_pem_json(self) -> bytes:
+        """ Chaine de certificats deja encodee en json, prete a copier dans un buffer de message. """
+        if self.__chaine_pem_json is None:
+            chaine_pem = self.chaine_pem
+            if chaine_pem is None:
+                return None
+            self.__chaine_pem_json = dumps(chaine_pem).encode('utf-8')
+        return self.__chaine_pem_json
+
+
+IDENTITE_LOCALE = IdentiteLocale()
+
+
+def invalider_identite_locale():
+    IDENTITE_LOCALE.invalider()
 
 
 def rnd_bytes(nb_bytes):
-    bytes_courant = nb_bytes
-    rnd_val = bytes()
-    while bytes_courant > 0:
-        bytes_courant -= 4
-        rnd_bits = getrandbits(32)  # 4 bytes
-        rnd_val += bytes(pack('L', rnd_bits))
-    
-    return rnd_val[:nb_bytes]
+    return DRBG.bytes(nb_bytes)
 
 
 def calculer_fingerprint(contenu_der):
@@ -149,26 +313,19 @@ async def valider_certificats(pem_certs: list, date_validation=None, is_der=Fals
     """ Valide la chaine de certificats, incluant le dernier avec le CA.
         @return Information du certificat leaf
         @raises Exception Si la chaine est invalide. """
-    # global CACHE_DICT
-
+    utiliser_cache = False
     if date_validation is None:
         date_validation = time.time()
+        utiliser_cache = True
     elif date_validation is False:
         date_validation = 0  # Invalide la date
     # print("valider_certificats avec time %s" % date_validation)
 
     # Verifier si le certificat est dans le cache memoire
-    # if fingerprint is not None:
-    #     if CACHE_DICT.get(fingerprint) is not None:
-    #         #print("Cert Cache HIT %s", fingerprint)
-    #         if date_validation is not None:
-    #             # TODO : Valider la date - note : un certificat en cache doit etre presentement valide
-    #             pass
-    #         enveloppe = CACHE_DICT[fingerprint]
-    #         enveloppe[CONST_CACHE_ACCES] += 1  # Incrementer nombre d'acces, cache est most commonly used
-    #         return enveloppe
-    #     #else:
-    #     #    print("Cert Cache MISS %s", fingerprint)
+    if utiliser_cache is True and fingerprint is not None:
+        enveloppe = get_cache_certificat(fingerprint, date_validation)
+        if enveloppe is not None:
+            return enveloppe
 
     cert = pem_certs.pop(0)
     if is_der is False:
@@ -194,15 +351,12 @@ async def valider_certificats(pem_certs: list, date_validation=None, is_der=Fals
         parent = pem_certs.pop(0)
         if is_der is False:
             parent = oryx_crypto.x509readpemcertificate(parent)
-        asyncio.sleep_ms(10)  # Yield
-        oryx_crypto.x509validercertificate(cert, parent, date_validation)
+        await executer_crypto(oryx_crypto.x509validercertificate, cert, parent, date_validation)
         cert = parent  # Poursuivre la chaine
     else:
         try:
-            with open(PATH_CA_CERT, 'rb') as fichier:
-                parent = fichier.read()
-            asyncio.sleep_ms(10)  # Yield
-            oryx_crypto.x509validercertificate(cert, parent, date_validation)
+            parent = charger_ca_der()
+            await executer_crypto(oryx_crypto.x509validercertificate, cert, parent, date_validation)
         except OSError as e:
             if e.errno == 2:
                 if err_ca_ok is True:
@@ -232,17 +386,9 @@ async def valider_certificats(pem_certs: list, date_validation=None, is_der=Fals
     if user_id is not None:
         enveloppe['user_id'] = user_id
     
-    # # Verifier si on conserve le certificat dans le cache
-    # if len(CACHE_DICT) < CONST_CACHE_MAX_LEN:  # Limite d'elements concurrents dans le cache (cleanup va reduire la taille)
-    #     if 'senseurspassifs' in roles or \
-    #        'senseurspassifs_relai' in roles or \
-    #        'maitredescles' in roles or \
-    #        'core' in roles:
-    #         # Verifier si le certificat est presentement valide - requis pour mettre en cache
-    #         if enveloppe['expiration'] > time.time():
-    #             enveloppe[CONST_CACHE_ACCES] = 1
-    #             CACHE_DICT[fingerprint] = enveloppe
-    
+    if utiliser_cache is True:
+        conserver_cache_certificat(enveloppe)
+
     return enveloppe
 
 
@@ -280,6 +426,8 @@ def sauvegarder_ca(ca_pem, idmg=None):
     with open(PATH_CA_CERT, 'wb') as fichier:
         fichier.write(ca_der)
 
+    clear_cache_certificats()
+
 
 def generer_cle_secrete(inclure_publique=False):
     cle_privee = rnd_bytes(32)
@@ -287,6 +435,7 @@ def generer_cle_secrete(inclure_publique=False):
     with open(PATH_CLE_PRIVEE + '.new', 'wb') as fichier:
         fichier.write(cle_privee)    # Premiers 32 bytes
         fichier.write(cle_publique)  # Derniers 32 bytes
+    invalider_identite_locale()
 
     # Cleanup, retirer certs/cert.pem.new si present
     try:
@@ -302,6 +451,9 @@ def generer_cle_secrete(inclure_publique=False):
 
 def charger_cle_privee(path_cle = PATH_CLE_PRIVEE):
     # print('Charger cle privee %s pour conversion publique' % path_cle)
+    if path_cle == PATH_CLE_PRIVEE:
+        return IDENTITE_LOCALE.cle_privee
+
     try:
         with open(path_cle, 'rb') as fichier:
             cle_privee = fichier.read()
@@ -314,6 +466,9 @@ def charger_cle_privee(path_cle = PATH_CLE_PRIVEE):
 
 def charger_cle_publique(path_cle = PATH_CLE_PRIVEE):
     # print('Charger cle privee %s pour conversion publique' % path_cle)
+    if path_cle == PATH_CLE_PRIVEE:
+        return IDENTITE_LOCALE.cle_publique
+
     try:
         with open(path_cle, 'rb') as fichier:
             cle_privee = fichier.read()
@@ -330,12 +485,11 @@ def charger_cle_publique(path_cle = PATH_CLE_PRIVEE):
 
 
 def get_fingerprint_local():
-    cle_publique = charger_cle_publique()
-    return binascii.hexlify(cle_publique).decode('utf-8')
+    return IDENTITE_LOCALE.pubkey
 
 
 def get_userid_local():
-    cert_local = split_pem(get_certificat_local())[0]
+    cert_local = oryx_crypto.x509readpemcertificate(IDENTITE_LOCALE.chaine_pem[0])
     x509_info = oryx_crypto.x509certificatinfo(cert_local)
     return oryx_crypto.x509Extension(x509_info, OID_USER_ID)
 
@@ -363,6 +517,7 @@ def remove_certificate():
         remove(PATH_CERT)
     except OSError:
         pass
+    invalider_identite_locale()
 
 
 def remove_ca():
@@ -370,10 +525,12 @@ def remove_ca():
         remove(PATH_CA_CERT)
     except OSError:
         pass
+    clear_cache_certificats()
 
 
 async def entretien_certificat():
-    # global CACHE_DICT
+    # Entretien cache
+    entretien_cache_certificats()
 
     date_expiration, cle_publique = get_expiration_certificat_local()
     print("Date expiration cert : %s" % date_expiration)
@@ -399,15 +556,8 @@ async def entretien_certificat():
         remove_certificate()
         return False
     
-    # # Entretien cache
-    # if len(CACHE_DICT) > CONST_CACHE_HIGH_LEN:
-    #     # Trier entrees de cache
-    #     cache_values = sort(CACHE_DICT.values(), reverse=True, key=cache_sort_key)
-    #     # Conserver les N premieres entrees
-    #     CACHE_DICT = cache_values[0:CONST_CACHE_HIGH_LEN]
-
     return True
 
 
 def cache_sort_key(elem):
-    return elem[CONST_CACHE_ACCES]
+    return elem[1][0]  # Compteur d'acces de (fingerprint, [acces, enveloppe])
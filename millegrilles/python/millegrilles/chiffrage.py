@@ -2,15 +2,61 @@ import time
 
 import oryx_crypto
 
-from ubinascii import a2b_base64, b2a_base64, hexlify, unhexlify
+from io import IOBase
+from ubinascii import a2b_base64, hexlify, unhexlify
 
-from json import dumps
+from json import dump
 
-from millegrilles.certificat import rnd_bytes, get_fingerprint_local
+from millegrilles.aleatoire import DRBG
+from millegrilles.certificat import get_fingerprint_local
 from millegrilles.message_inscription import NOM_APPAREIL
+from millegrilles.mgmessages import utf8_view
+from millegrilles.mgthreads import executer_crypto
 
 EXPIRATION_SECRET = const(6*3600)
 
+# Taille des blocs de plaintext chiffres, multiple de 3 (base64 sans padding intermediaire)
+CONST_TAILLE_BLOC_CHIFFRAGE = const(240)
+
+
+class FluxChiffrage(IOBase):
+    """
+    Stream ChaCha20Poly1305 : le plaintext recu (e.g. json.dump) est chiffre en place par blocs
+    et le ciphertext est ecrit en base64 directement dans le buffer de destination (BufferMessage).
+    """
+
+    def __init__(self, secret, nonce, buffer):
+        super().__init__()
+        self.__contexte = oryx_crypto.chacha20poly1305init(secret, nonce)
+        self.__buffer = buffer
+        self.__bloc = bytearray(CONST_TAILLE_BLOC_CHIFFRAGE)
+        self.__len_bloc = 0
+
+    def write(self, data):
+        data = utf8_view(data)
+        taille = len(data)
+        position = 0
+        while position < taille:
+            n = min(taille - position, CONST_TAILLE_BLOC_CHIFFRAGE - self.__len_bloc)
+            self.__bloc[self.__len_bloc:self.__len_bloc+n] = data[position:position+n]
+            self.__len_bloc += n
+            position += n
+            if self.__len_bloc == CONST_TAILLE_BLOC_CHIFFRAGE:
+                self.__vider_bloc()
+        return taille
+
+    def __vider_bloc(self):
+        bloc = memoryview(self.__bloc)[:self.__len_bloc]
+        oryx_crypto.chacha20poly1305update(self.__contexte, bloc)
+        self.__buffer.ecrire_base64(bloc)
+        self.__len_bloc = 0
+
+    def final(self) -> bytes:
+        """ Chiffre le dernier bloc. @return tag (MAC) """
+        if self.__len_bloc > 0:
+            self.__vider_bloc()
+        return oryx_crypto.chacha20poly1305final(self.__contexte)
+
 
 class ChiffrageMessages:
 
@@ -33,7 +79,7 @@ class ChiffrageMessages:
 
     def generer_cle_bytes(self) -> bytes:
         if self.__cle_privee_echange is None:
-            self.__cle_privee_echange = rnd_bytes(32)
+            self.__cle_privee_echange = DRBG.bytes(32)
         cle_publique = oryx_crypto.x25519generatepubkey(self.__cle_privee_echange)
         return cle_publique
 
@@ -41,12 +87,13 @@ class ChiffrageMessages:
         self.__fingerprint_local = get_fingerprint_local()
         self.__uuid_appareil = NOM_APPAREIL
 
-    def calculer_secret_exchange(self, cle_publique: str, charger_info_app=True):
+    async def calculer_secret_exchange(self, cle_publique: str, charger_info_app=True):
         if self.__cle_privee_echange is None:
             raise Exception('cle privee None')
 
         cle_publique_remote = unhexlify(cle_publique.encode('utf-8'))
-        self.__secret_echange = oryx_crypto.x25519computesharedsecret(self.__cle_privee_echange, cle_publique_remote)
+        self.__secret_echange = await executer_crypto(
+            oryx_crypto.x25519computesharedsecret, self.__cle_privee_echange, cle_publique_remote)
 
         # print("!!! SECRET !!! : %s" % hexlify(self.__secret_echange))
 
@@ -68,27 +115,52 @@ class ChiffrageMessages:
     def pret(self):
         return self.__secret_echange is not None
 
-    async def chiffrer(self, message: dict) -> dict:
-        message = dumps(message)
-
+    async def ecrire_chiffre(self, message: dict, buffer, routage=None):
+        """
+        Chiffre message et ecrit l'enveloppe {uuid_appareil, fingerprint, nonce, ciphertext, tag, routage?}
+        directement dans buffer (BufferMessage), sans chaines intermediaires.
+        """
         # ticks_debut = time.ticks_ms()
-        nonce = rnd_bytes(12)
-        tag = oryx_crypto.cipherchacha20poly1305encrypt(self.__secret_echange, nonce, message)
-        tag = b2a_base64(tag).decode('utf-8')[:-1]
-        nonce = b2a_base64(nonce).decode('utf-8')[:-1]
+        nonce = DRBG.bytes(12)
+
+        buffer.clear()
+        buffer.write('{"uuid_appareil":')
+        dump(self.__uuid_appareil, buffer)
+        buffer.write(',"fingerprint":')
+        dump(self.__fingerprint_local, buffer)
+        buffer.write(',"nonce":"')
+        buffer.ecrire_base64(nonce)
+        buffer.write('","ciphertext":"')
+        flux = FluxChiffrage(self.__secret_echange, nonce, buffer)
+        dump(message, flux)
+        tag = flux.final()
+        buffer.write('","tag":"')
+        buffer.ecrire_base64(tag)
+        buffer.write('"')
+        if routage is not None:
+            buffer.write(',"routage":')
+            dump(routage, buffer)
+        buffer.write('}')
         # print("chiffrer duree %d ms" % time.ticks_diff(time.ticks_ms(), ticks_debut))
 
-        return {
-            'uuid_appareil': self.__uuid_appareil,
-            'fingerprint': self.__fingerprint_local,
-            'nonce': nonce,
-            'tag': tag,
-            'ciphertext': b2a_base64(message).decode('utf-8')[:-1],
-        }
-
-    def dechiffrer(self, message: dict) -> bytes:
-        nonce_tag = a2b_base64(message['nonce']) + a2b_base64(message['tag'])
-        ciphertext = a2b_base64(message['ciphertext'])
+        return buffer
+
+    def dechiffrer(self, message: dict, buffer=None):
+        """
+        Dechiffre message. Si buffer (BufferMessage) est fourni, le ciphertext y est decode (base64)
+        et dechiffre en place.
+        @return bytes ou memoryview du plaintext
+        """
+        nonce_tag = bytearray(28)
+        if oryx_crypto.base64decode(message['nonce'], nonce_tag) != 12:
+            raise ValueError('nonce')
+        if oryx_crypto.base64decode(message['tag'], memoryview(nonce_tag)[12:]) != 16:
+            raise ValueError('tag')
+
+        if buffer is not None:
+            ciphertext = buffer.set_base64(message['ciphertext'])
+        else:
+            ciphertext = a2b_base64(message['ciphertext'])
 
         # Le contenu est dechiffre _en-place_ dans ciphertext
         oryx_crypto.cipherchacha20poly1305decrypt(self.__secret_echange, nonce_tag, ciphertext)
@@ -1,20 +1,22 @@
-import os
 from json import load, dump
 from os import stat, unlink
 from uasyncio import sleep, sleep_ms
 from sys import print_exception
 from network import STAT_GOT_IP
 
-from mgutils import comparer_dict
+from mgutils import comparer_dict, recaler_debut
 from millegrilles.const_leds import CODE_CONFIG_INITIALISATION
 from millegrilles.ledblink import led_executer_sequence
 from millegrilles.wifi import connect_wifi, detecter_wifi, ErreurConnexionWifi
 from millegrilles.certificat import PATH_CERT, PATH_CA_CERT
+from millegrilles.config_store import CONFIG_STORE, STATS_CONFIG
+from millegrilles.filtre_etat import STATS_ETAT
 
 from millegrilles import constantes
 
 from millegrilles.constantes import CONST_PATH_FICHIER_DISPLAY, CONST_PATH_FICHIER_PROGRAMMES, \
     CONST_PATH_TIMEINFO, CONST_PATH_TZOFFSET, CONST_PATH_SOLAIRE, CONST_PATH_RELAIS, CONST_PATH_RELAIS_NEW, \
+    CONST_PATH_RELAIS_SCORES, \
     CONST_MODE_INIT, CONST_MODE_RECUPERER_CA, CONST_MODE_CHARGER_URL_RELAIS, CONST_MODE_SIGNER_CERTIFICAT, \
     CONST_MODE_POLLING, CONST_HTTP_TIMEOUT_DEFAULT, CONST_CHAMP_HTTP_INSTANCE, \
     CONST_CHAMPS_SOLAIRE, CONST_SOLAIRE_CHANGEMENT, \
@@ -25,6 +27,16 @@ from millegrilles.constantes import CONST_PATH_FICHIER_DISPLAY, CONST_PATH_FICHI
     CONST_CHAMP_HTTPS, CONST_CHAMP_PORTS, CONST_CHAMP_DOMAINES, CONST_CHAMP_RELAIS, \
     CONST_READ_BINARY, CONST_WRITE_BINARY
 
+# Score des relais (ms) : moyenne mobile de la latence connexion + upgrade websocket, plus penalite par echec
+CONST_LATENCE_INCONNUE_MS = const(1500)  # Relai jamais mesure, essaye avant un relai lent ou en echec
+CONST_PENALITE_ECHEC_MS = const(3000)
+CONST_ECHECS_MAX = const(5)
+CONST_ECART_LATENCE_MS = const(100)  # Variation de latence minimale pour reecrire relais_scores.json
+
+_scores_relais = None  # {url: [latence_ms, echecs]}, charge de relais_scores.json
+_scores_modifies = False
+_latences_sauvegardees = dict()  # {url: latence_ms} telle qu'ecrite dans relais_scores.json
+
 
 async def detecter_mode_operation():
     # Si wifi.txt/idmg.txt manquants, on est en mode initial.
@@ -202,40 +214,42 @@ def get_http_timeout():
     return CONST_HTTP_TIMEOUT_DEFAULT
 
 
+def get_user():
+    user = CONFIG_STORE.lire(constantes.CONST_PATH_USER)
+    if user is None:
+        raise OSError(2)  # ENOENT, user.json absent
+    return user
+
+
 def get_idmg():
-    with open(constantes.CONST_PATH_USER, CONST_READ_BINARY) as fichier:
-        return load(fichier)[CONST_CHAMP_IDMG]
+    return get_user()[CONST_CHAMP_IDMG]
 
 
 def get_user_id():
-    with open(constantes.CONST_PATH_USER, CONST_READ_BINARY) as fichier:
-        return load(fichier)[CONST_CHAMP_USER_ID]
+    return get_user()[CONST_CHAMP_USER_ID]
 
 
 def get_timezone():
     try:
-        with open(CONST_PATH_TZOFFSET, CONST_READ_BINARY) as fichier:
-            return load(fichier)[CONST_CHAMP_TIMEZONE]
-    except (KeyError, OSError, ValueError):
+        return CONFIG_STORE.lire(CONST_PATH_TZOFFSET)[CONST_CHAMP_TIMEZONE]
+    except (KeyError, TypeError):
         return None
 
 
 def get_tz_offset():
     try:
-        with open(CONST_PATH_TZOFFSET, CONST_READ_BINARY) as fichier:
-            return load(fichier)[CONST_CHAMP_OFFSET]
-    except (KeyError, OSError, ValueError):
+        return CONFIG_STORE.lire(CONST_PATH_TZOFFSET)[CONST_CHAMP_OFFSET]
+    except (KeyError, TypeError):
         return None
 
 
 def get_timezone_transition():
     try:
-        with open(CONST_PATH_TZOFFSET, CONST_READ_BINARY) as fichier:
-            info_tz = load(fichier)
+        info_tz = CONFIG_STORE.lire(CONST_PATH_TZOFFSET)
         transition_time = info_tz[constantes.CONST_CHAMP_TRANSITION_TIME]
         transition_offset = info_tz[constantes.CONST_CHAMP_TRANSITION_OFFSET]
         return transition_time, transition_offset
-    except (KeyError, OSError, ValueError):
+    except (KeyError, TypeError):
         pass
 
     return None, None
@@ -243,14 +257,12 @@ def get_timezone_transition():
 
 async def transition_timezone():
     """ Effectuer une transition de timezone """
-    try:
-        with open(CONST_PATH_TZOFFSET, CONST_READ_BINARY) as fichier:
-            info_tz = load(fichier)
-        await sleep(0)
-    except OSError:
+    info_tz = CONFIG_STORE.lire(CONST_PATH_TZOFFSET)
+    if info_tz is None:
         print("tz transition erreur config absent")
         await sleep(1)
         return
+    await sleep(0)
 
     try:
         # Extraire timezone et le nouvel offset a appliquer
@@ -264,10 +276,7 @@ async def transition_timezone():
     except Exception as e:
         print("tz transition erreur, reset")
         print_exception(e)
-        try:
-            os.unlink(CONST_PATH_TZOFFSET)
-        except OSError:
-            pass
+        CONFIG_STORE.supprimer(CONST_PATH_TZOFFSET)
 
 
 async def set_timezone_offset(offset, timezone=None, transition_time=None, transition_offset=None, reset=False):
@@ -278,10 +287,8 @@ async def set_timezone_offset(offset, timezone=None, transition_time=None, trans
         diff = True
         tz_courant = dict()
     else:
-        try:
-            with open(CONST_PATH_TZOFFSET, CONST_READ_BINARY) as fichier:
-                tz_courant = load(fichier)
-        except (OSError, ValueError):
+        tz_courant = CONFIG_STORE.lire(CONST_PATH_TZOFFSET)
+        if tz_courant is None:
             print('tzoffset.json absent/invalide')
             diff = True
             tz_courant = dict()
@@ -298,14 +305,13 @@ async def set_timezone_offset(offset, timezone=None, transition_time=None, trans
 
     if diff:
         print("overwrite %s" % CONST_PATH_TZOFFSET)
-        with open(CONST_PATH_TZOFFSET, CONST_WRITE_BINARY) as fichier:
-            params = {
-                CONST_CHAMP_OFFSET: offset,
-                CONST_CHAMP_TIMEZONE: timezone or tz_courant.get(CONST_CHAMP_TIMEZONE),
-                CONST_CHAMP_TRANSITION_TIME: transition_time or tz_courant.get(CONST_CHAMP_TRANSITION_TIME),
-                CONST_CHAMP_TRANSITION_OFFSET: transition_offset or tz_courant.get(CONST_CHAMP_TRANSITION_OFFSET)
-            }
-            dump(params, fichier)
+        params = {
+            CONST_CHAMP_OFFSET: offset,
+            CONST_CHAMP_TIMEZONE: timezone or tz_courant.get(CONST_CHAMP_TIMEZONE),
+            CONST_CHAMP_TRANSITION_TIME: transition_time or tz_courant.get(CONST_CHAMP_TRANSITION_TIME),
+            CONST_CHAMP_TRANSITION_OFFSET: transition_offset or tz_courant.get(CONST_CHAMP_TRANSITION_OFFSET)
+        }
+        CONFIG_STORE.ecrire(CONST_PATH_TZOFFSET, params)
 
 
 def temps_liste_to_secs(temps_list: list):
@@ -323,14 +329,11 @@ def temps_liste_to_secs(temps_list: list):
 
 async def set_horaire_solaire(solaire: dict):
     print("set solaire %s" % solaire)
-    try:
-        with open(CONST_PATH_SOLAIRE, CONST_READ_BINARY) as fichier:
-            solaire_courant = load(fichier)
-    except OSError:
+    solaire_courant = CONFIG_STORE.lire(CONST_PATH_SOLAIRE)
+    if solaire_courant is None:
         # sauvegarder information directement
-        with open(CONST_PATH_SOLAIRE, CONST_WRITE_BINARY) as fichier:
-            print("maj solaire(1)")
-            dump(solaire, fichier)
+        print("maj solaire(1)")
+        CONFIG_STORE.ecrire(CONST_PATH_SOLAIRE, solaire)
         return
 
     # Comparer valeurs recues, eviter write IO si les changements sont mineurs pour reduire usure de la memoire flash
@@ -348,23 +351,21 @@ async def set_horaire_solaire(solaire: dict):
             val_max = max(val, val_max)
 
     if val_max > CONST_SOLAIRE_CHANGEMENT:  # Limite de 2 minutes pour changer le contenu
-        with open(CONST_PATH_SOLAIRE, 'wb') as fichier:
-            print("maj solaire(2) diff %d secs" % val_max)
-            dump(solaire, fichier)
+        print("maj solaire(2) diff %d secs" % val_max)
+        CONFIG_STORE.ecrire(CONST_PATH_SOLAIRE, solaire)
 
 
 def get_horaire_solaire():
-    try:
-        with open(CONST_PATH_SOLAIRE, CONST_READ_BINARY) as fichier:
-            return load(fichier)
-    except OSError:
-        return
+    return CONFIG_STORE.lire(CONST_PATH_SOLAIRE)
+
+
+def get_configuration_display():
+    return CONFIG_STORE.lire(CONST_PATH_FICHIER_DISPLAY)
 
 
 def set_configuration_display(configuration: dict):
     # print('Maj configuration display')
-    with open(CONST_PATH_FICHIER_DISPLAY, CONST_WRITE_BINARY) as fichier:
-        dump(configuration, fichier)
+    CONFIG_STORE.ecrire(CONST_PATH_FICHIER_DISPLAY, configuration)
 
 
 def set_nom_appareil(nom_appareil: str):
@@ -512,6 +513,12 @@ def sauvegarder_relais_liste(url_relais: list):
                 change = True
 
     if change:
+        # Retirer les scores des relais qui ne sont plus dans la fiche
+        scores = get_scores_relais()
+        for relai in [r for r in scores if r not in url_relais]:
+            del scores[relai]
+            marquer_scores_modifies()
+
         print('Sauvegarder %s maj' % CONST_PATH_RELAIS)
         try:
             with open(CONST_PATH_RELAIS, CONST_WRITE_BINARY) as fichier:
@@ -549,16 +556,105 @@ def get_relais():
     return relais
 
 
+def get_scores_relais() -> dict:
+    global _scores_relais
+    if _scores_relais is None:
+        try:
+            with open(CONST_PATH_RELAIS_SCORES, CONST_READ_BINARY) as fichier:
+                _scores_relais = load(fichier)
+        except (OSError, ValueError):
+            _scores_relais = dict()
+        _noter_latences_sauvegardees()
+    return _scores_relais
+
+
+def _noter_latences_sauvegardees():
+    _latences_sauvegardees.clear()
+    for url, score in _scores_relais.items():
+        _latences_sauvegardees[url] = score[0]
+
+
+def marquer_scores_modifies():
+    global _scores_modifies
+    _scores_modifies = True
+
+
+def score_relai(url: str) -> int:
+    try:
+        latence, echecs = get_scores_relais()[url]
+    except KeyError:
+        return CONST_LATENCE_INCONNUE_MS
+    return latence + echecs * CONST_PENALITE_ECHEC_MS
+
+
+def noter_relai(url: str, latence_ms=None):
+    """
+    Met a jour le score du relai en memoire (voir sauvegarder_scores_relais).
+    @param latence_ms: Duree connexion + upgrade websocket. None si la tentative a echoue.
+    """
+    scores = get_scores_relais()
+    score = scores.get(url)
+    echecs = None if score is None else score[1]
+    if latence_ms is None:
+        if score is None:
+            score = [CONST_LATENCE_INCONNUE_MS, 0]
+        score[1] = min(score[1] + 1, CONST_ECHECS_MAX)
+    elif score is None:
+        score = [latence_ms, 0]
+    else:
+        score[0] = (3 * score[0] + latence_ms) // 4
+        score[1] = score[1] // 2  # Le relai se retablit apres quelques succes
+    scores[url] = score
+
+    # Reecrire sur flash seulement si le classement peut changer (pas a chaque reconnexion)
+    latence_sauvegardee = _latences_sauvegardees.get(url)
+    if score[1] != echecs or latence_sauvegardee is None or \
+            abs(score[0] - latence_sauvegardee) > CONST_ECART_LATENCE_MS:
+        marquer_scores_modifies()
+
+
+def sauvegarder_scores_relais():
+    """ Ecrit relais_scores.json si un score a change. """
+    global _scores_modifies
+    if _scores_modifies is False:
+        return
+    try:
+        with open(CONST_PATH_RELAIS_SCORES, CONST_WRITE_BINARY) as fichier:
+            dump(get_scores_relais(), fichier)
+        _scores_modifies = False
+        _noter_latences_sauvegardees()
+    except Exception as e:
+        print('Erreur sauvegarde %s' % CONST_PATH_RELAIS_SCORES)
+        print_exception(e)
+
+
+def ordonner_relais(relais: list) -> list:
+    """ Trie les relais en place, meilleur score (plus rapide) en premier. """
+    relais.sort(key=score_relai)
+    return relais
+
+
+def _recaler_stats(decalage_s: int):
+    """ Les metriques par heure comptent a partir de time.time() au demarrage, avant le reglage de l'horloge. """
+    recaler_debut(decalage_s, STATS_CONFIG, STATS_ETAT)
+
+
 async def set_time():
-    from ntptime import settime
+    import ntptime
     import time
     import urequests
     from millegrilles.webutils import parse_url
+    from millegrilles.resolveur_dns import resoudre
 
     # ntptime.host = 'maple.maceroc.com'
+    hote_ntp = ntptime.host
+    avant = time.time()
     try:
-        settime()
+        # Resolution DNS non-bloquante (cache), settime() recoit l'adresse ip
+        ntptime.host = await resoudre(hote_ntp)
+        ntptime.settime()
         print("NTP Time : ", time.gmtime())
+        _recaler_stats(time.time() - avant)
     except OSError as e:
         import sys
         print('NTP erreur')
@@ -585,6 +681,9 @@ async def set_time():
                     year, month, day, hour, minute, second, dow, doy = time.gmtime(time_reponse_int)
                     rtc = RTC()
                     rtc.datetime((year, month, day, dow, hour, minute, second, None))
+                    _recaler_stats(time.time() - avant)
                     return
 
         raise e
+    finally:
+        ntptime.host = hote_ntp
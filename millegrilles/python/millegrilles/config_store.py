@@ -0,0 +1,70 @@
+import time
+
+from json import load, dump
+from os import unlink
+
+from millegrilles.constantes import CONST_READ_BINARY, CONST_WRITE_BINARY
+
+# Cache en RAM des fichiers json de configuration (tzoffset.json, solaire.json, displays.json, user.json).
+# Chaque fichier est lu une seule fois sur flash, les modifications sont ecrites directement (write-through).
+# Les valeurs retournees sont partagees : ne pas les modifier, passer une copie a ecrire().
+
+# Metriques. ouvertures : open() sur flash (lectures et ecritures), cache : lectures servies de la RAM.
+STATS_CONFIG = {'ouvertures': 0, 'lectures': 0, 'cache': 0, 'ecritures': 0, 'debut': time.time()}
+
+
+class ConfigStore:
+
+    def __init__(self):
+        self.__contenu = dict()  # {chemin: valeur json}, None : fichier absent ou invalide
+
+    def lire(self, chemin: str):
+        """ @return Contenu json du fichier (partage, lecture seule) ou None si absent/invalide """
+        try:
+            valeur = self.__contenu[chemin]
+            STATS_CONFIG['cache'] += 1
+            return valeur
+        except KeyError:
+            pass
+
+        STATS_CONFIG['ouvertures'] += 1
+        STATS_CONFIG['lectures'] += 1
+        try:
+            with open(chemin, CONST_READ_BINARY) as fichier:
+                valeur = load(fichier)
+        except (OSError, ValueError):
+            valeur = None  # Absent aussi conserve, evite un open() a chaque lecture
+        self.__contenu[chemin] = valeur
+        return valeur
+
+    def ecrire(self, chemin: str, valeur):
+        """ Sauvegarde sur flash puis remplace le contenu en RAM. """
+        STATS_CONFIG['ouvertures'] += 1
+        STATS_CONFIG['ecritures'] += 1
+        try:
+            with open(chemin, CONST_WRITE_BINARY) as fichier:
+                dump(valeur, fichier)
+        except Exception:
+            self.invalider(chemin)  # Contenu du fichier inconnu, relire au prochain acces
+            raise
+        self.__contenu[chemin] = valeur
+
+    def supprimer(self, chemin: str):
+        self.__contenu[chemin] = None
+        try:
+            unlink(chemin)
+        except OSError:
+            pass
+
+    def invalider(self, chemin=None):
+        """ Force la relecture du fichier (modifie hors du store). chemin None : tous les fichiers. """
+        if chemin is None:
+            self.__contenu.clear()
+        else:
+            try:
+                del self.__contenu[chemin]
+            except KeyError:
+                pass
+
+
+CONFIG_STORE = ConfigStore()
@@ -12,6 +12,13 @@ CONST_PATH_USER_NEW = const('user.new.json')
 
 CONST_PATH_RELAIS = const('relais.json')
 CONST_PATH_RELAIS_NEW = const('relais.new.json')
+CONST_PATH_RELAIS_SCORES = const('relais_scores.json')
+
+CONST_PATH_FICHE = const('fiche.json')  # Derniere fiche recue (message signe, tel que telecharge)
+CONST_PATH_FICHE_META = const('fiche_meta.json')  # id, ETag/Last-Modified et verification de la fiche
+
+CONST_PATH_JOURNAL_LECTURES = const('lectures.jrn')
+CONST_PATH_JOURNAL_SENSEURS = const('lectures_senseurs.json')
 
 CONST_PATH_WIFI = const('wifi.json')
 CONST_PATH_WIFI_NEW = const('wifi.new.json')
@@ -0,0 +1,40 @@
+import time
+
+try:
+    import ssl
+except ImportError:
+    import ussl as ssl
+
+# SSLContext client partage par le websocket et urequests2. Le module ssl du firmware n'expose pas
+# les sessions TLS (aucun parametre session=, aucun attribut .session) : chaque connexion fait un
+# handshake complet, seule la configuration mbedtls du contexte est reutilisee.
+
+# Metriques. duree_ms : dernier handshake TLS
+STATS_TLS = {'handshakes': 0, 'duree_ms': 0}
+
+_contexte = None
+
+
+def get_contexte():
+    """
+    SSLContext client partage (configuration mbedtls reutilisee entre connexions).
+    @return SSLContext ou None si le firmware n'a que ssl.wrap_socket
+    """
+    global _contexte
+    if _contexte is None and hasattr(ssl, 'SSLContext'):
+        _contexte = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        _contexte.verify_mode = ssl.CERT_NONE  # Idem ssl.wrap_socket
+    return _contexte
+
+
+def wrap_socket(sock, hote: str):
+    """ Etablit la connexion TLS (bloquant) avec le contexte partage, SNI hote. """
+    debut = time.ticks_ms()
+    contexte = get_contexte()
+    if contexte is not None:
+        ssl_sock = contexte.wrap_socket(sock, server_hostname=hote)
+    else:
+        ssl_sock = ssl.wrap_socket(sock, server_hostname=hote)
+    STATS_TLS['handshakes'] += 1
+    STATS_TLS['duree_ms'] = time.ticks_diff(time.ticks_ms(), debut)
+    return ssl_sock
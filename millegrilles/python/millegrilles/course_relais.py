@@ -0,0 +1,160 @@
+import time
+import uasyncio as asyncio
+
+from gc import collect
+
+from uwebsockets.client import connect_tcp, handshake, ErreurDeflate
+from uwebsockets.protocol import urlparse
+
+# Course de connexion aux relais (happy eyeballs, RFC 8305) : les connexions TCP vers les
+# premiers relais sont demarrees en echelon, la premiere connectee gagne. Le handshake TLS du firmware
+# est bloquant (gele la boucle uasyncio) : il est fait seulement avec le gagnant TCP, un relai a la fois.
+CONST_NB_RELAIS_COURSE = const(3)  # Relais en tete de liste mis en course
+CONST_NB_SOCKETS_MAX = const(2)  # Sockets simultanes (heap mbedtls/lwIP du Pico W)
+CONST_DELAI_ECHELON_MS = const(250)  # Delai avant de demarrer le relai suivant
+CONST_TIMEOUT_TCP_MS = const(10000)  # Par etape (connexion TCP, upgrade websocket)
+
+# Metrique de la derniere course. resultats : [(url, latence_ms ou None si echec), ...]
+STATS_COURSE = {'gagnant': None, 'duree_ms': 0, 'tentatives': 0, 'echecs': 0, 'resultats': list()}
+
+
+async def course_tcp(candidats: list, echoues: list, nb_sockets_max, delai_echelon_ms, timeout_tcp_ms):
+    """
+    Course des connexions TCP (non-bloquantes). Le relai suivant demarre apres delai_echelon_ms ou des
+    l'echec d'une tentative, sans depasser nb_sockets_max sockets ouverts. Les perdants sont annules
+    et leurs sockets fermes. Les urls en echec sont ajoutes a echoues.
+
+    @return (url, uri, socket, debut de la tentative en ticks_ms) du premier relai connecte
+    @raises Derniere erreur recue si tous les candidats echouent
+    """
+    etat = {'gagnant': None, 'actifs': 0, 'erreur': None}
+    evenement = asyncio.Event()
+    taches = list()
+    resultats = STATS_COURSE['resultats']
+
+    async def tentative(url):
+        debut_tentative = time.ticks_ms()
+        try:
+            uri = urlparse(url)
+            assert uri
+            sock = await asyncio.wait_for_ms(connect_tcp(uri), timeout_tcp_ms)
+            if etat['gagnant'] is not None:
+                sock.close()  # Course deja gagnee
+                return
+            etat['gagnant'] = (url, uri, sock, debut_tentative)
+        except asyncio.CancelledError:
+            pass
+        except asyncio.TimeoutError:
+            print("course_relais timeout %s" % url)
+            resultats.append((url, None))
+            echoues.append(url)
+            STATS_COURSE['echecs'] += 1
+            etat['erreur'] = OSError(110)  # ETIMEDOUT
+        except Exception as e:
+            print("course_relais echec %s : %s" % (url, e))
+            resultats.append((url, None))
+            echoues.append(url)
+            STATS_COURSE['echecs'] += 1
+            etat['erreur'] = e
+        finally:
+            etat['actifs'] -= 1
+            evenement.set()
+
+    try:
+        prochain = 0
+        while etat['gagnant'] is None:
+            delai = timeout_tcp_ms
+            if prochain < len(candidats) and etat['actifs'] < nb_sockets_max:
+                etat['actifs'] += 1
+                STATS_COURSE['tentatives'] += 1
+                taches.append(asyncio.create_task(tentative(candidats[prochain])))
+                prochain += 1
+                delai = delai_echelon_ms
+            elif etat['actifs'] == 0:
+                break  # Tous les relais ont echoue
+
+            # Reveil sur succes/echec d'une tentative ou pour demarrer le relai suivant
+            evenement.clear()
+            try:
+                await asyncio.wait_for_ms(evenement.wait(), delai)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for tache in taches:
+            tache.cancel()
+        await asyncio.sleep_ms(1)  # Laisser les perdants fermer leurs sockets
+        collect()
+
+    if etat['gagnant'] is None:
+        if etat['erreur'] is not None:
+            raise etat['erreur']
+        raise OSError(103)  # ECONNABORTED, aucun relai
+
+    return etat['gagnant']
+
+
+async def course_relais(urls: list, compression=False, nb_relais=CONST_NB_RELAIS_COURSE,
+                        nb_sockets_max=CONST_NB_SOCKETS_MAX, delai_echelon_ms=CONST_DELAI_ECHELON_MS,
+                        timeout_tcp_ms=CONST_TIMEOUT_TCP_MS):
+    """
+    Connecte le websocket du premier relai disponible parmi les nb_relais premiers urls (ordre de preference).
+    Course TCP (voir course_tcp), puis TLS et upgrade websocket avec le gagnant seulement. Si le handshake
+    echoue, la course TCP reprend avec les relais restants.
+
+    @param urls: Urls websocket (wss://...), en ordre de preference
+    @return (url, websocket)
+    @raises Derniere erreur recue si tous les relais echouent
+    """
+    debut = time.ticks_ms()
+    STATS_COURSE['tentatives'] = 0
+    STATS_COURSE['echecs'] = 0
+    resultats = STATS_COURSE['resultats']
+    resultats.clear()
+
+    echoues = list()
+    gagnant = None
+    erreur = None
+    while gagnant is None:
+        candidats = [url for url in urls[:nb_relais] if url not in echoues]
+        if len(candidats) == 0:
+            break
+        try:
+            url, uri, sock, debut_tentative = await course_tcp(
+                candidats, echoues, nb_sockets_max, delai_echelon_ms, timeout_tcp_ms)
+        except Exception as e:
+            erreur = e
+            break
+
+        try:
+            # TLS (bloquant) et upgrade websocket, le socket est ferme sur erreur
+            try:
+                websocket = await asyncio.wait_for_ms(handshake(sock, uri, compression), timeout_tcp_ms)
+            except ErreurDeflate as e:
+                # Le relai fonctionne, seulement les parametres deflate ne conviennent pas : pas un echec
+                print("course_relais %s permessage-deflate refuse (%s), reessai sans compression" % (url, e))
+                sock = await asyncio.wait_for_ms(connect_tcp(uri), timeout_tcp_ms)
+                websocket = await asyncio.wait_for_ms(handshake(sock, uri, False), timeout_tcp_ms)
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = OSError(110)  # ETIMEDOUT
+            print("course_relais echec handshake %s : %s" % (url, e))
+            resultats.append((url, None))
+            echoues.append(url)
+            STATS_COURSE['echecs'] += 1
+            erreur = e
+            continue
+
+        resultats.append((url, time.ticks_diff(time.ticks_ms(), debut_tentative)))
+        gagnant = (url, websocket)
+
+    STATS_COURSE['duree_ms'] = time.ticks_diff(time.ticks_ms(), debut)
+
+    if gagnant is None:
+        STATS_COURSE['gagnant'] = None
+        if erreur is not None:
+            raise erreur
+        raise OSError(103)  # ECONNABORTED, aucun relai
+
+    STATS_COURSE['gagnant'] = gagnant[0]
+    print("course_relais gagnant %s en %d ms" % (gagnant[0], STATS_COURSE['duree_ms']))
+    return gagnant
@@ -0,0 +1,138 @@
+import time
+import uasyncio as asyncio
+
+# Priorites d'emission (plus petit = emis en premier)
+PRIORITE_REPONSE = const(0)  # Reponses/confirmations aux commandes du serveur
+PRIORITE_ETAT = const(1)  # Etat de l'appareil, fusionne avec l'etat en attente
+PRIORITE_REQUETE = const(2)  # Requetes de configuration
+
+CONST_NB_MESSAGES_MAX = const(6)
+CONST_OCTETS_MAX = const(16 * 1024)  # Copies des messages en attente (heap)
+
+# Metriques de la file
+STATS_EMISSION = {
+    'profondeur': 0, 'profondeur_max': 0, 'emis': 0, 'fusionnes': 0, 'attentes_place': 0,
+    'latence_max_ms': 0, 'latence_totale_ms': 0,
+}
+
+
+class FileEmission:
+    """
+    File d'emission bornee du websocket, videe par une seule tache d'ecriture.
+    Les messages sont copies a l'entree : le buffer partage (BUFFER_MESSAGE) est libre des le retour de emettre().
+    """
+
+    def __init__(self, websocket):
+        self.__websocket = websocket
+        self.__files = ([], [], [])  # Par priorite, entrees [ticks_ms entree, data, Event envoye ou None]
+        self.__nb_messages = 0
+        self.__octets = 0
+        self.__message_pret = asyncio.Event()
+        self.__place_libre = asyncio.Event()
+        self.__progres = asyncio.Event()  # Message ecrit, erreur ou arret (voir attendre_envoi)
+        self.__tache = None
+        self.__erreur = None
+
+    def demarrer(self):
+        self.__tache = asyncio.create_task(self.__ecrire())
+
+    def arreter(self):
+        if self.__tache is not None:
+            self.__tache.cancel()
+            self.__tache = None
+        for file in self.__files:
+            file.clear()
+        self.__nb_messages = 0
+        self.__octets = 0
+        STATS_EMISSION['profondeur'] = 0
+        self.__place_libre.set()  # Debloquer les producteurs en attente
+        self.__progres.set()
+
+    def verifier(self):
+        """ Leve l'erreur d'ecriture du websocket (recue par la tache d'ecriture). """
+        if self.__erreur is not None:
+            raise self.__erreur
+        if self.__tache is None:
+            raise OSError(-104)  # File arretee (connexion fermee)
+
+    async def emettre(self, data, priorite=PRIORITE_REQUETE, envoye=None):
+        """
+        Ajoute un message a la file. Attend de la place si la file est pleine (backpressure).
+        Un etat remplace l'etat pas encore emis.
+        @param envoye: Event optionnel, set apres l'ecriture complete de la frame (voir attendre_envoi)
+        """
+        self.verifier()
+        data = bytearray(data)  # Copie avant tout await (buffer partage), masquee en place par envoyer
+        taille = len(data)
+
+        file = self.__files[priorite]
+        if priorite == PRIORITE_ETAT and len(file) > 0:
+            entree = file[-1]
+            self.__octets += taille - len(entree[1])
+            entree[1] = data  # L'heure d'entree est conservee (latence de l'etat le plus ancien)
+            STATS_EMISSION['fusionnes'] += 1
+            return
+
+        while self.__nb_messages >= CONST_NB_MESSAGES_MAX or \
+                (self.__nb_messages > 0 and self.__octets + taille > CONST_OCTETS_MAX):
+            STATS_EMISSION['attentes_place'] += 1
+            self.__place_libre.clear()
+            await self.__place_libre.wait()
+            self.verifier()
+
+        file.append([time.ticks_ms(), data, envoye])
+        self.__nb_messages += 1
+        self.__octets += taille
+        STATS_EMISSION['profondeur'] = self.__nb_messages
+        STATS_EMISSION['profondeur_max'] = max(STATS_EMISSION['profondeur_max'], self.__nb_messages)
+        self.__message_pret.set()
+
+    async def attendre_envoi(self, envoye):
+        """
+        Attend l'ecriture sur le socket du message emis avec envoye.
+        @raises Erreur d'ecriture du websocket ou OSError(-104) si la file est arretee avant l'envoi
+        """
+        while not envoye.is_set():
+            self.verifier()
+            self.__progres.clear()
+            await self.__progres.wait()
+
+    def __retirer(self):
+        for file in self.__files:
+            if len(file) > 0:
+                entree = file.pop(0)
+                self.__nb_messages -= 1
+                self.__octets -= len(entree[1])
+                STATS_EMISSION['profondeur'] = self.__nb_messages
+                return entree
+        return None
+
+    async def __ecrire(self):
+        websocket = self.__websocket
+        try:
+            while True:
+                entree = self.__retirer()
+                if entree is None:
+                    self.__message_pret.clear()
+                    await self.__message_pret.wait()
+                    continue
+
+                self.__place_libre.set()
+                # Frame complete (ecritures partielles reprises). Le verrou d'ecriture du websocket
+                # serialise cette frame avec les frames de controle (PONG de recv, CLOSE).
+                await websocket.envoyer(memoryview(entree[1]))
+
+                if entree[2] is not None:
+                    entree[2].set()
+                self.__progres.set()
+
+                latence = time.ticks_diff(time.ticks_ms(), entree[0])
+                STATS_EMISSION['emis'] += 1
+                STATS_EMISSION['latence_totale_ms'] += latence
+                STATS_EMISSION['latence_max_ms'] = max(STATS_EMISSION['latence_max_ms'], latence)
+                entree = None
+        except Exception as e:
+            print("FileEmission erreur ecriture : %s" % e)
+            self.__erreur = e
+            self.__place_libre.set()
+            self.__progres.set()
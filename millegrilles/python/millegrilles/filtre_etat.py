@@ -0,0 +1,106 @@
+import time
+
+# Emission de l'etat seulement sur changement significatif (deadband par type de lecture)
+# ou battement (silence max). Configurable par la section "emission" de devices.json.
+CONST_SILENCE_MAX_S = const(300)  # Battement : etat emis au moins une fois par periode (borne par http_timeout)
+CONST_INTERVALLE_MIN_S = const(5)  # Limite de frequence d'emission
+
+# Deadbands par type de lecture, dans l'unite du senseur. Type absent : tout changement est emis.
+DEADBANDS_DEFAUT = {'temperature': 0.2, 'humidite': 1.0, 'pression': 0.5, 'pression_tendance': 0.2}
+
+# Metriques d'emission de l'etat (messages et bytes vers le relai)
+STATS_ETAT = {'emis': 0, 'octets': 0, 'changements': 0, 'battements': 0, 'ignores': 0, 'debut': time.time()}
+
+
+class FiltreEtat:
+
+    def __init__(self):
+        self.__deadbands = DEADBANDS_DEFAUT
+        self.__silence_max_ms = CONST_SILENCE_MAX_S * 1000
+        self.__timeout_http_ms = None  # http_timeout annonce dans l'etat, borne le silence
+        self.__intervalle_min_ms = CONST_INTERVALLE_MIN_S * 1000
+        self.__valeurs_emises = dict()  # {senseur_id: valeur emise}
+        self.__derniere_emission = None  # ticks_ms, None : etat complet du (connexion)
+
+    def configurer(self, params):
+        """
+        params : section "emission" de devices.json
+            {"deadbands": {"temperature": 0.2, ...}, "silence_max_s": 300, "intervalle_min_s": 5}
+        """
+        if params is None:
+            return
+        try:
+            deadbands = dict(DEADBANDS_DEFAUT)
+            deadbands.update(params['deadbands'])
+            self.__deadbands = deadbands
+        except KeyError:
+            pass
+        self.__silence_max_ms = params.get('silence_max_s', CONST_SILENCE_MAX_S) * 1000
+        self.__intervalle_min_ms = params.get('intervalle_min_s', CONST_INTERVALLE_MIN_S) * 1000
+        print("Emission etat : deadbands %s, silence max %d ms, intervalle min %d ms" % (
+            self.__deadbands, self.__silence_max_ms, self.__intervalle_min_ms))
+
+    def set_timeout_http(self, timeout_http: int):
+        """
+        L'etat annonce http_timeout au relai : un appareil silencieux plus longtemps est considere deconnecte.
+        Le battement est emis au plus tard a http_timeout, silence_max_s peut seulement le raccourcir.
+        """
+        self.__timeout_http_ms = timeout_http * 1000
+
+    def __get_silence_max_ms(self) -> int:
+        if self.__timeout_http_ms is None:
+            return self.__silence_max_ms
+        return min(self.__silence_max_ms, self.__timeout_http_ms)
+
+    def reset(self):
+        """ Nouvelle connexion : le prochain etat est emis au complet. """
+        self.__derniere_emission = None
+
+    def changement(self, lectures: dict) -> bool:
+        """ True si une lecture a change au-dela de la deadband de son type (ou nouveau senseur). """
+        if self.__comparer(lectures) is True:
+            STATS_ETAT['changements'] += 1
+            return True
+        STATS_ETAT['ignores'] += 1
+        return False
+
+    def __comparer(self, lectures: dict) -> bool:
+        valeurs_emises = self.__valeurs_emises
+        for senseur_id, lecture in lectures.items():
+            valeur = lecture.get('valeur', lecture.get('valeur_str'))
+            try:
+                precedente = valeurs_emises[senseur_id]
+            except KeyError:
+                return True  # Nouveau senseur
+            if valeur == precedente:
+                continue
+            if isinstance(valeur, (int, float)) and isinstance(precedente, (int, float)):
+                if abs(valeur - precedente) >= self.__deadbands.get(lecture.get('type'), 0):
+                    return True
+            else:
+                return True  # Texte, apparition/disparition de valeur
+        return False
+
+    def ms_avant_battement(self) -> int:
+        if self.__derniere_emission is None:
+            return 0
+        return max(0, self.__get_silence_max_ms() - time.ticks_diff(time.ticks_ms(), self.__derniere_emission))
+
+    def ms_avant_intervalle(self) -> int:
+        """ Delai avant la prochaine emission permise (limite de frequence). """
+        if self.__derniere_emission is None:
+            return 0
+        return max(0, self.__intervalle_min_ms - time.ticks_diff(time.ticks_ms(), self.__derniere_emission))
+
+    def marquer_emis(self, lectures: dict, taille: int):
+        battement = self.ms_avant_battement() == 0
+        valeurs_emises = self.__valeurs_emises
+        valeurs_emises.clear()
+        for senseur_id, lecture in lectures.items():
+            valeurs_emises[senseur_id] = lecture.get('valeur', lecture.get('valeur_str'))
+        self.__derniere_emission = time.ticks_ms()
+
+        STATS_ETAT['emis'] += 1
+        STATS_ETAT['octets'] += taille
+        if battement:
+            STATS_ETAT['battements'] += 1
@@ -9,15 +9,20 @@ from millegrilles.config import set_configuration_display, update_configuration_
 
 from millegrilles.certificat import get_userid_local
 from millegrilles.message_inscription import recevoir_certificat
-from millegrilles.mgmessages import formatter_message
+from millegrilles.mgmessages import formatter_message, ecrire_message
+from millegrilles.file_emission import PRIORITE_REPONSE
 
 
-async def traiter_commande(buffer, websocket, appareil, commande: dict, info_certificat: dict):
+def get_action(commande: dict) -> str:
     try:
         routage = commande['routage']
-        action = routage['action']
+        return routage['action']
     except (TypeError, KeyError):
-        action = commande['attachements']['action']  # Correlation a la reponse d'action de requete
+        return commande['attachements']['action']  # Correlation a la reponse d'action de requete
+
+
+async def traiter_commande(buffer, emetteur, appareil, commande: dict, info_certificat: dict):
+    action = get_action(commande)
     
     if action == 'challengeAppareil':
         await challenge_led_blink(appareil, commande)
@@ -58,11 +63,11 @@ async def traiter_commande(buffer, websocket, appareil, commande: dict, info_cer
     elif action == 'commandeAppareil':
         await recevoir_commande_appareil(appareil, commande, info_certificat)
     elif action == 'echangerSecret':
-        await recevoir_echanger_secret(buffer, websocket, appareil, commande, info_certificat)
+        await recevoir_echanger_secret(buffer, emetteur, appareil, commande, info_certificat)
     elif action == 'resetSecret':
         await recevoir_reset_secret(appareil)
     elif action == 'majConfigurationAppareil':
-        await recevoir_maj_configuration_appareil(appareil, buffer, websocket, commande)
+        await recevoir_maj_configuration_appareil(appareil, buffer, emetteur, commande)
     else:
         raise ValueError('Action inconnue : %s' % action)
     
@@ -179,7 +184,7 @@ async def appareil_set_switch_value(appareil, senseur_id, value):
     appareil.trigger_stale_event()
 
 
-async def recevoir_echanger_secret(buffer, websocket, appareil, reponse, info_certificat):
+async def recevoir_echanger_secret(buffer, emetteur, appareil, reponse, info_certificat):
     print("recevoir_echanger_secret Info certificat : %s" % info_certificat)
     print("recevoir_echanger_secret reponse : %s" % reponse)
 
@@ -187,7 +192,7 @@ async def recevoir_echanger_secret(buffer, websocket, appareil, reponse, info_ce
     fingerprint = info_certificat['fingerprint']
 
     chiffrage_messages = appareil.chiffrage_messages
-    chiffrage_messages.calculer_secret_exchange(contenu['peer'])
+    await chiffrage_messages.calculer_secret_exchange(contenu['peer'])
 
     # Emettre un message de confirmation - sert de permission pour relayer l'etat non signe de l'appareil
     conf = {'fingerprint': fingerprint}
@@ -195,12 +200,11 @@ async def recevoir_echanger_secret(buffer, websocket, appareil, reponse, info_ce
         conf, kind=2, action='confirmerRelai', domaine='SenseursPassifs',
         buffer=buffer, ajouter_certificat=True)
 
-    buffer.clear()
-    json.dump(message_inscription, buffer)
+    ecrire_message(message_inscription, buffer)
     message_inscription = None
     await asyncio.sleep_ms(1)  # Yield
 
-    websocket.send(buffer.get_data())
+    await emetteur.emettre(buffer.get_data(), PRIORITE_REPONSE)
 
 
 async def recevoir_reset_secret(appareil):
@@ -209,7 +213,7 @@ async def recevoir_reset_secret(appareil):
     chiffrage_messages.clear()
 
 
-async def recevoir_maj_configuration_appareil(appareil, buffer, websocket, commande):
+async def recevoir_maj_configuration_appareil(appareil, buffer, emetteur, commande):
     try:
         reponse = json.loads(commande['contenu'])
         print("maj appareil event %s" % reponse)
@@ -231,10 +235,7 @@ async def recevoir_maj_configuration_appareil(appareil, buffer, websocket, comma
 
     # Chiffrer le message
     requete = {'timezone': timezone}
-    requete = await chiffrage_messages.chiffrer(requete)
-    requete['routage'] = {'action': 'getTimezoneInfo'}
-
-    buffer.set_text(json.dumps(requete))
+    await chiffrage_messages.ecrire_chiffre(requete, buffer, routage={'action': 'getTimezoneInfo'})
 
     # Emettre requete
-    websocket.send(buffer.get_data())
+    await emetteur.emettre(buffer.get_data())
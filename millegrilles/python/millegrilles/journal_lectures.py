@@ -0,0 +1,216 @@
+from json import load, dump
+from struct import pack, pack_into, unpack_from
+
+from millegrilles.constantes import CONST_PATH_JOURNAL_LECTURES, CONST_PATH_JOURNAL_SENSEURS, \
+    CONST_READ_BINARY, CONST_WRITE_BINARY
+
+# Journal des lectures prises hors ligne (relai injoignable) : anneau d'enregistrements binaires sur flash.
+# Entete : tete (prochaine ecriture), nombre d'enregistrements. Enregistrement : timestamp, index senseur, valeur.
+CONST_FORMAT_ENTETE = const('<II')
+CONST_TAILLE_ENTETE = const(8)
+CONST_FORMAT_ENREGISTREMENT = const('<IBf')
+CONST_TAILLE_ENREGISTREMENT = const(9)
+
+CONST_NB_ENREGISTREMENTS_MAX = const(2048)  # 18 KB sur flash, les plus anciens sont ecrases
+CONST_NB_TAMPON = const(128)  # Enregistrements en RAM entre deux ecritures flash
+CONST_INTERVALLE_ECRITURE_S = const(600)  # Au plus une ecriture flash par intervalle (usure)
+CONST_PERIODE_ECHANTILLON_S = const(60)  # Au plus une lecture par senseur par periode
+CONST_NB_SENSEURS_MAX = const(255)
+
+STATS_JOURNAL = {'enregistrements': 0, 'ecritures_flash': 0, 'octets_ecrits': 0, 'perdus': 0, 'televerses': 0}
+
+
+class JournalLectures:
+    """
+    Journal store-and-forward des lectures numeriques. Les lectures sont accumulees en RAM puis
+    ajoutees a l'anneau sur flash au plus une fois par CONST_INTERVALLE_ECRITURE_S.
+    Les noms de senseurs sont dans un fichier json separe (index de 1 byte dans les enregistrements).
+    """
+
+    def __init__(self, chemin=CONST_PATH_JOURNAL_LECTURES, chemin_senseurs=CONST_PATH_JOURNAL_SENSEURS,
+                 capacite=CONST_NB_ENREGISTREMENTS_MAX):
+        self.__chemin = chemin
+        self.__chemin_senseurs = chemin_senseurs
+        self.__capacite = capacite
+
+        self.__senseurs = None  # [[senseur_id, type], ...], l'index est la position
+        self.__index_senseurs = None  # {senseur_id: index}
+        self.__derniere_lecture = dict()  # {index: timestamp}
+
+        self.__tampon = None
+        self.__nb_tampon = 0
+        self.__derniere_ecriture = None  # Timestamp (lectures) de la derniere ecriture flash
+
+        self.__tete = 0
+        self.__nombre = None  # None : entete pas encore chargee
+
+    @property
+    def nombre(self) -> int:
+        """ Enregistrements en attente de televersement (flash et RAM). """
+        self.__charger_entete()
+        return self.__nombre + self.__nb_tampon
+
+    def __charger_entete(self):
+        if self.__nombre is not None:
+            return
+        try:
+            with open(self.__chemin, CONST_READ_BINARY) as fichier:
+                self.__tete, self.__nombre = unpack_from(CONST_FORMAT_ENTETE, fichier.read(CONST_TAILLE_ENTETE))
+        except (OSError, ValueError):
+            self.__tete, self.__nombre = 0, 0
+
+    def __charger_senseurs(self) -> list:
+        if self.__senseurs is None:
+            try:
+                with open(self.__chemin_senseurs, CONST_READ_BINARY) as fichier:
+                    self.__senseurs = load(fichier)
+            except (OSError, ValueError):
+                self.__senseurs = list()
+            self.__index_senseurs = dict()
+            for index, senseur in enumerate(self.__senseurs):
+                self.__index_senseurs[senseur[0]] = index
+        return self.__senseurs
+
+    def __get_index_senseur(self, senseur_id: str, type_lecture):
+        senseurs = self.__charger_senseurs()
+        try:
+            return self.__index_senseurs[senseur_id]
+        except KeyError:
+            pass
+        if len(senseurs) >= CONST_NB_SENSEURS_MAX:
+            return None
+        # Nouveau senseur (rare) : sauvegarder la table
+        senseurs.append([senseur_id, type_lecture])
+        with open(self.__chemin_senseurs, CONST_WRITE_BINARY) as fichier:
+            dump(senseurs, fichier)
+        index = len(senseurs) - 1
+        self.__index_senseurs[senseur_id] = index
+        return index
+
+    def ajouter(self, lectures: dict):
+        """
+        Conserve les lectures numeriques (format DeviceHandler : {senseur_id: {valeur, type, timestamp}}).
+        """
+        ts_max = None
+        for senseur_id, lecture in lectures.items():
+            try:
+                valeur = lecture['valeur']
+                ts = lecture['timestamp']
+            except (KeyError, TypeError):
+                continue  # Lecture texte (valeur_str) ou incomplete
+            if not isinstance(valeur, (int, float)):
+                continue
+
+            index = self.__get_index_senseur(senseur_id, lecture.get('type'))
+            if index is None:
+                continue
+            if ts - self.__derniere_lecture.get(index, 0) < CONST_PERIODE_ECHANTILLON_S:
+                continue
+            self.__derniere_lecture[index] = ts
+
+            if self.__nb_tampon >= CONST_NB_TAMPON:
+                # Tampon plein avant l'intervalle d'ecriture : vider sur flash, perte seulement si echec
+                try:
+                    self.ecrire()
+                    self.__derniere_ecriture = ts
+                except OSError as e:
+                    print("Journal erreur ecriture flash : %s" % e)
+                    STATS_JOURNAL['perdus'] += 1
+                    continue
+            if self.__tampon is None:
+                self.__tampon = bytearray(CONST_NB_TAMPON * CONST_TAILLE_ENREGISTREMENT)
+            pack_into(CONST_FORMAT_ENREGISTREMENT, self.__tampon, self.__nb_tampon * CONST_TAILLE_ENREGISTREMENT,
+                      ts, index, valeur)
+            self.__nb_tampon += 1
+            STATS_JOURNAL['enregistrements'] += 1
+            ts_max = ts
+
+        if ts_max is None:
+            return
+        if self.__derniere_ecriture is None:
+            self.__derniere_ecriture = ts_max  # Debut de l'intervalle d'ecriture
+        elif ts_max - self.__derniere_ecriture >= CONST_INTERVALLE_ECRITURE_S:
+            self.ecrire()
+            self.__derniere_ecriture = ts_max
+
+    def ecrire(self):
+        """ Ajoute le tampon RAM a l'anneau sur flash. """
+        nb_tampon = self.__nb_tampon
+        if nb_tampon == 0:
+            return
+        self.__charger_entete()
+        capacite = self.__capacite
+        mv_tampon = memoryview(self.__tampon)
+
+        try:
+            fichier = open(self.__chemin, 'r+b')
+        except OSError:
+            fichier = open(self.__chemin, 'w+b')
+            fichier.write(bytes(CONST_TAILLE_ENTETE))
+
+        with fichier:
+            position = 0
+            while position < nb_tampon:
+                # Ecrire jusqu'a la fin de l'anneau, puis recommencer au debut
+                n = min(nb_tampon - position, capacite - self.__tete)
+                fichier.seek(CONST_TAILLE_ENTETE + self.__tete * CONST_TAILLE_ENREGISTREMENT)
+                fichier.write(mv_tampon[position * CONST_TAILLE_ENREGISTREMENT:(position + n) * CONST_TAILLE_ENREGISTREMENT])
+                position += n
+                self.__tete = (self.__tete + n) % capacite
+
+            nombre = self.__nombre + nb_tampon
+            if nombre > capacite:
+                STATS_JOURNAL['perdus'] += nombre - capacite  # Plus anciens ecrases
+                nombre = capacite
+            self.__nombre = nombre
+            fichier.seek(0)
+            fichier.write(pack(CONST_FORMAT_ENTETE, self.__tete, nombre))
+
+        STATS_JOURNAL['ecritures_flash'] += 1
+        STATS_JOURNAL['octets_ecrits'] += nb_tampon * CONST_TAILLE_ENREGISTREMENT + CONST_TAILLE_ENTETE
+        self.__nb_tampon = 0
+
+    def lire_lot(self, nb_max: int):
+        """
+        Lit les enregistrements les plus anciens sur flash (voir ecrire() pour le tampon RAM).
+        @return ({senseur_id: {'type': type, 'lectures': [[timestamp, valeur], ...]}}, nombre lu)
+        """
+        self.__charger_entete()
+        capacite = self.__capacite
+        nb_lot = min(nb_max, self.__nombre)
+        data = bytearray(nb_lot * CONST_TAILLE_ENREGISTREMENT)
+        mv_data = memoryview(data)
+
+        if nb_lot > 0:
+            debut = (self.__tete - self.__nombre) % capacite
+            with open(self.__chemin, CONST_READ_BINARY) as fichier:
+                lus = 0
+                while lus < nb_lot:
+                    index = (debut + lus) % capacite
+                    n = min(nb_lot - lus, capacite - index)
+                    fichier.seek(CONST_TAILLE_ENTETE + index * CONST_TAILLE_ENREGISTREMENT)
+                    fichier.readinto(mv_data[lus * CONST_TAILLE_ENREGISTREMENT:(lus + n) * CONST_TAILLE_ENREGISTREMENT])
+                    lus += n
+
+        senseurs = self.__charger_senseurs()
+        historique = dict()
+        for i in range(0, nb_lot):
+            ts, index, valeur = unpack_from(CONST_FORMAT_ENREGISTREMENT, data, i * CONST_TAILLE_ENREGISTREMENT)
+            senseur_id, type_lecture = senseurs[index]
+            try:
+                lectures_senseur = historique[senseur_id]['lectures']
+            except KeyError:
+                lectures_senseur = list()
+                historique[senseur_id] = {'type': type_lecture, 'lectures': lectures_senseur}
+            lectures_senseur.append([ts, round(valeur, 2)])
+
+        return historique, nb_lot
+
+    def retirer(self, nb_enregistrements: int):
+        """ Retire les enregistrements les plus anciens (televerses). """
+        self.__charger_entete()
+        self.__nombre = max(0, self.__nombre - nb_enregistrements)
+        with open(self.__chemin, 'r+b') as fichier:
+            fichier.write(pack(CONST_FORMAT_ENTETE, self.__tete, self.__nombre))
+        STATS_JOURNAL['octets_ecrits'] += CONST_TAILLE_ENTETE
+        STATS_JOURNAL['televerses'] += nb_enregistrements
@@ -1,7 +1,6 @@
 import json
 import os
 import time
-import urequests
 import sys
 
 from binascii import hexlify
@@ -15,13 +14,14 @@ from json import load, loads, dump, dumps
 from millegrilles import urequests2 as requests
 from millegrilles.certificat import valider_certificats, \
      generer_cle_secrete, charger_cle_privee, charger_cle_publique, \
-     get_expiration_certificat_local, generer_cle_secrete, sauvegarder_ca, \
+     get_expiration_certificat_local, generer_cle_secrete, sauvegarder_ca, invalider_identite_locale, \
      PATH_CERT, PATH_CLE_PRIVEE, PATHNAME_RENOUVELER
 from millegrilles.mgmessages import formatter_message, verifier_message
 from millegrilles.config import get_user_id, get_timezone, get_idmg, sauvegarder_relais, \
     set_timezone_offset, get_relais
 
 from millegrilles.webutils import parse_url
+from millegrilles.constantes import CONST_PATH_FICHE, CONST_PATH_FICHE_META, CONST_READ_BINARY, CONST_WRITE_BINARY
 
 
 # Generer le nom d'appareil avec le machine unique_id du RPi PICO
@@ -34,6 +34,12 @@ CONST_PATH_INSCRIPTION = '/inscrire'
 CONST_CSR_BEGIN = const('-----BEGIN CERTIFICATE REQUEST-----')
 CONST_CSR_END = const('-----END CERTIFICATE REQUEST-----')
 
+# Metriques du cache de la fiche (GET conditionnel, verification evitee si l'id est inchange)
+STATS_FICHE = {
+    'telechargements': 0, 'non_modifiees': 0, 'octets_recus': 0, 'octets_economises': 0,
+    'verifications': 0, 'verifications_evitees': 0, 'verification_ms': 0, 'cpu_economise_ms': 0,
+}
+
 
 async def generer_message_inscription(buffer, action='inscrire', domaine=None):
     # Generer message d'inscription
@@ -101,7 +107,7 @@ async def post_inscription(url, buffer):
             raise Exception('err http:%d' % status_code)
         
         # Valider la reponse
-        await reponse.read_text_into(buffer)
+        await reponse.lire_into(buffer)
         return status_code, buffer
     finally:
         reponse.close()
@@ -172,6 +178,7 @@ async def recevoir_certificat(certificat):
     
     rename(PATH_CLE_PRIVEE + '.new', PATH_CLE_PRIVEE)
     rename(PATH_CERT + '.new', PATH_CERT)
+    invalider_identite_locale()
     print("Nouveau certificat installe")
     
     return True
@@ -278,7 +285,7 @@ async def verifier_renouveler_certificat(url_relai: str, buffer):
     try:
         status_code = reponse.status_code
         print("Reponse renouveler certificat %s" % status_code)
-        await reponse.read_text_into(buffer)
+        await reponse.lire_into(buffer)
     finally:
         reponse.close()
         reponse = None
@@ -308,7 +315,7 @@ async def verifier_renouveler_certificat(url_relai: str, buffer):
             await recevoir_certificat(certificat)
 
 
-async def verifier_renouveler_certificat_ws(websocket, buffer):
+async def verifier_renouveler_certificat_ws(emetteur, buffer):
     date_expiration, _ = get_expiration_certificat_local()
     print("Date expiration certificat local : %s" % date_expiration)
     if time.time() > (date_expiration - CONST_RENOUVELLEMENT_DELAI):
@@ -324,7 +331,7 @@ async def verifier_renouveler_certificat_ws(websocket, buffer):
     collect()
     sleep_ms(1)  # Yield
 
-    websocket.send(buffer.get_data())
+    await emetteur.emettre(buffer.get_data())
 
     # Reponse recue via websocket_messages
 
@@ -357,6 +364,42 @@ async def recuperer_ca(buffer=None):
     sauvegarder_relais(fiche)
 
 
+def charger_meta_fiche():
+    try:
+        with open(CONST_PATH_FICHE_META, CONST_READ_BINARY) as fichier:
+            return load(fichier)
+    except (OSError, ValueError):
+        return None
+
+
+def sauvegarder_meta_fiche(meta: dict):
+    with open(CONST_PATH_FICHE_META, CONST_WRITE_BINARY) as fichier:
+        dump(meta, fichier)
+
+
+def get_entete(headers, nom: str):
+    """ Entete http (nom en minuscules), insensible a la casse. """
+    if headers is not None:
+        for cle, valeur in headers.items():
+            if cle.lower() == nom:
+                return valeur
+    return None
+
+
+def charger_fiche_cache(buffer) -> bool:
+    """ Copie la fiche conservee sur flash dans le buffer. """
+    try:
+        with open(CONST_PATH_FICHE, CONST_READ_BINARY) as fichier:
+            taille = fichier.readinto(buffer.buffer)
+            if fichier.read(1):
+                raise ValueError('overflow')
+        buffer.set_len(taille)
+        return True
+    except (OSError, ValueError) as e:
+        print("Fiche cache non disponible : %s" % e)
+        return False
+
+
 async def charger_fiche(no_validation=False, buffer=None):
     liste_urls = set()
     relais = get_relais()
@@ -367,54 +410,77 @@ async def charger_fiche(no_validation=False, buffer=None):
         proto = 'http:'
         liste_urls.add(proto + '//' + host)
 
+    # GET conditionnel : la fiche conservee sur flash est reutilisee si le serveur repond 304
+    meta = charger_meta_fiche() or dict()
+
     recu_ok = False
     for url_instance in liste_urls:
         fiche_url = url_instance + '/fiche.json'
         print("charger_fiche url %s" % fiche_url)
 
+        headers = dict()
+        if meta.get('url') == fiche_url:
+            if meta.get('etag') is not None:
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified') is not None:
+                headers['If-Modified-Since'] = meta['last_modified']
+
         # Downloader la fiche
         # print("Recuperer fiche a %s" % fiche_url)
         await sleep_ms(1)  # Yield
-        fiche_json = None
-        try:
-            # reponse = await requests.get(fiche_url, lock=ui_lock)
-            reponse = urequests.get(fiche_url)
-        except OSError as e:
-            if e.errno in (103, 104, -2):
-                # ECONNABORTED ou connexion refusee/serveur introuvable, essayer prochain relai
-                print("errno %s connexion %s" % (e.errno, fiche_url))
-                continue
-            else:
-                raise e
-            
+        reponse = None
         try:
-            await sleep_ms(1)  # Yield
+            reponse = await requests.get(fiche_url, headers=headers)
+            if reponse.status_code == 304:
+                if charger_fiche_cache(buffer) is False:
+                    meta = dict()  # Cache invalide, telecharger a nouveau
+                    continue
+                STATS_FICHE['non_modifiees'] += 1
+                STATS_FICHE['octets_economises'] += len(buffer)
+                recu_ok = True
+                break  # Ok, fiche inchangee
             if reponse.status_code != 200:
                 # raise Exception("fiche http status:%d" % reponse.status_code)
                 print("Erreur fiche %s status = %s" % (fiche_url, reponse.status_code))
                 continue
-            
-            # await reponse.read_text_into(buffer)
-            buffer.set_bytes(reponse.content)
-            reponse = None
+
+            # Corps (chunked ou non) lu directement dans le buffer, borne par sa taille
+            entetes = reponse.headers
+            await reponse.lire_into(buffer)
+            STATS_FICHE['telechargements'] += 1
+            STATS_FICHE['octets_recus'] += len(buffer)
+
+            # Conserver la fiche sur flash pour les prochains GET conditionnels
+            with open(CONST_PATH_FICHE, CONST_WRITE_BINARY) as fichier:
+                fichier.write(buffer.get_data())
+            meta = {
+                'url': fiche_url,
+                'etag': get_entete(entetes, 'etag'),
+                'last_modified': get_entete(entetes, 'last-modified'),
+                # Fiche verifiee precedemment, comparee apres reception
+                'id': meta.get('id'),
+                'empreinte': meta.get('empreinte'),
+                'verification_ms': meta.get('verification_ms'),
+            }
+            sauvegarder_meta_fiche(meta)
+            entetes = None
             recu_ok = True
             break  # Ok
-        except AttributeError:
-            # Verifier si on a eu un redirect sur https (generateur)
-            try:
-                reponse.__next__()
-                print('Erreur fiche https')
-            except Exception:
-                print('Erreur chargement fiche (1)')
+        except OSError as e:
+            if e.errno in (103, 104, 110, -2):
+                # ECONNABORTED, connexion refusee/serveur introuvable ou timeout, essayer prochain relai
+                print("errno %s connexion %s" % (e.errno, fiche_url))
                 continue
+            else:
+                raise e
         except Exception as e:
-            print('Erreur chargement fiche (2)')
+            print('Erreur chargement fiche')
             print_exception(e)
             continue
         finally:
-            # print("charger_fiche fermer reponse")
-            # reponse.close()
-            # reponse = None
+            if reponse is not None:
+                reponse.close()
+                reponse = None
 
             # Cleanup memoire
             collect()
@@ -423,6 +489,8 @@ async def charger_fiche(no_validation=False, buffer=None):
     if recu_ok is True:
         # collect()
         # await sleep_ms(1)  # Yield
+        from oryx_crypto import blake2s
+        empreinte = hexlify(blake2s(buffer.get_data())).decode('utf-8')
         try:
             message_fiche = loads(buffer.get_data())
         except Exception as e:
@@ -434,9 +502,22 @@ async def charger_fiche(no_validation=False, buffer=None):
         print("Fiche recue id %s" % message_fiche['id'])
         certificat = message_fiche.get('certificat')
         if no_validation is False:
-            info_cert = await verifier_message(message_fiche, buffer=buffer)
-            if 'core' not in info_cert['roles']:
-                raise Exception('Fiche a un mauvais certificat')
+            if message_fiche['id'] == meta.get('id') and empreinte == meta.get('empreinte'):
+                # Fiche identique (bytes) a la fiche deja verifiee
+                print("Fiche id inchange, verification evitee")
+                STATS_FICHE['verifications_evitees'] += 1
+                STATS_FICHE['cpu_economise_ms'] += meta.get('verification_ms') or 0
+            else:
+                debut_verification = time.ticks_ms()
+                info_cert = await verifier_message(message_fiche, buffer=buffer)
+                if 'core' not in info_cert['roles']:
+                    raise Exception('Fiche a un mauvais certificat')
+                STATS_FICHE['verifications'] += 1
+                STATS_FICHE['verification_ms'] = time.ticks_diff(time.ticks_ms(), debut_verification)
+                meta['id'] = message_fiche['id']
+                meta['empreinte'] = empreinte
+                meta['verification_ms'] = STATS_FICHE['verification_ms']
+                sauvegarder_meta_fiche(meta)
             certificat = None  # Certificat valide, cleanup
         
         # Transferer contenu dans le buffer pour faire parsing du json
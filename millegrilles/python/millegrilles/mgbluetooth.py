@@ -13,6 +13,7 @@ from millegrilles.message_inscription import NOM_APPAREIL
 from millegrilles.wifi import pack_info_wifi
 from millegrilles import constantes
 from millegrilles.config import get_nom_appareil, get_user_id, get_idmg
+from millegrilles.config_store import CONFIG_STORE
 from millegrilles.mgmessages import BufferMessage, verifier_message
 from millegrilles.chiffrage import ChiffrageMessages
 from millegrilles.certificat import remove_certificate, remove_ca
@@ -414,8 +415,7 @@ class BluetoothHandler:
 
         # with open(constantes.CONST_PATH_USER_NEW, 'wb') as fichier:
         # TODO : ajouter securite pour changement d'usager
-        with open(constantes.CONST_PATH_USER, 'wb') as fichier:
-            json.dump(existant, fichier)
+        CONFIG_STORE.ecrire(constantes.CONST_PATH_USER, existant)
 
         print('user change pour %s' % existant)
 
@@ -500,7 +500,7 @@ class BluetoothHandler:
 
         # Calculer le secret partage
         await asyncio.sleep(0)  # Yield
-        self.__chiffrage_handler.calculer_secret_exchange(cle_publique, charger_info_app=False)
+        await self.__chiffrage_handler.calculer_secret_exchange(cle_publique, charger_info_app=False)
         await asyncio.sleep(0)  # Yield
         # Placer le fingerprint du peer authentifie. Va indiquer qu'on a accepte l'echange.
         self.__command_auth_characteristic.write(pubkey_auth, send_update=True)
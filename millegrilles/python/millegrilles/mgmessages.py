@@ -6,62 +6,96 @@ import time
 import uasyncio as asyncio
 import oryx_crypto
 
-from io import IOBase
+from io import IOBase, BytesIO
 
 from . import certificat
+from .aleatoire import DRBG
+from .mgthreads import executer_crypto
 # -- DEV --
 #from millegrilles import certificat
 # -- DEV --
 
-from collections import OrderedDict
-
 
 VERSION_SIGNATURE = 2
 
-
-def prep_message_1(message, conserver_entete=True):
-    message_prep = OrderedDict([])
-
-    # Re-inserer toutes les key/values en ordre
-    # Filtrer/transformer les valeurs au besoin
-    for (key, value) in sorted(message.items(), key=lambda ele: ele[0]):
-        if key.startswith('_'):
-            continue
-        
-        if key == 'en-tete' and conserver_entete is False:
-            continue
-        
-        message_prep[key] = __traiter_value(value)
-    
-    return message_prep
-
-
-def __traiter_value(value):
-    if isinstance(value, float):
-        # Retirer le .0 (convertir en int) si applicable
-        if math.floor(value) == value:
-            value = int(value)
-    
-    elif isinstance(value, dict):
-        # Appel recursif
-        value = prep_message_1(value)
-    
-    elif isinstance(value, list):
-        for i, liste_value in enumerate(value):
-            value[i] = __traiter_value(liste_value)
-    
-    return value
+# Cache des contextes blake2s apres le prefixe '["<pubkey>",' (cle : pubkey)
+CONST_CACHE_PREFIXE_MAX_LEN = const(4)
+CONST_TAILLE_LECTURE_TEXTE = const(256)
+CACHE_PREFIXE_HACHAGE = dict()
+
+
+def ecrire_json_canonique(valeur, stream, conserver_entete=True):
+    """
+    Ecrit valeur en json canonique dans stream (e.g. BufferMessage, HacheurBlake2s) sans copie intermediaire.
+    Les cles des dicts sont triees, les cles '_' sont retirees et les float entiers sont convertis en int.
+    """
+    if isinstance(valeur, dict):
+        stream.write(b'{')
+        premier = True
+        for key in sorted(valeur):
+            if key.startswith('_'):
+                continue
+            if key == 'en-tete' and conserver_entete is False:
+                continue
+            if premier is False:
+                stream.write(b',')
+            premier = False
+            json.dump(key, stream)
+            stream.write(b':')
+            ecrire_json_canonique(valeur[key], stream)
+        stream.write(b'}')
+    elif isinstance(valeur, list):
+        stream.write(b'[')
+        for i in range(0, len(valeur)):
+            if i > 0:
+                stream.write(b',')
+            ecrire_json_canonique(valeur[i], stream)
+        stream.write(b']')
+    elif isinstance(valeur, float) and math.floor(valeur) == valeur:
+        # Retirer le .0 (convertir en int)
+        json.dump(int(valeur), stream)
+    else:
+        json.dump(valeur, stream, separators=(',', ':'))
 
 
 def message_stringify(message, buffer=None):
     if buffer is None:
-        return json.dumps(message, separators=(',', ':')).encode('utf-8')
+        stream = BytesIO()
+        ecrire_json_canonique(message, stream)
+        return stream.getvalue()
     else:
         buffer.clear()
-        json.dump(message, buffer, separators=(',', ':'))
+        ecrire_json_canonique(message, buffer)
         return buffer.get_data()
 
 
+def ecrire_message(message: dict, buffer):
+    """
+    Ecrit le message json dans buffer. Si le message contient la chaine de certificats locale
+    (ajoutee par formatter_message), elle est copiee a partir du fragment json pre-serialise.
+    """
+    buffer.clear()
+    identite = certificat.IDENTITE_LOCALE
+    certificat_message = message.get('certificat')
+    if certificat_message is None or certificat_message is not identite.chaine_pem:
+        json.dump(message, buffer)
+        return buffer
+
+    del message['certificat']
+    try:
+        json.dump(message, buffer)
+        buffer.set_len(len(buffer) - 1)  # Retirer '}'
+        if len(message) > 0:
+            buffer.write(b',')
+        buffer.write(b'"certificat":')
+        buffer.write(identite.chaine_pem_json)
+        buffer.write(b'}')
+    finally:
+        message['certificat'] = certificat_message
+
+    return buffer
+
+
 async def verifier_message(message: dict, buffer=None, err_ca_ok=False):
     # Valider le certificat - raise Exception si erreur
     pubkey = message['pubkey']
@@ -83,7 +117,7 @@ async def verifier_message(message: dict, buffer=None, err_ca_ok=False):
     signature = message['sig']
     id_message = message['id']
     # Raise une exception si la signature est invalide
-    verifier_signature_2023_5(id_message, signature, pubkey)
+    await verifier_signature_2023_5(id_message, signature, pubkey)
     await asyncio.sleep_ms(1)
 
     # Hacher le message, comparer id
@@ -119,14 +153,44 @@ class UUID:
 
 def uuid4():
     """Generates a random UUID compliant to RFC 4122 pg.14"""
-    from millegrilles.certificat import rnd_bytes
-    
-    random = bytearray(rnd_bytes(16))
+    random = DRBG.fill(bytearray(16))
     random[6] = (random[6] & 0x0F) | 0x40
     random[8] = (random[8] & 0x3F) | 0x80
     return UUID(bytes=random)
 
 
+class HacheurBlake2s(IOBase):
+    """ Stream d'ecriture qui calcule un hachage blake2s-256 au fil de l'eau (e.g. avec json.dump). """
+
+    def __init__(self, contexte=None):
+        super().__init__()
+        if contexte is None:
+            contexte = oryx_crypto.blake2sinit()
+        self.__contexte = contexte
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = utf8_view(data)
+        oryx_crypto.blake2supdate(self.__contexte, data)
+        return len(data)
+
+    def copy(self):
+        return HacheurBlake2s(oryx_crypto.blake2scopy(self.__contexte))
+
+    def digest(self) -> bytes:
+        return oryx_crypto.blake2sfinal(self.__contexte)
+
+
+def utf8_view(data: str):
+    """ Retourne le contenu utf-8 d'un str pour copie directe dans un buffer. """
+    try:
+        # MicroPython conserve les str en utf-8 et expose le buffer protocol : aucune copie
+        return memoryview(data)
+    except TypeError:
+        # CPython (tests sur host) : encodage en un seul bloc
+        return data.encode('utf-8')
+
+
 # Buffer pour recevoir l'etat
 class BufferMessage(IOBase):
 
@@ -139,44 +203,15 @@ class BufferMessage(IOBase):
         return memoryview(self.__buffer)[:self.__len_courant]
 
     def set_text(self, data):
-        try:
-            if len(data) > len(self.__buffer):
-                raise ValueError('overflow')
-        except TypeError:
-            pass  # Pas de len sur data
-
-        pos = 0
-        for c in data:
-            cv = c.encode('utf-8')
-
-            if pos + len(cv) > len(self.__buffer):
-                raise ValueError('overflow')
-
-            self.__buffer[pos:pos+len(cv)] = cv
-            pos += len(cv)
-
-        self.__len_courant = pos
+        self.__len_courant = 0
+        self.write(data)
 
     def set_text_read(self, data):
-        try:
-            if len(data) > len(self.__buffer):
-                raise ValueError('overflow')
-        except TypeError:
-            pass  # Pas de len sur data
-
-        pos = 0
-        c = data.read(1)
-        while c != '':
-            cv = c.encode('utf-8')
-
-            if pos + len(cv) > len(self.__buffer):
-                raise ValueError('overflow')
-
-            self.__buffer[pos:pos+len(cv)] = cv
-            pos += len(cv)
-            c = data.read(1)
-
-        self.__len_courant = pos
+        self.__len_courant = 0
+        chunk = data.read(CONST_TAILLE_LECTURE_TEXTE)
+        while chunk:
+            self.write(chunk)
+            chunk = data.read(CONST_TAILLE_LECTURE_TEXTE)
 
     def set_bytes(self, data):
         if len(data) > len(self.__buffer):
@@ -193,20 +228,32 @@ class BufferMessage(IOBase):
         self.__len_courant = 0
         # self.__buffer.clear()
 
+    def ecrire_base64(self, data):
+        """ Encode data en base64 directement a la fin du buffer (aucune chaine intermediaire). """
+        taille = oryx_crypto.base64encode(data, memoryview(self.__buffer)[self.__len_courant:])
+        self.__len_courant += taille
+        return taille
+
+    def set_base64(self, data):
+        """ Decode data (base64) dans le buffer. @return memoryview du contenu decode """
+        self.__len_courant = oryx_crypto.base64decode(data, self.__buffer)
+        return self.get_data()
+
     def write(self, data):
-        if len(data) + self.__len_courant > len(self.__buffer):
-            raise Exception('ouverflow')
-
-        if isinstance(data, bytes) or isinstance(data, bytearray):
-            self.__buffer[self.__len_courant:self.__len_courant+len(data)] = data
-            self.__len_courant += len(data)
-        elif isinstance(data, str):
-            for c in data:
-                cb = c.encode('utf-8')
-                self.write(cb)
-        else:
+        if isinstance(data, str):
+            data = utf8_view(data)
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
             raise ValueError("non supporte %s" % data)
 
+        taille = len(data)
+        if taille + self.__len_courant > len(self.__buffer):
+            raise ValueError('overflow')
+
+        # Copie en bloc dans le bytearray (aucun objet intermediaire par caractere)
+        self.__buffer[self.__len_courant:self.__len_courant+taille] = data
+        self.__len_courant += taille
+        return taille
+
     @property
     def buffer(self):
         return self.__buffer
@@ -228,22 +275,10 @@ class BufferMessage(IOBase):
 async def signer_message_2023_5(id_message: str, cle_privee=None):
     cle_publique = None
     if cle_privee is None:
-        # Charger la cle locale
-        try:
-            with open(certificat.PATH_CLE_PRIVEE, 'rb') as fichier:
-                cle_privee = fichier.read()
-            if len(cle_privee) == 64:
-                # Split cle privee/publique
-                cle_publique = cle_privee[32:]
-                cle_privee = cle_privee[:32]
-        except OSError:
-            print("Cle prive absente, utiliser .new")
-            with open(certificat.PATH_CLE_PRIVEE + '.new', 'rb') as fichier:
-                cle_privee = fichier.read()
-                if len(cle_privee) == 64:
-                    # Split cle privee/publique
-                    cle_publique = cle_privee[32:]
-                    cle_privee = cle_privee[:32]
+        # Identite locale en memoire (aucune lecture flash)
+        identite = certificat.IDENTITE_LOCALE
+        cle_privee = identite.cle_privee
+        cle_publique = identite.cle_publique
 
     ticks_debut = time.ticks_ms()
     if cle_publique is None:
@@ -256,7 +291,7 @@ async def signer_message_2023_5(id_message: str, cle_privee=None):
     hachage = binascii.unhexlify(id_message)
 
     ticks_debut = time.ticks_ms()
-    signature = oryx_crypto.ed25519sign(cle_privee, cle_publique, hachage)
+    signature = await executer_crypto(oryx_crypto.ed25519sign, cle_privee, cle_publique, hachage)
     print("__signer_message_2 ed25519sign duree %d" % time.ticks_diff(time.ticks_ms(), ticks_debut))
 
     await asyncio.sleep_ms(1)
@@ -266,49 +301,78 @@ async def signer_message_2023_5(id_message: str, cle_privee=None):
     return signature
 
 
-def verifier_signature_2023_5(id_message: str, signature: str, cle_publique: str):
+async def verifier_signature_2023_5(id_message: str, signature: str, cle_publique: str):
     """ Verifie la signature d'un message. Lance une exception en cas de signature invalide. """
     hachage = binascii.unhexlify(id_message)
     cle_publique = binascii.unhexlify(cle_publique)
     signature = binascii.unhexlify(signature)
     ticks_debut = time.ticks_ms()
-    oryx_crypto.ed25519verify(cle_publique, signature, hachage)
+    await executer_crypto(oryx_crypto.ed25519verify, cle_publique, signature, hachage)
     print("__verifier_signature ed25519verify duree %d" % time.ticks_diff(time.ticks_ms(), ticks_debut))
 
 
 async def hacher_message_2023_5(message: dict, buffer=None):
+    """ Calcule le id du message. Le json est hache au fil de l'ecriture, buffer n'est plus utilise. """
     ticks_debut = time.ticks_ms()
     await asyncio.sleep_ms(1)
-    message_array = preparer_array_hachage_2023_5(message)
-    await asyncio.sleep_ms(1)
 
-    hachage = oryx_crypto.blake2s(message_stringify(message_array, buffer=buffer))
+    # Le prefixe '["<pubkey>",' est deja hache dans le contexte en cache
+    hacheur = get_hacheur_prefixe_2023_5(message['pubkey'])
+    preparer_array_hachage_2023_5(message, hacheur, inclure_pubkey=False)
+
+    hachage = hacheur.digest()
     print("hacher_message stringify+blake2s duree %d" % time.ticks_diff(time.ticks_ms(), ticks_debut))
     await asyncio.sleep_ms(1)
 
     return binascii.hexlify(hachage).decode('utf-8')
 
 
-def preparer_array_hachage_2023_5(message) -> list:
+def get_hacheur_prefixe_2023_5(pubkey: str):
+    """ Retourne un hacheur qui contient deja le prefixe '["<pubkey>",' du message """
+    global CACHE_PREFIXE_HACHAGE
+
+    hacheur = CACHE_PREFIXE_HACHAGE.get(pubkey)
+    if hacheur is None:
+        if len(CACHE_PREFIXE_HACHAGE) >= CONST_CACHE_PREFIXE_MAX_LEN:
+            CACHE_PREFIXE_HACHAGE = dict()  # Reset, conserve uniquement les pubkeys recentes
+        hacheur = HacheurBlake2s()
+        hacheur.write(b'[')
+        json.dump(pubkey, hacheur)
+        hacheur.write(b',')
+        CACHE_PREFIXE_HACHAGE[pubkey] = hacheur
+
+    # Copie de l'etat, le contexte en cache n'est jamais finalise
+    return hacheur.copy()
+
+
+def preparer_array_hachage_2023_5(message, stream, inclure_pubkey=True):
+    """
+    Ecrit l'array a hacher [pubkey, estampille, kind, contenu, routage?, pre-migration?] dans stream.
+    Seul le routage est mis en format canonique, les autres valeurs sont ecrites telles quelles.
+    """
     kind = message['kind']
-    
-    message_array = [
-        message['pubkey'],
-        message['estampille'],
-        message['kind'],
-        message['contenu'],
-    ]
+    if kind > 7:
+        raise Exception('kind message non supporte %d' % kind)
+
+    if inclure_pubkey is True:
+        stream.write(b'[')
+        json.dump(message['pubkey'], stream)
+        stream.write(b',')
+
+    json.dump(message['estampille'], stream)
+    stream.write(b',')
+    json.dump(kind, stream)
+    stream.write(b',')
+    json.dump(message['contenu'], stream)
 
     if kind in [1, 2, 3, 5, 7]:
-        routage = prep_message_1(message['routage'])
-        message_array.append(routage)
+        stream.write(b',')
+        ecrire_json_canonique(message['routage'], stream)
     if kind in [7]:
-        message_array.append(message['pre-migration'])
-    
-    if kind > 7:
-        raise Error('kind message non supporte' % kind)
+        stream.write(b',')
+        json.dump(message['pre-migration'], stream, separators=(',', ':'))
 
-    return message_array
+    stream.write(b']')
 
 
 async def formatter_message(message: dict, kind: int, domaine=None, action=None, partition=None, cle_privee=None, buffer=None, ajouter_certificat=True):
@@ -318,11 +382,10 @@ async def formatter_message(message: dict, kind: int, domaine=None, action=None,
         # Calculer pubkey
         pubkey = binascii.hexlify(oryx_crypto.ed25519generatepubkey(cle_privee)).decode('utf-8')
     else:
-        pubkey = binascii.hexlify(certificat.charger_cle_publique()).decode('utf-8')
+        pubkey = certificat.IDENTITE_LOCALE.pubkey
 
-    # Serialiser le contenu en string
-    contenu = prep_message_1(message)
-    contenu = message_stringify(contenu).decode('utf-8')
+    # Serialiser le contenu en string (json canonique)
+    contenu = str(message_stringify(message, buffer), 'utf-8')
 
     enveloppe_message = {
         'pubkey': pubkey,
@@ -351,7 +414,7 @@ async def formatter_message(message: dict, kind: int, domaine=None, action=None,
     enveloppe_message['sig'] = signature
     
     if ajouter_certificat is True:
-        enveloppe_message['certificat'] = certificat.split_pem(certificat.get_certificat_local(), format_str=True)
+        enveloppe_message['certificat'] = certificat.IDENTITE_LOCALE.chaine_pem
 
     return enveloppe_message
 
@@ -1,10 +1,14 @@
 import time
 import uasyncio as asyncio
-import _thread
 
 from gc import collect
 from sys import print_exception
 
+try:
+    import _thread
+except ImportError:
+    _thread = None  # Port single core
+
 
 class TaskRunner:
     """ Run des functions sur le processeur alternatif. """
@@ -169,3 +173,118 @@ class ThreadExecutor():
         finally:
             print("__wrap_execution done!")
             self.__internal.set()  # Reset execution
+
+
+class CryptoExecutor:
+    """
+    Execute les operations crypto couteuses (ed25519, x509, x25519) sur core1
+    pour ne pas bloquer la boucle asyncio (display, bluetooth, boutons).
+    Un seul worker core1, demarre au premier appel et conserve (core1 reserve a la crypto).
+    Execution synchrone sur les ports sans _thread.
+    """
+
+    def __init__(self):
+        self.__lock = None  # asyncio.Lock, une operation a la fois
+        self.__fin = None  # ThreadSafeFlag, signale par core1 a la fin de l'operation
+        self.__demande_prete = None  # _thread lock, libere par core0 pour reveiller core1 (aucun polling)
+        self.__demande = None  # (ident, fonction, args) en attente pour core1
+        self.__reponse = None  # (ident, resultat, exception) de la derniere operation de core1
+        self.__ident = 0
+        self.actif = True  # Permet de desactiver le offloading (e.g. comparaison du lag asyncio)
+
+    def __worker(self):
+        """ Boucle core1 : bloque sur __demande_prete, execute les demandes une a la fois. """
+        while True:
+            self.__demande_prete.acquire()
+            ident, fonction, args = self.__demande
+            self.__demande = None
+            resultat, exception = None, None
+            try:
+                resultat = fonction(*args)
+            except Exception as e:
+                exception = e
+            self.__reponse = (ident, resultat, exception)
+            self.__fin.set()
+
+    async def run(self, fonction, *args):
+        if _thread is None or self.actif is False:
+            return fonction(*args)
+
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+            self.__fin = asyncio.ThreadSafeFlag()
+            self.__demande_prete = _thread.allocate_lock()
+            self.__demande_prete.acquire()  # Aucune demande, core1 bloque au demarrage
+            _thread.start_new_thread(self.__worker, ())
+
+        annulation = None
+        async with self.__lock:
+            self.__ident += 1
+            ident = self.__ident
+            self.__reponse = None
+            self.__fin.clear()
+            self.__demande = (ident, fonction, args)
+            self.__demande_prete.release()
+
+            # Conserver le lock jusqu'a la fin de l'operation sur core1, meme si l'appelant est annule :
+            # la demande suivante ne doit pas remplacer celle en cours ni recevoir sa reponse.
+            while True:
+                try:
+                    await self.__fin.wait()
+                except asyncio.CancelledError as e:
+                    annulation = e
+                    continue
+                reponse = self.__reponse
+                if reponse is not None and reponse[0] == ident:
+                    break
+            self.__reponse = None
+
+        if annulation is not None:
+            raise annulation
+        _, resultat, exception = reponse
+        if exception is not None:
+            raise exception
+        return resultat
+
+
+EXECUTEUR_CRYPTO = CryptoExecutor()
+
+
+async def executer_crypto(fonction, *args):
+    """ Execute une fonction oryx_crypto sur core1 si disponible. @return awaitable du resultat """
+    return await EXECUTEUR_CRYPTO.run(fonction, *args)
+
+
+class MesureLagAsyncio:
+    """ Mesure le retard de reveil de la boucle asyncio (lag) par rapport a un sleep_ms periodique. """
+
+    def __init__(self, intervalle_ms=10):
+        self.__intervalle_ms = intervalle_ms
+        self.__actif = False
+        self.lag_max = 0
+        self.lag_total = 0
+        self.nb_mesures = 0
+
+    @property
+    def lag_moyen(self):
+        if self.nb_mesures == 0:
+            return 0
+        return self.lag_total // self.nb_mesures
+
+    def reset(self):
+        self.lag_max = 0
+        self.lag_total = 0
+        self.nb_mesures = 0
+
+    def stop(self):
+        self.__actif = False
+
+    async def run(self):
+        self.__actif = True
+        while self.__actif:
+            debut = time.ticks_ms()
+            await asyncio.sleep_ms(self.__intervalle_ms)
+            lag = time.ticks_diff(time.ticks_ms(), debut) - self.__intervalle_ms
+            self.lag_max = max(self.lag_max, lag)
+            self.lag_total += lag
+            self.nb_mesures += 1
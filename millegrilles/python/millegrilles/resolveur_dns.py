@@ -0,0 +1,194 @@
+import time
+import usocket
+
+from struct import pack, unpack_from
+from uasyncio import wait_for_ms, TimeoutError
+
+from millegrilles.attente_socket import attendre_lecture
+from millegrilles.aleatoire import DRBG
+
+# Resolution DNS non-bloquante (requete UDP type A) avec cache borne qui respecte les TTL.
+# Partagee par le websocket (course_relais), urequests2 et NTP.
+CONST_PORT_DNS = const(53)
+CONST_TIMEOUT_DNS_MS = const(1500)  # Par essai
+CONST_NB_ESSAIS_DNS = const(2)
+CONST_NB_ENTREES_MAX = const(8)
+CONST_TTL_MIN_S = const(30)
+CONST_TTL_MAX_S = const(6 * 3600)
+CONST_TAILLE_REPONSE_MAX = const(512)  # DNS sur UDP sans EDNS
+
+CONST_TYPE_A = const(1)
+CONST_CLASSE_IN = const(1)
+
+# Cache : {hote: [expiration, adresse ip]}. Les entrees expirees sont conservees pour le repli.
+CACHE_DNS = dict()
+
+# Metriques. repli : derniere adresse connue utilisee (resolveur injoignable).
+STATS_DNS = {'requetes': 0, 'cache': 0, 'echecs': 0, 'repli': 0, 'bloquant': 0, 'duree_ms': 0}
+
+_serveur = None  # (ip, port), None : serveur DNS du wifi
+
+
+def set_serveur_dns(serveur):
+    """ serveur : (ip, port) du resolveur, None pour le serveur DNS du wifi (DHCP). """
+    global _serveur
+    _serveur = serveur
+
+
+def get_serveur_dns():
+    if _serveur is not None:
+        return _serveur
+    from network import WLAN, STA_IF
+    return WLAN(STA_IF).ifconfig()[3], CONST_PORT_DNS
+
+
+def est_adresse_ip(hote: str) -> bool:
+    parties = hote.split('.')
+    if len(parties) != 4:
+        return False
+    for partie in parties:
+        if not partie.isdigit():
+            return False
+    return True
+
+
+def construire_requete(hote: str, ident: int) -> bytes:
+    # Entete : id, flags (recursion desiree), 1 question
+    requete = bytearray(pack('>HHHHHH', ident, 0x0100, 1, 0, 0, 0))
+    for label in hote.split('.'):
+        requete.append(len(label))
+        requete.extend(label.encode('utf-8'))
+    requete.append(0)
+    requete.extend(pack('>HH', CONST_TYPE_A, CONST_CLASSE_IN))
+    return requete
+
+
+def sauter_nom(data, position: int) -> int:
+    """ @return Position apres le nom (labels ou pointeur de compression) """
+    while True:
+        longueur = data[position]
+        if longueur == 0:
+            return position + 1
+        if longueur & 0xC0 == 0xC0:
+            return position + 2  # Pointeur, fin du nom
+        position += longueur + 1
+
+
+def lire_reponse(data, ident: int):
+    """
+    @return (adresse ip, ttl) du premier enregistrement A
+    @raises OSError(-2) si le nom n'existe pas ou si la reponse n'a aucune adresse
+    @raises ValueError ou IndexError si la reponse est invalide ou tronquee
+    """
+    ident_reponse, flags, nb_questions, nb_reponses = unpack_from('>HHHH', data, 0)
+    if ident_reponse != ident or flags & 0x8000 == 0:
+        raise ValueError('reponse DNS invalide')
+    code = flags & 0x000F
+    if code == 3:
+        raise OSError(-2)  # NXDOMAIN
+    elif code != 0:
+        raise OSError(5)  # EIO, SERVFAIL ou refus du resolveur
+
+    position = 12
+    for _ in range(0, nb_questions):
+        position = sauter_nom(data, position) + 4
+    for _ in range(0, nb_reponses):
+        position = sauter_nom(data, position)
+        type_rr, classe, ttl, longueur = unpack_from('>HHIH', data, position)
+        position += 10
+        if position + longueur > len(data):
+            raise ValueError('reponse DNS tronquee')
+        if type_rr == CONST_TYPE_A and classe == CONST_CLASSE_IN and longueur == 4:
+            return '%d.%d.%d.%d' % tuple(data[position:position + 4]), ttl
+        position += longueur  # CNAME, ...
+
+    raise OSError(-2)
+
+
+def conserver_adresse(hote: str, adresse: str, ttl: int):
+    if hote not in CACHE_DNS and len(CACHE_DNS) >= CONST_NB_ENTREES_MAX:
+        # Retirer l'entree qui expire le plus tot
+        hote_retrait = min(CACHE_DNS, key=lambda h: CACHE_DNS[h][0])
+        del CACHE_DNS[hote_retrait]
+    ttl = min(max(ttl, CONST_TTL_MIN_S), CONST_TTL_MAX_S)
+    CACHE_DNS[hote] = [time.time() + ttl, adresse]
+
+
+def clear_cache():
+    CACHE_DNS.clear()
+
+
+async def requete_dns(hote: str, serveur, timeout_ms=CONST_TIMEOUT_DNS_MS):
+    """ Requete UDP sans bloquer la boucle uasyncio (reveil par poll du socket). @return (adresse ip, ttl) """
+    adresse_serveur = usocket.getaddrinfo(serveur[0], serveur[1])[0][-1]  # Adresse ip, aucune requete reseau
+    ident = DRBG.u32() & 0xFFFF  # Identifiant imprevisible (usurpation de reponse)
+    sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(construire_requete(hote, ident), adresse_serveur)
+        debut = time.ticks_ms()
+        while True:
+            restant = timeout_ms - time.ticks_diff(time.ticks_ms(), debut)
+            if restant <= 0:
+                raise OSError(110)  # ETIMEDOUT
+            try:
+                await wait_for_ms(attendre_lecture(sock), restant)
+            except TimeoutError:
+                raise OSError(110)
+            try:
+                data = sock.recv(CONST_TAILLE_REPONSE_MAX)
+            except OSError:
+                continue  # EAGAIN
+            try:
+                return lire_reponse(data, ident)
+            except (ValueError, IndexError):
+                continue  # Reponse a une autre requete ou invalide (tronquee), attendre la suivante
+    finally:
+        sock.close()
+
+
+async def resoudre(hote: str) -> str:
+    """
+    Resout hote en adresse ip (IPv4). Cache selon le TTL, derniere adresse connue si le resolveur est injoignable.
+    @raises OSError(-2) si le nom ne peut etre resolu
+    """
+    if est_adresse_ip(hote):
+        return hote
+
+    try:
+        expiration, adresse = CACHE_DNS[hote]
+        if expiration >= time.time():
+            STATS_DNS['cache'] += 1
+            return adresse
+    except KeyError:
+        adresse = None
+
+    STATS_DNS['requetes'] += 1
+    debut = time.ticks_ms()
+    erreur = None
+    for _ in range(0, CONST_NB_ESSAIS_DNS):
+        try:
+            adresse_recue, ttl = await requete_dns(hote, get_serveur_dns())
+            conserver_adresse(hote, adresse_recue, ttl)
+            STATS_DNS['duree_ms'] = time.ticks_diff(time.ticks_ms(), debut)
+            return adresse_recue
+        except OSError as e:
+            erreur = e
+            if e.errno == -2:
+                break  # Reponse negative, ne pas reessayer
+
+    STATS_DNS['echecs'] += 1
+    if erreur.errno == -2:
+        raise erreur  # Nom inexistant
+
+    if adresse is not None:
+        print("DNS %s injoignable (%s), derniere adresse connue %s" % (hote, erreur, adresse))
+        STATS_DNS['repli'] += 1
+        return adresse
+
+    # Aucune adresse connue : resolution du firmware (bloquante)
+    print("DNS %s injoignable (%s), getaddrinfo bloquant" % (hote, erreur))
+    STATS_DNS['bloquant'] += 1
+    adresse = usocket.getaddrinfo(hote, CONST_PORT_DNS)[0][-1][0]
+    conserver_adresse(hote, adresse, CONST_TTL_MIN_S)
+    return adresse
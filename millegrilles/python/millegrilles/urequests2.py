@@ -1,35 +1,278 @@
+import time
 import usocket
-from uasyncio import sleep_ms
+from uasyncio import sleep_ms, wait_for_ms, TimeoutError
 from uerrno import EINPROGRESS
 from gc import collect
 from json import loads
 
+from millegrilles.attente_socket import attendre_ecriture, attendre_lecture, verifier_connexion
+from millegrilles.contexte_tls import wrap_socket
+from millegrilles.resolveur_dns import resoudre
+from millegrilles.mgmessages import BufferMessage
+
+CONST_TIMEOUT_S = const(10)  # Par attente (connexion, donnees), remplace par le parametre timeout
+CONST_TAILLE_TAMPON = const(512)  # Tampon de lecture de l'entete et des tailles de chunks
+CONST_TAILLE_LIGNE_MAX = const(2048)
+CONST_TAILLE_CONTENU_MAX = const(8 * 1024)  # Response.content() sans Content-Length
+
+# Pool keep-alive (HTTP/1.1) : une connexion inactive par 'proto//hote:port'
+CONST_NB_CONNEXIONS_MAX = const(2)  # Sockets inactifs conserves (heap TLS)
+CONST_DUREE_INACTIVITE_S = const(30)
+
+# Connexions inactives : {cle: [expiration, socket, lecteur]}
+POOL_CONNEXIONS = dict()
+
+# Metriques de la derniere requete. connexion_ms : connexion TCP et TLS, 0 si connexion reutilisee
+STATS_HTTP = {'requetes': 0, 'ttfb_ms': 0, 'duree_ms': 0, 'octets': 0, 'connexion_ms': 0}
+
+# Metriques du pool. connexion_moyenne_ms : duree moyenne d'une nouvelle connexion, economisee a chaque reutilisation
+STATS_POOL = {'nouvelles': 0, 'reutilisations': 0, 'connexion_moyenne_ms': 0, 'economie_ms': 0}
+
+
+class LecteurSocket:
+    """
+    Lecture tamponnee d'un socket non-bloquant. Le reveil est fait par uasyncio (poll du socket),
+    aucune attente fixe entre les tentatives de lecture.
+    """
+
+    def __init__(self, sock, timeout_ms):
+        self.__sock = sock
+        self.__timeout_ms = timeout_ms
+        self.__tampon = bytearray(CONST_TAILLE_TAMPON)
+        self.__debut = 0
+        self.__fin = 0
+
+    @property
+    def disponible(self) -> int:
+        """ Bytes recus non consommes. """
+        return self.__fin - self.__debut
+
+    async def __lire_socket(self, destination) -> int:
+        """ @return Nombre de bytes lus, 0 sur fin de connexion """
+        while True:
+            n = self.__sock.readinto(destination)
+            if n is not None:
+                return n
+            try:
+                await wait_for_ms(attendre_lecture(self.__sock), self.__timeout_ms)
+            except TimeoutError:
+                raise OSError(110)  # ETIMEDOUT
+
+    async def readline(self) -> bytes:
+        """ @return Ligne incluant \r\n, b'' sur fin de connexion """
+        ligne = b''
+        while True:
+            if self.__debut == self.__fin:
+                self.__debut = 0
+                self.__fin = await self.__lire_socket(self.__tampon)
+                if self.__fin == 0:
+                    return ligne
+            # bytearray n'a pas de find() sous MicroPython : chercher \n par index
+            tampon = self.__tampon
+            fin = self.__debut
+            while fin < self.__fin:
+                fin += 1
+                if tampon[fin - 1] == 0x0A:
+                    break
+            ligne += tampon[self.__debut:fin]
+            self.__debut = fin
+            if ligne.endswith(b'\n'):
+                return ligne
+            if len(ligne) > CONST_TAILLE_LIGNE_MAX:
+                raise ValueError('ligne trop longue')
+
+    async def readinto(self, destination) -> int:
+        """ Lit dans destination (memoryview), le reste du tampon en premier. @return 0 sur fin de connexion """
+        disponible = self.__fin - self.__debut
+        if disponible > 0:
+            n = min(disponible, len(destination))
+            destination[:n] = memoryview(self.__tampon)[self.__debut:self.__debut + n]
+            self.__debut += n
+            return n
+        return await self.__lire_socket(destination)
+
+    async def readexactly(self, destination):
+        position = 0
+        while position < len(destination):
+            n = await self.readinto(destination[position:])
+            if n == 0:
+                raise OSError(104)  # ECONNRESET, reponse tronquee
+            position += n
+
+
+async def ecrire(sock, data, timeout_ms):
+    """ Ecrit data au complet sur un socket non-bloquant. """
+    mv = memoryview(data)
+    position = 0
+    while position < len(mv):
+        n = sock.write(mv[position:])
+        if n is None:
+            try:
+                await wait_for_ms(attendre_ecriture(sock), timeout_ms)
+            except TimeoutError:
+                raise OSError(110)  # ETIMEDOUT
+            continue
+        position += n
+
+
+def prendre_connexion(cle: str):
+    """ @return (socket, lecteur) inactif pour cle, None si absent, expire ou ferme par le serveur """
+    try:
+        expiration, sock, lecteur = POOL_CONNEXIONS.pop(cle)
+    except KeyError:
+        return None
+    if expiration >= time.time():
+        # Connexion ouverte : aucune donnee en attente (None). 0 : fermee par le serveur.
+        try:
+            if sock.readinto(bytearray(1)) is None:
+                return sock, lecteur
+        except OSError:
+            pass
+    sock.close()
+    return None
+
+
+def rendre_connexion(cle: str, sock, lecteur):
+    """ Conserve une connexion inactive pour la prochaine requete vers le meme hote. """
+    maintenant = time.time()
+    for cle_pool in [c for c, v in POOL_CONNEXIONS.items() if c == cle or v[0] < maintenant]:
+        POOL_CONNEXIONS.pop(cle_pool)[1].close()
+    if len(POOL_CONNEXIONS) >= CONST_NB_CONNEXIONS_MAX:
+        # Retirer la connexion qui expire le plus tot
+        cle_retrait = min(POOL_CONNEXIONS, key=lambda c: POOL_CONNEXIONS[c][0])
+        POOL_CONNEXIONS.pop(cle_retrait)[1].close()
+    POOL_CONNEXIONS[cle] = [maintenant + CONST_DUREE_INACTIVITE_S, sock, lecteur]
+
+
+def fermer_connexions():
+    """ Ferme les connexions inactives (e.g. liberer le heap TLS avant la connexion websocket). """
+    for connexion in POOL_CONNEXIONS.values():
+        connexion[1].close()
+    POOL_CONNEXIONS.clear()
+
+
+async def ouvrir_connexion(proto: str, host: str, port: int, timeout_ms: int, lock=None):
+    """ Connexion TCP non-bloquante, puis TLS (https). @return socket non-bloquant """
+    # Resolution DNS non-bloquante, getaddrinfo recoit une adresse ip
+    ai = usocket.getaddrinfo(await resoudre(host), port, 0, usocket.SOCK_STREAM)[0]
+
+    s = usocket.socket(ai[0], usocket.SOCK_STREAM, ai[2])
+    s.setblocking(False)
+    try:
+        try:
+            s.connect(ai[-1])
+        except OSError as er:
+            if er.errno != EINPROGRESS:
+                raise er
+        try:
+            await wait_for_ms(attendre_ecriture(s), timeout_ms)
+        except TimeoutError:
+            raise OSError(110)  # ETIMEDOUT
+        verifier_connexion(s)
+
+        if proto == "https:":
+            try:
+                if lock is not None:
+                    await lock.acquire()
+                # Handshake TLS bloquant (firmware), borne par le timeout
+                s.settimeout(timeout_ms // 1000)
+                s = wrap_socket(s, host)
+                s.setblocking(False)
+            finally:
+                if lock is not None:
+                    lock.release()
+            await sleep_ms(1)  # Yield
+    except BaseException as e:
+        s.close()
+        raise e
+
+    return s
+
+
 class Response:
-    def __init__(self, f):
+    def __init__(self, f, lecteur=None):
         self.raw = f
         self.encoding = "utf-8"
         self._cached = None
-        print("Response init")
+        self._lecteur = lecteur
+        self._chunked = False
+        self._content_length = None
+        self._cle = None  # Cle du pool si la connexion peut etre reutilisee (keep-alive)
+        self._corps_lu = False
+        self.status_code = None
+        self.reason = ''
+        self.headers = None
 
     def close(self):
+        """ Remet la connexion dans le pool si le corps a ete lu au complet, sinon la ferme. """
         if self.raw:
-            self.raw.close()
+            if self._corps_lu is True and self._cle is not None and self._lecteur.disponible == 0:
+                rendre_connexion(self._cle, self.raw, self._lecteur)
+            else:
+                self.raw.close()
             self.raw = None
-            print("Response.close() Raw 1")
+        self._lecteur = None
         self._cached = None
 
-    async def content(self):
+    async def lire_into(self, buffer, taille_max=None):
+        """
+        Lit le corps de la reponse directement dans buffer (BufferMessage), sans copie intermediaire.
+        Le corps chunked (Transfer-Encoding) est decode.
+        @raises ValueError('overflow') si le corps depasse taille_max (defaut : taille du buffer)
+        """
+        if taille_max is None:
+            taille_max = len(buffer.buffer)
+        destination = memoryview(buffer.buffer)[:taille_max]
+        lecteur = self._lecteur
+        position = 0
+        try:
+            if self._chunked is True:
+                while True:
+                    ligne = await lecteur.readline()
+                    if not ligne:
+                        raise OSError(104)  # Reponse tronquee
+                    taille = int(ligne.split(b';', 1)[0].strip(), 16)
+                    if taille == 0:
+                        # Trailers optionnels jusqu'a la ligne vide
+                        while True:
+                            ligne = await lecteur.readline()
+                            if not ligne or ligne == b'\r\n':
+                                break
+                        break
+                    if position + taille > taille_max:
+                        raise ValueError('overflow')
+                    await lecteur.readexactly(destination[position:position + taille])
+                    position += taille
+                    await lecteur.readline()  # \r\n de fin de chunk
+            elif self._content_length is not None:
+                if self._content_length > taille_max:
+                    raise ValueError('overflow')
+                await lecteur.readexactly(destination[:self._content_length])
+                position = self._content_length
+            else:
+                # HTTP/1.0 sans Content-Length : lire jusqu'a la fermeture
+                while True:
+                    if position == taille_max:
+                        if await lecteur.readinto(bytearray(1)) > 0:
+                            raise ValueError('overflow')
+                        break
+                    n = await lecteur.readinto(destination[position:])
+                    if n == 0:
+                        break
+                    position += n
+            self._corps_lu = True
+        finally:
+            self.close()
+
+        buffer.set_len(position)
+        STATS_HTTP['octets'] = position
+        return position
+
+    async def content(self, taille_max=CONST_TAILLE_CONTENU_MAX):
         if self._cached is None:
-            try:
-                await sleep_ms(10)  # Attendre download
-                self._cached = self.raw.read()
-                #if self._cached is None:
-                #    await sleep_ms(250)  # Attendre download, tenter a nouveau
-                #    self._cached = self.raw.read()
-            finally:
-                self.raw.close()
-                self.raw = None
-                print("Response.close() Raw 2")
+            buffer = BufferMessage(self._content_length or taille_max)
+            await self.lire_into(buffer)
+            self._cached = bytes(buffer.get_data())
         return self._cached
 
     async def text(self):
@@ -37,10 +280,10 @@ class Response:
 
     async def json(self):
         return loads(await self.content())
-    
+
     async def read_text_into(self, buffer):
-        content = await self.content()
-        buffer.set_text(await self.text())
+        await self.lire_into(buffer)
+
 
 async def request(
     method,
@@ -53,9 +296,13 @@ async def request(
     timeout=None,
     parse_headers=True,
     lock=None,
+    keep_alive=True,
 ):
     redirect = None  # redirection url, None means no redirection
     chunked_data = data and getattr(data, "__iter__", None) and not getattr(data, "__len__", None)
+    timeout_ms = (timeout or CONST_TIMEOUT_S) * 1000
+    debut = time.ticks_ms()
+    STATS_HTTP['requetes'] += 1
 
     if auth is not None:
         import ubinascii
@@ -73,8 +320,6 @@ async def request(
     if proto == "http:":
         port = 80
     elif proto == "https:":
-        import ussl
-
         port = 443
     else:
         raise ValueError("Unsupported protocol: " + proto)
@@ -83,93 +328,94 @@ async def request(
         host, port = host.split(":", 1)
         port = int(port)
 
-    ai = usocket.getaddrinfo(host, port, 0, usocket.SOCK_STREAM)
-    await sleep_ms(1)  # Yield
-    #else:
-    #    ai = await thread_executor(usocket.getaddrinfo, host, port, 0, usocket.SOCK_STREAM)
-    ai = ai[0]
-
     resp_d = None
     if parse_headers is not False:
         resp_d = {}
 
-    print("open socket")
-    s = usocket.socket(ai[0], usocket.SOCK_STREAM, ai[2])
-    print("Socket init")
-    s.setblocking(False)
+    # Entete complete en une seule ecriture (un seul record TLS)
+    entete = bytearray(b"%s /%s HTTP/1.%d\r\n" % (method, path, 1 if keep_alive else 0))
+    if not "Host" in headers:
+        entete.extend(b"Host: %s\r\n" % host)
+    # Iterate over keys to avoid tuple alloc
+    for k in headers:
+        entete.extend(b"%s: %s\r\n" % (k, headers[k]))
+    if json is not None:
+        assert data is None
+        import ujson
+
+        data = ujson.dumps(json)
+        entete.extend(b"Content-Type: application/json\r\n")
+    if data:
+        if chunked_data:
+            entete.extend(b"Transfer-Encoding: chunked\r\n")
+        else:
+            entete.extend(b"Content-Length: %d\r\n" % len(data))
+    if keep_alive:
+        entete.extend(b"Connection: keep-alive\r\n\r\n")
+    else:
+        entete.extend(b"Connection: close\r\n\r\n")
 
-    if timeout is not None:
-        # Note: settimeout is not supported on all platforms, will raise
-        # an AttributeError if not available.
-        s.settimeout(timeout)
+    cle = "%s//%s:%s" % (proto, host, port)
+    s = None
+    reutilisee = False
+    if keep_alive:
+        connexion = prendre_connexion(cle)
+        if connexion is not None:
+            s, lecteur = connexion
+            reutilisee = True
 
     try:
-        try:
-            await sleep_ms(1)  # Yield
-            s.connect(ai[-1])
-            # print("Socket connect")
-            await sleep_ms(1)  # Yield
-        except OSError as er:
-            if er.errno != EINPROGRESS:
-                raise er        
-        
-        if proto == "https:":
-            # print("https init")
-            try:
-                if lock is not None:
-                    await lock.acquire()
-                    # print("https lock acquired")
-                s = ussl.wrap_socket(s, server_hostname=host)
-            finally:
-                if lock is not None:
-                    # print("https release lock")
-                    lock.release()
-            # print("https init done")
-            await sleep_ms(1)  # Yield
-        
-        s.write(b"%s /%s HTTP/1.0\r\n" % (method, path))
-        
-        if not "Host" in headers:
-            s.write(b"Host: %s\r\n" % host)
-        # Iterate over keys to avoid tuple alloc
-        for k in headers:
-            s.write(k)
-            s.write(b": ")
-            s.write(headers[k])
-            s.write(b"\r\n")
-        if json is not None:
-            assert data is None
-            import ujson
-
-            data = ujson.dumps(json)
-            s.write(b"Content-Type: application/json\r\n")
-        if data:
-            if chunked_data:
-                s.write(b"Transfer-Encoding: chunked\r\n")
-            else:
-                s.write(b"Content-Length: %d\r\n" % len(data))
-        s.write(b"Connection: close\r\n\r\n")
-        await sleep_ms(1)  # Yield
-        if data:
-            if chunked_data:
-                for chunk in data:
-                    s.write(b"%x\r\n" % len(chunk))
-                    s.write(chunk)
-                    s.write(b"\r\n")
-                    await sleep_ms(1)  # Yield
-                s.write("0\r\n\r\n")
-            else:
-                s.write(data)
-                await sleep_ms(1)  # Yield
-
-        # Simuler non-blocking
-        await sleep_ms(1)
         while True:
-            l = s.readline()
-            if l is not None:
+            if s is None:
+                debut_connexion = time.ticks_ms()
+                s = await ouvrir_connexion(proto, host, port, timeout_ms, lock)
+                lecteur = LecteurSocket(s, timeout_ms)
+                duree_connexion = time.ticks_diff(time.ticks_ms(), debut_connexion)
+                STATS_HTTP['connexion_ms'] = duree_connexion
+                STATS_POOL['nouvelles'] += 1
+                if STATS_POOL['connexion_moyenne_ms'] == 0:
+                    STATS_POOL['connexion_moyenne_ms'] = duree_connexion
+                else:
+                    STATS_POOL['connexion_moyenne_ms'] = (STATS_POOL['connexion_moyenne_ms'] * 3 + duree_connexion) // 4
+
+            entete_envoyee = False
+            try:
+                await ecrire(s, entete, timeout_ms)
+                entete_envoyee = True
+                if data:
+                    if chunked_data:
+                        for chunk in data:
+                            await ecrire(s, b"%x\r\n" % len(chunk), timeout_ms)
+                            await ecrire(s, chunk, timeout_ms)
+                            await ecrire(s, b"\r\n", timeout_ms)
+                        await ecrire(s, b"0\r\n\r\n", timeout_ms)
+                    else:
+                        await ecrire(s, data, timeout_ms)
+
+                l = await lecteur.readline()
+                if not l:
+                    raise OSError(104)  # ECONNRESET, connexion fermee avant la reponse
                 break
-            await sleep_ms(500)
-        
+            except OSError as e:
+                if reutilisee is False or chunked_data:
+                    raise e
+                if entete_envoyee and method not in ("GET", "HEAD"):
+                    # Entete complete envoyee : requete possiblement traitee par le serveur (ex. /inscrire), ne pas rejouer
+                    raise e
+                # Connexion du pool fermee par le serveur entre-temps : reessayer sur une nouvelle connexion
+                print("Connexion %s reutilisee fermee (%s), nouvelle connexion" % (cle, e))
+                s.close()
+                s = None
+                reutilisee = False
+
+        entete = None
+        if reutilisee is True:
+            STATS_HTTP['connexion_ms'] = 0
+            STATS_POOL['reutilisations'] += 1
+            STATS_POOL['economie_ms'] += STATS_POOL['connexion_moyenne_ms']
+        STATS_HTTP['ttfb_ms'] = time.ticks_diff(time.ticks_ms(), debut)
+
+        reutilisable = keep_alive and l.startswith(b"HTTP/1.1")
         l = l.split(None, 2)
         if len(l) < 2:
             # Invalid response
@@ -178,19 +424,21 @@ async def request(
         reason = ""
         if len(l) > 2:
             reason = l[2].rstrip()
+
+        chunked = False
+        content_length = None
         while True:
-            l = s.readline()
-            if not l:
-                # Donner une chance, on est en non blocking io
-                await sleep_ms(250)
-                l = s.readline()
+            l = await lecteur.readline()
             if not l or l == b"\r\n":
                 break
-            # print(l)
-            if l.startswith(b"Transfer-Encoding:"):
-                if b"chunked" in l:
-                    raise ValueError("Unsupported " + str(l, "utf-8"))
-            elif l.startswith(b"Location:") and not 200 <= status <= 299:
+            nom = l[:l.find(b":")].lower()
+            if nom == b"transfer-encoding":
+                chunked = b"chunked" in l
+            elif nom == b"content-length":
+                content_length = int(l[15:].strip())
+            elif nom == b"connection":
+                reutilisable = reutilisable and b"close" not in l.lower()
+            elif nom == b"location" and not 200 <= status <= 299:
                 if status in [301, 302, 303, 307, 308]:
                     redirect = str(l[10:-2], "utf-8")
                 else:
@@ -203,24 +451,37 @@ async def request(
                 resp_d[k] = v.strip()
             else:
                 parse_headers(l, resp_d)
-    except OSError:
-        s.close()
-        print("Closing socket")
+    except BaseException:
+        if s is not None:
+            s.close()
+            print("Closing socket")
         raise
 
+    if method == "HEAD" or status in (204, 304):
+        chunked = False
+        content_length = 0  # Aucun corps
+
     if redirect:
         s.close()
-        print("Closing socket")
+        collect()
         if status in [301, 302, 303]:
-            return request("GET", redirect, None, None, headers, stream)
+            return await request("GET", redirect, None, None, headers, stream, timeout=timeout, lock=lock,
+                                 keep_alive=keep_alive)
         else:
-            return request(method, redirect, data, json, headers, stream)
+            return await request(method, redirect, data, json, headers, stream, timeout=timeout, lock=lock,
+                                 keep_alive=keep_alive)
     else:
-        resp = Response(s)
+        resp = Response(s, lecteur)
+        resp._chunked = chunked
+        resp._content_length = content_length
+        resp._corps_lu = content_length == 0
+        if reutilisable and (chunked or content_length is not None):
+            resp._cle = cle  # Fin du corps delimitee, connexion reutilisable
         resp.status_code = status
         resp.reason = reason
         if resp_d is not None:
             resp.headers = resp_d
+        STATS_HTTP['duree_ms'] = time.ticks_diff(time.ticks_ms(), debut)
         return resp
 
 
@@ -246,6 +507,3 @@ async def patch(url, **kw):
 
 async def delete(url, **kw):
     return await request("DELETE", url, **kw)
-
-
-
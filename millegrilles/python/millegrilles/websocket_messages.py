@@ -2,21 +2,30 @@ import time
 import uasyncio as asyncio
 
 from binascii import hexlify
-from json import dumps, loads, load, dump
+from json import loads, load
 from gc import collect
 from sys import print_exception
 from micropython import mem_info
 
-from uwebsockets.client import connect
+from mgutils import taux_heure
+
+from uwebsockets.protocol import MessageTooBig, ConnectionClosed, STATS_DEFLATE
+from millegrilles.file_emission import FileEmission, STATS_EMISSION, PRIORITE_ETAT
+from millegrilles.journal_lectures import STATS_JOURNAL
+from millegrilles.filtre_etat import FiltreEtat, STATS_ETAT
+from millegrilles.config_store import STATS_CONFIG
+from millegrilles.urequests2 import fermer_connexions
+from millegrilles.course_relais import course_relais, CONST_NB_RELAIS_COURSE, STATS_COURSE
 from millegrilles.certificat import get_expiration_certificat_local
-from millegrilles.mgmessages import formatter_message, verifier_message
-from millegrilles.config import get_http_timeout, set_configuration_display, get_timezone, set_timezone_offset, CONST_PATH_TZOFFSET, get_tz_offset
+from millegrilles.mgmessages import formatter_message, verifier_message, ecrire_message
+from millegrilles.config import get_http_timeout, set_configuration_display, get_timezone, set_timezone_offset, CONST_PATH_TZOFFSET, get_tz_offset, \
+    noter_relai, sauvegarder_scores_relais
 
 from millegrilles.message_inscription import verifier_renouveler_certificat_ws, generer_message_timeinfo
 
 # Import dev/prod
 # from handler_commandes import traiter_commande
-from millegrilles.handler_commandes import traiter_commande
+from millegrilles.handler_commandes import traiter_commande, get_action
 
 
 PATHNAME_POLL = const('/poll')
@@ -31,9 +40,26 @@ CONST_REQUETE_FICHE_PUBLIQUE = const('getFichePublique')
 CONST_REQUETE_RELAIS_WEB = const('getRelaisWeb')
 CONST_COMMANDE_ECHANGE_CLES = const('echangerClesChiffrage')
 
+# Actions des reponses aux requetes de warm-up
+CONST_REPONSE_TIMEINFO = const('timezoneInfo')
+CONST_REPONSE_CERTIFICAT = const('signerAppareil')
+CONST_REPONSE_RELAIS_WEB = const('relaisWeb')
+
 # Durees en secondes
 CONST_EXPIRATION_CONFIG = const(8 * 3600)
 
+CONST_DELAI_EMIT_MS = const(250)  # Delai avant d'emettre l'etat sur emit_event
+CONST_DELAI_PREMIER_ETAT_MS = const(2500)  # Emission de l'etat si aucune reponse recue
+
+CONST_LOT_JOURNAL = const(120)  # Enregistrements du journal de lectures par message
+CONST_ATTENTE_SECRET_MS = const(5000)  # Attente max du canal chiffre avant d'emettre les requetes de warm-up
+
+# Metrique : nombre de reveils de la boucle poll
+STATS_POLL = {'cycles': 0}
+
+# Metrique : duree (re)connexion -> toutes les reponses de configuration recues
+STATS_WARMUP = {'duree_ms': None, 'requetes': 0, 'reponses': 0}
+
 
 class HttpErrorException(Exception):
     pass
@@ -52,35 +78,47 @@ async def __preparer_message(chiffrage_messages, timeout_http, generer_etat, buf
     if chiffrage_messages.pret is True:
         # Chiffrer le message
         print('preparer_message chiffrer')
-        etat = await chiffrage_messages.chiffrer(etat)
-        etat['routage'] = {'action': 'etatAppareilRelai'}
+        await chiffrage_messages.ecrire_chiffre(etat, buffer, routage={'action': 'etatAppareilRelai'})
     else:
         # Signer message
         etat = await formatter_message(etat, kind=2, domaine=CONST_DOMAINE_SENSEURSPASSIFS, action='etatAppareil', buffer=buffer)
-
-    buffer.clear()
-    dump(etat, buffer)
+        ecrire_message(etat, buffer)
 
     return buffer
 
 
-async def poll(appareil, websocket, emit_event, buffer, timeout_http=60, generer_etat=None):
+async def attendre_reveil(websocket, delai_ms):
+    """
+    Attend des donnees sur le websocket, un reveil (websocket.reveil, e.g. emit_event de l'appareil)
+    ou l'expiration du delai. Aucun polling ni tache par cycle : le websocket a une seule tache de veille.
+    """
+    try:
+        await asyncio.wait_for_ms(websocket.attendre_lecture(), delai_ms)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def poll(appareil, websocket, emit_event, buffer, timeout_http=60, generer_etat=None, emetteur=None,
+               filtre_etat=None, echeance_ms=None):
+    """
+    echeance_ms : ticks_ms optionnel, retourne None des l'echeance (e.g. attente du canal chiffre du warm-up)
+    """
     # Calculer limite de la periode de polling
     if timeout_http is None or timeout_http < 1:
         timeout_http = 1  # Min pour executer entretien websocket
 
+    if filtre_etat is None:
+        filtre_etat = FiltreEtat()
+    filtre_etat.set_timeout_http(timeout_http)
+
     expiration_polling = time.time() + timeout_http
     print("expiration polling dans %s" % timeout_http)
 
-    # Poll socket
-    cycle = 0
-    deja_emis = False
-    emettre = False
-    refresh = True
+    debut = time.ticks_ms()
 
     while expiration_polling > time.time():
-        cycle += 1
-        
+        STATS_POLL['cycles'] += 1
+
         try:
             reponse = await websocket.recv(buffer.buffer)
             if reponse is not None and len(reponse) > 0:
@@ -92,27 +130,74 @@ async def poll(appareil, websocket, emit_event, buffer, timeout_http=60, generer
             else:
                 raise e
 
-        if cycle > 5 and emit_event.is_set():
+        ecoule = time.ticks_diff(time.ticks_ms(), debut)
+        attente_battement = filtre_etat.ms_avant_battement()
+        attente_intervalle = filtre_etat.ms_avant_intervalle()
+        emettre = False
+        refresh = True
+        if attente_battement == 0:
+            # Battement (ou premier etat de la connexion) si aucune reponse recue
+            emettre = ecoule >= CONST_DELAI_PREMIER_ETAT_MS
+        elif ecoule >= CONST_DELAI_EMIT_MS and emit_event.is_set() and attente_intervalle == 0:
             print("Emit event set, emettre")
             emettre = True
             refresh = False
-        elif cycle == 50 and deja_emis is False:
-            emettre = True
-        else:
-            # Intervalle polling socket
-            await asyncio.sleep_ms(50)
 
         if emettre is True:
-            emettre = False
-            deja_emis = True
             chiffrage_messages = appareil.chiffrage_messages
             buffer = await __preparer_message(chiffrage_messages, timeout_http, generer_etat, buffer, refresh=refresh)
             print("poll Send data, taille etat: %d" % len(buffer))
-            websocket.send(buffer.get_data())
+            await emetteur.emettre(buffer.get_data(), PRIORITE_ETAT)
+            filtre_etat.marquer_emis(appareil.lectures_courantes, len(buffer))
             await asyncio.sleep_ms(1)  # Yield
+            continue
+
+        # Prochain reveil : donnees recues, emit_event (reveil du websocket) ou prochaine echeance
+        # (battement, limite de frequence)
+        if attente_battement == 0:
+            delai = CONST_DELAI_PREMIER_ETAT_MS - ecoule
+        else:
+            delai = min((expiration_polling - time.time()) * 1000, attente_battement)
+            if ecoule < CONST_DELAI_EMIT_MS:
+                delai = min(delai, CONST_DELAI_EMIT_MS - ecoule)
+            elif emit_event.is_set():
+                delai = min(delai, attente_intervalle)  # Changement en attente de la limite de frequence
+        if echeance_ms is not None:
+            restant = time.ticks_diff(echeance_ms, time.ticks_ms())
+            if restant <= 0:
+                return None
+            delai = min(delai, restant)
+        await attendre_reveil(websocket, max(delai, 1))
+
+
+async def televerser_journal(chiffrage_messages, emetteur, journal, buffer):
+    """
+    Televerse le journal de lectures hors ligne par lots, via l'etat chiffre (etatAppareilRelai).
+    """
+    journal.ecrire()  # Tampon RAM vers flash
+    debut = time.ticks_ms()
+    nb_lots = 0
+    while True:
+        historique, nb_enregistrements = journal.lire_lot(CONST_LOT_JOURNAL)
+        if nb_enregistrements == 0:
+            break
+        etat = {'lectures_senseurs': {}, 'lectures_historiques': historique}
+        historique = None
+        await chiffrage_messages.ecrire_chiffre(etat, buffer, routage={'action': 'etatAppareilRelai'})
+        etat = None
+        envoye = asyncio.Event()
+        await emetteur.emettre(buffer.get_data(), envoye=envoye)
+        await emetteur.attendre_envoi(envoye)  # Erreur d'ecriture : lot conserve pour la prochaine connexion
+        journal.retirer(nb_enregistrements)
+        nb_lots += 1
+        await asyncio.sleep_ms(1)  # Yield
+        collect()
 
+    print("Journal lectures televerse : %d lots en %d ms %s" % (
+        nb_lots, time.ticks_diff(time.ticks_ms(), debut), STATS_JOURNAL))
 
-async def requete_configuration_displays(chiffrage_messages, websocket, buffer):
+
+async def requete_configuration_displays(chiffrage_messages, emetteur, buffer):
     #requete = await signer_message(
     #    dict(), domaine=CONST_DOMAINE_SENSEURSPASSIFS, action=CONST_REQUETE_DISPLAY)
     message = dict()
@@ -125,7 +210,7 @@ async def requete_configuration_displays(chiffrage_messages, websocket, buffer):
     requete = await formatter_message(message, kind=1,
                                       domaine=CONST_DOMAINE_SENSEURSPASSIFS, action=CONST_REQUETE_DISPLAY,
                                       buffer=buffer, ajouter_certificat=True)
-    buffer.set_text(dumps(requete))
+    ecrire_message(requete, buffer)
     requete = None
 
     # Cleanup memoire
@@ -134,16 +219,16 @@ async def requete_configuration_displays(chiffrage_messages, websocket, buffer):
     await asyncio.sleep_ms(1)
     
     print('requete_configuration_displays')
-    websocket.send(buffer.get_data())
+    await emetteur.emettre(buffer.get_data())
 
 
-async def requete_configuration_programmes(chiffrage_messages, websocket, buffer):
+async def requete_configuration_programmes(chiffrage_messages, emetteur, buffer):
     #requete = await signer_message(
     #    dict(), domaine=CONST_DOMAINE_SENSEURSPASSIFS, action=CONST_REQUETE_PROGRAMMES)
     requete = await formatter_message(dict(), kind=1,
                                       domaine=CONST_DOMAINE_SENSEURSPASSIFS, action=CONST_REQUETE_PROGRAMMES,
                                       buffer=buffer, ajouter_certificat=True)
-    buffer.set_text(dumps(requete))
+    ecrire_message(requete, buffer)
     requete = None
 
     # Cleanup memoire
@@ -152,16 +237,16 @@ async def requete_configuration_programmes(chiffrage_messages, websocket, buffer
     await asyncio.sleep_ms(1)
     
     print('requete_configuration_programmes')
-    websocket.send(buffer.get_data())
+    await emetteur.emettre(buffer.get_data())
 
 
-async def requete_fiche_publique(websocket, buffer):
+async def requete_fiche_publique(emetteur, buffer):
     #requete = await signer_message(
     #    dict(), domaine='senseurspassifs_relai', action=CONST_REQUETE_FICHE_PUBLIQUE)
     requete = await formatter_message(dict(), kind=1,
                                       domaine=CONST_DOMAINE_SENSEURSPASSIFS_RELAI, action=CONST_REQUETE_FICHE_PUBLIQUE,
                                       buffer=buffer, ajouter_certificat=True)
-    buffer.set_text(dumps(requete))
+    ecrire_message(requete, buffer)
     requete = None
 
     # Cleanup memoire
@@ -169,34 +254,32 @@ async def requete_fiche_publique(websocket, buffer):
     collect()
     await asyncio.sleep_ms(1)
     
-    websocket.send(buffer.get_data())
+    await emetteur.emettre(buffer.get_data())
 
 
-async def requete_relais_web(chiffrage_messages, websocket, buffer):
+async def requete_relais_web(chiffrage_messages, emetteur, buffer):
     #requete = await signer_message(
     #    dict(), domaine=CONST_DOMAINE_SENSEURSPASSIFS_RELAI, action=CONST_REQUETE_RELAIS_WEB, buffer=buffer)
 
     if chiffrage_messages.pret is True:
         # Chiffrer le message
-        requete = await chiffrage_messages.chiffrer(dict())
-        requete['routage'] = {'action': CONST_REQUETE_RELAIS_WEB}
+        await chiffrage_messages.ecrire_chiffre(dict(), buffer, routage={'action': CONST_REQUETE_RELAIS_WEB})
     else:
         requete = await formatter_message(dict(), kind=1,
                                           domaine=CONST_DOMAINE_SENSEURSPASSIFS_RELAI, action=CONST_REQUETE_RELAIS_WEB,
                                           buffer=buffer, ajouter_certificat=True)
-    buffer.clear()
-    dump(requete, buffer)
-    requete = None
+        ecrire_message(requete, buffer)
+        requete = None
 
     # Cleanup memoire
     await asyncio.sleep_ms(1)
     collect()
     await asyncio.sleep_ms(1)
     
-    websocket.send(buffer.get_data())
+    await emetteur.emettre(buffer.get_data())
 
 
-async def charger_timeinfo(chiffrage_messages, websocket, buffer, refresh: False):
+async def charger_timeinfo(chiffrage_messages, emetteur, buffer, refresh: False):
 
     offset = None
     try:
@@ -234,19 +317,17 @@ async def charger_timeinfo(chiffrage_messages, websocket, buffer, refresh: False
         if latitude and longitude:
             requete['latitude'] = latitude
             requete['longitude'] = longitude
-        requete = await chiffrage_messages.chiffrer(requete)
-        requete['routage'] = {'action': 'getTimezoneInfo'}
+        await chiffrage_messages.ecrire_chiffre(requete, buffer, routage={'action': 'getTimezoneInfo'})
     else:
         requete = await generer_message_timeinfo(timezone_str)
-
-    buffer.set_text(dumps(requete))
+        ecrire_message(requete, buffer)
 
     await asyncio.sleep_ms(1)  # Yield
     collect()
     await asyncio.sleep_ms(1)  # Yield
 
     # Emettre requete
-    websocket.send(buffer.get_data())
+    await emetteur.emettre(buffer.get_data())
 
 
 async def verifier_signature(reponse, buffer):
@@ -263,11 +344,16 @@ class PollingThread:
         self.__load_initial = True
         self.__prochain_refresh_config = 0
         self.__refresh_step = 0
+        self.__debut_warmup = 0
+        self.__debut_secret = 0
+        self.__reponses_attendues = set()  # Actions des reponses de warm-up non recues
         self.__url_relai = None
+        self.__relais_echec = list()  # Relais en echec, mis en fin de course
         self.__errnumber = 0
         
         self.__buffer = buffer
         self.__websocket = None
+        self.__emetteur = None  # File d'emission du websocket, seul ecrivain sur le socket
         
         self.__nie_count = 0
         self.__memory_error = 0
@@ -284,83 +370,135 @@ class PollingThread:
         self.__load_initial = True
         self.__refresh_step = 0
         self.__errnumber = 0
+        self.__debut_warmup = time.ticks_ms()
+        self.__reponses_attendues.clear()
+        STATS_WARMUP['duree_ms'] = None
 
-        # Assigner un URL
+        # Ordonner les relais (relai courant en premier)
         self.entretien_url_relai()
+        candidats = self.candidats_relais()
 
         chiffrage_messages = self.__appareil.chiffrage_messages
         chiffrage_messages.clear()
         self.__prochain_refresh_config = 0  # Forcer recharger config sur connexion. Permet aussi chiffrage.
+        fermer_connexions()  # Connexions http keep-alive inactives, liberer le heap TLS
 
         print("PRE CONNECT")
         mem_info()
 
-        url_connexion = self.__url_relai + '/ws'
-        url_connexion = url_connexion.replace('https://', 'wss://')
-        print("URL connexion websocket %s" % url_connexion)
-        self.__websocket = connect(url_connexion)
+        urls_connexion = [url_relai.replace('https://', 'wss://') + '/ws' for url_relai in candidats]
+        print("URLs connexion websocket %s" % urls_connexion)
+        try:
+            url_connexion, self.__websocket = await course_relais(urls_connexion, compression=True)
+        except (AssertionError, OSError) as e:
+            # Aucun relai de la course n'a repondu, les passer en fin de liste
+            for url_relai in candidats[:CONST_NB_RELAIS_COURSE]:
+                if url_relai not in self.__relais_echec:
+                    self.__relais_echec.append(url_relai)
+            self.__url_relai = None
+            raise e
+        finally:
+            # Scores des relais : latence des tentatives completees, penalite des echecs
+            for url_resultat, latence in STATS_COURSE['resultats']:
+                noter_relai(candidats[urls_connexion.index(url_resultat)], latence)
+            sauvegarder_scores_relais()
+
+        self.__url_relai = candidats[urls_connexion.index(url_connexion)]
+        try:
+            self.__relais_echec.remove(self.__url_relai)
+        except ValueError:
+            pass
         self.__websocket.setblocking(False)
+        self.__emetteur = FileEmission(self.__websocket)
+        self.__emetteur.demarrer()
+        self.__appareil.filtre_etat.reset()  # Etat complet emis sur la nouvelle connexion
+        self.__appareil.set_websocket_pret(self.__websocket.reveil)
         print("websocket connecte")
         mem_info()
         
     def entretien_url_relai(self):
-        if self.__url_relai is None or self.__nie_count >= 3:
-            self.__url_relai = self.__appareil.pop_relais()
-            print("Utilisation relai %s" % self.__url_relai)
+        if self.__url_relai is not None and self.__nie_count >= 3:
+            print("Relai %s en echec" % self.__url_relai)
+            noter_relai(self.__url_relai)
+            sauvegarder_scores_relais()
+            self.__relais_echec.append(self.__url_relai)
+            self.__url_relai = None
             self.__nie_count = 0  # Reset compte erreurs connexion
 
-        if self.__url_relai is None:
+    def candidats_relais(self) -> list:
+        """ Relais en ordre de preference : relai courant, relais connus puis relais en echec. """
+        url_relais = self.__appareil.get_url_relais() or list()
+        candidats = [r for r in url_relais if r != self.__url_relai and r not in self.__relais_echec]
+        if self.__url_relai is not None:
+            candidats.insert(0, self.__url_relai)
+        candidats.extend([r for r in self.__relais_echec if r in url_relais])
+
+        if len(candidats) == 0:
             raise Exception('URL relai None')
 
-    def _refresh_config(self):
-        # Forcer un refresh de la liste de relais (via fiche MilleGrille)
+        return candidats
+
+    async def _refresh_config(self):
+        """
+        Warm-up de la connexion : echange de secret, puis les requetes de configuration sont emises
+        en rafale des que le canal chiffre est pret. Les reponses sont correlees par action dans _poll.
+        """
         print("Refresh config %d" % self.__refresh_step)
 
         chiffrage_messages = self.__appareil.chiffrage_messages
 
-        if self.__refresh_step <= 1:
-            self.__refresh_step = 2
-            await self.echanger_secret()
-            return
+        if self.__refresh_step == 0:
+            self.__refresh_step = 1
+            if self.__load_initial is False:
+                self.__debut_warmup = time.ticks_ms()  # Refresh periodique
+            self.__debut_secret = time.ticks_ms()
+            if await self.echanger_secret() is True:
+                return  # Reponse echangerSecret traitee par _poll
 
-        if self.__refresh_step <= 2:
-            self.__refresh_step = 3
-            # Recharger la configuration des displays
-            await requete_configuration_displays(chiffrage_messages, self.__websocket, buffer=self.__buffer)
-            return
+        if chiffrage_messages.pret is False and \
+                time.ticks_diff(time.ticks_ms(), self.__debut_secret) < CONST_ATTENTE_SECRET_MS:
+            return  # Canal chiffre pas encore pret
 
-        if self.__refresh_step <= 3:
-            self.__refresh_step = 4
-            await charger_timeinfo(
-                chiffrage_messages,
-                self.__websocket,
-                buffer=self.__buffer,
-                refresh=True)
-            return
-        
-        if self.__refresh_step <= 4:
-            self.__refresh_step = 5
-            # Recharger la configuration des programmes
-            await requete_configuration_programmes(chiffrage_messages, self.__websocket, buffer=self.__buffer)
-            return
-        
-        if self.__refresh_step <= 5:
-            self.__refresh_step = 6
-            # Verifier si le certificat doit etre renouvelle
-            await verifier_renouveler_certificat_ws(self.__websocket, buffer=self.__buffer)
-            return
+        # Requetes independantes emises sans attendre les reponses
+        reponses_attendues = self.__reponses_attendues
 
-        if self.__refresh_step <= 6:
-            self.__refresh_step = 7
-            # Verifier si le certificat doit etre renouvelle
-            await requete_relais_web(chiffrage_messages, self.__websocket, buffer=self.__buffer)
-            return
+        # Recharger la configuration des displays
+        await requete_configuration_displays(chiffrage_messages, self.__emetteur, buffer=self.__buffer)
+        reponses_attendues.add(CONST_REQUETE_DISPLAY)
+
+        await charger_timeinfo(chiffrage_messages, self.__emetteur, buffer=self.__buffer, refresh=True)
+        reponses_attendues.add(CONST_REPONSE_TIMEINFO)
+
+        # Recharger la configuration des programmes
+        await requete_configuration_programmes(chiffrage_messages, self.__emetteur, buffer=self.__buffer)
+        reponses_attendues.add(CONST_REQUETE_PROGRAMMES)
+
+        # Verifier si le certificat doit etre renouvelle
+        if await verifier_renouveler_certificat_ws(self.__emetteur, buffer=self.__buffer) is not False:
+            reponses_attendues.add(CONST_REPONSE_CERTIFICAT)
+
+        await requete_relais_web(chiffrage_messages, self.__emetteur, buffer=self.__buffer)
+        reponses_attendues.add(CONST_REPONSE_RELAIS_WEB)
+
+        STATS_WARMUP['requetes'] = len(reponses_attendues)
+        STATS_WARMUP['reponses'] = 0
 
         # Succes - ajuster prochain refresh
         self.__load_initial = False  # Complete load initial
         self.__prochain_refresh_config = CONST_EXPIRATION_CONFIG + time.time()
         self.__refresh_step = 0
-        print("Refresh config complete")
+        print("Refresh config emis (%d requetes)" % len(reponses_attendues))
+
+    def _correler_reponse(self, action: str):
+        """ Retire l'action des reponses de warm-up attendues, conserve la duree quand toutes sont recues. """
+        reponses_attendues = self.__reponses_attendues
+        if action not in reponses_attendues:
+            return
+        reponses_attendues.remove(action)
+        STATS_WARMUP['reponses'] += 1
+        if len(reponses_attendues) == 0:
+            STATS_WARMUP['duree_ms'] = time.ticks_diff(time.ticks_ms(), self.__debut_warmup)
+            print("Configuration complete en %d ms (warm-up %s)" % (STATS_WARMUP['duree_ms'], STATS_WARMUP))
 
     async def run(self):
         # Faire expirer la thread pour reloader la fiche/url, entretien certificat
@@ -369,7 +507,6 @@ class PollingThread:
         
         print("Expiration thread %s (exp cert %s)" % (expiration_thread, expiration_certificat))
 
-        self.__appareil.set_websocket_pret()
         while expiration_thread > time.time() and self.__memory_error < 10:
             try:
                 print("Expiration thread dans %s " % (expiration_thread - time.time()))
@@ -377,27 +514,28 @@ class PollingThread:
                 # Connecter
                 try:
                     await self.connecter()
-                except AssertionError:
-                    # Erreur connexion (e.g. status code 502)
-                    self.__url_relai = None
-                    self.entretien_url_relai()
-                    continue
                 except OSError as e:
                     if e.errno == 104:
                         # ECONNRESET
                         self.__nie_count += 1
                         await asyncio.sleep_ms(500)
                         continue  # Retry
-                    elif e.errno in (103, -2):
-                        # Erreur connexion (e.g. ECONNABORTED, refused)
-                        self.__url_relai = None
-                        self.entretien_url_relai()
-                        continue
+                    elif len(self.__relais_echec) >= len(self.__appareil.get_url_relais()):
+                        # Tous les relais sont en echec, recharger la fiche
+                        self.__relais_echec.clear()
+                        raise e
                     else:
+                        continue  # Course avec les relais suivants
+                except AssertionError as e:
+                    # Erreur connexion (e.g. status code 502)
+                    if len(self.__relais_echec) >= len(self.__appareil.get_url_relais()):
+                        self.__relais_echec.clear()
                         raise e
-                    
+                    continue
+
                 # Boucle polling sur connexion websocket
                 now = time.time()
+                televerser = False
                 while expiration_thread > now and self.__memory_error < 10:
                     print("Expiration thread dans %s " % (expiration_thread - now))
 
@@ -409,14 +547,29 @@ class PollingThread:
                     elif self.__last_message_ts < now - (CONST_EXPIRATION_CONFIG+300):
                         # This is an attempt to force a reboot if the connection is not working properly
                         raise Exception('WS thread message timeout')
+                    elif self.__appareil.chiffrage_messages.pret is True and self.__appareil.journal_lectures.nombre > 0:
+                        televerser = True  # Lectures prises hors ligne
 
                     try:
+                        self.__emetteur.verifier()  # Erreur d'ecriture du websocket
+                        if televerser is True:
+                            televerser = False
+                            await televerser_journal(self.__appareil.chiffrage_messages, self.__emetteur,
+                                                     self.__appareil.journal_lectures, self.__buffer)
                         print("debut ws poll")
                         await self._poll()
                         print("fin ws poll OK")
                         # Reset erreurs
                         self.__nie_count = 0
                         self.__memory_error = 0
+                    except MessageTooBig as e:
+                        # Message lu et ignore, la connexion reste ouverte. Reconnecter referait le warm-up
+                        # et recevrait la meme reponse trop grosse en boucle.
+                        print("Message websocket plus gros que le buffer (%s bytes), ignore" % str(e))
+                    except ConnectionClosed:
+                        print("Connexion websocket fermee (EOF)")
+                        self.__nie_count += 1
+                        break  # Break inner loop
                     except NotImplementedError as e:
                         self.__nie_count += 1
                         print("Erreur websocket (NotImplementedError %s)" % str(e))
@@ -442,17 +595,15 @@ class PollingThread:
 
             finally:
                 self.__appareil.reset_websocket_pret()
-                print("Close websocket")
+                if self.__emetteur is not None:
+                    self.__emetteur.arreter()
+                    self.__emetteur = None
+                print("Close websocket (deflate %s, emission %s, etat %s %s, config %s %s)" % (
+                    STATS_DEFLATE, STATS_EMISSION, STATS_ETAT, taux_heure(STATS_ETAT, ('emis', 'octets')),
+                    STATS_CONFIG, taux_heure(STATS_CONFIG, ('ouvertures', 'cache'))))
                 mem_info()
-                try:
-                    self.__websocket.close()
-                except AttributeError:
-                    pass  # Websocket est None
-                except OSError as e:
-                    if e.errno == -104:
-                        pass  # Erreur frame fermeture - OK
-                    else:
-                        raise e
+                if self.__websocket is not None:
+                    await self.__websocket.fermer()  # Frame CLOSE au mieux, erreurs d'ecriture ignorees
                 self.__websocket = None
                 collect()
                 print("Collect")
@@ -460,6 +611,10 @@ class PollingThread:
                 print("--- Socket closed --- ")
             
     async def _poll(self):
+        echeance_ms = None
+        if self.__refresh_step == 1:
+            # Warm-up en attente du canal chiffre : revenir a _refresh_config sans attendre un cycle de poll
+            echeance_ms = time.ticks_add(self.__debut_secret, CONST_ATTENTE_SECRET_MS)
         try:
             reponse = await poll(
                 self.__appareil,
@@ -468,6 +623,9 @@ class PollingThread:
                 self.__buffer,
                 self.__timeout_http,
                 self.__appareil.get_etat,
+                self.__emetteur,
+                self.__appareil.filtre_etat,
+                echeance_ms,
             )
             
             await asyncio.sleep_ms(1)  # Yield
@@ -503,14 +661,14 @@ class PollingThread:
 
                             # Dechiffrer le message
                             try:
-                                reponse = self.__appareil.chiffrage_messages.dechiffrer(message_chiffre)
+                                reponse = self.__appareil.chiffrage_messages.dechiffrer(message_chiffre, self.__buffer)
                             except Exception as e:
                                 print('err Desactiver chiffrage : %s' % e)
                                 self.__appareil.chiffrage_messages.clear()
                                 raise e  # Fallback sur message signe
 
                             print("message websocket dechiffre OK")
-                            # Le message dechiffre est en bytes, charger avec json
+                            # Le message dechiffre est dans le buffer (memoryview), charger avec json
                             reponse = loads(reponse)
 
                             # On peut se fier au message dechiffre sans valider le reste du contenu
@@ -523,7 +681,8 @@ class PollingThread:
                         # Cleanup
                         await asyncio.sleep_ms(2)  # Yield
 
-                        await traiter_commande(self.__buffer, self.__websocket, self.__appareil, reponse, info_certificat)
+                        await traiter_commande(self.__buffer, self.__emetteur, self.__appareil, reponse, info_certificat)
+                        self._correler_reponse(get_action(reponse))
                     except KeyError as e:
                         print("Erreur reception KeyError %s" % str(e))
                         print("ERR Message\n%s" % reponse)
@@ -548,7 +707,7 @@ class PollingThread:
 
         chiffrage_messages = self.__appareil.chiffrage_messages
         if chiffrage_messages.doit_renouveler_secret() is False:
-            return
+            return False
 
         cle_publique = chiffrage_messages.generer_cle()
         message = {'peer': cle_publique, 'version': CONST_VERSION}
@@ -559,9 +718,9 @@ class PollingThread:
                                           domaine=CONST_DOMAINE_SENSEURSPASSIFS_RELAI,
                                           action=CONST_COMMANDE_ECHANGE_CLES,
                                           buffer=self.__buffer, ajouter_certificat=True)
-        self.__buffer.clear()
-        dump(requete, self.__buffer)
+        ecrire_message(requete, self.__buffer)
         requete = None
         await asyncio.sleep_ms(1)  # Yield
 
-        self.__websocket.send(self.__buffer.get_data())
+        await self.__emetteur.emettre(self.__buffer.get_data())
+        return True
@@ -1,14 +1,33 @@
 import binascii
+import json
 import oryx_crypto
 import time
 import machine
-from gc import collect
+from gc import collect, mem_alloc
 from micropython import mem_info
 
 from millegrilles.certificat import split_pem, calculer_fingerprint, valider_certificats, \
-     entretien_certificat, charger_cle_privee, charger_cle_publique, generer_cle_secrete, rnd_bytes
+     entretien_certificat, charger_cle_privee, charger_cle_publique, generer_cle_secrete, rnd_bytes, CACHE_STATS, \
+     IDENTITE_LOCALE
 from millegrilles.mgmessages import BufferMessage, signer_message_2023_5, verifier_signature_2023_5, \
-     hacher_message_2023_5, verifier_message, formatter_message
+     hacher_message_2023_5, verifier_message, formatter_message, message_stringify
+from millegrilles.mgthreads import EXECUTEUR_CRYPTO, MesureLagAsyncio
+
+import uasyncio as asyncio
+
+from uwebsockets.protocol import Websocket, MessageTooBig, OP_TEXT, OP_BYTES, OP_CONT, OP_PING
+from millegrilles.websocket_messages import poll, STATS_POLL
+from millegrilles.contexte_tls import STATS_TLS
+from millegrilles.config import get_relais, noter_relai, ordonner_relais, get_scores_relais
+from millegrilles.attente_socket import connect
+from millegrilles.course_relais import course_relais, STATS_COURSE
+from millegrilles.journal_lectures import JournalLectures, STATS_JOURNAL
+from millegrilles.file_emission import FileEmission, STATS_EMISSION, PRIORITE_REPONSE, PRIORITE_ETAT, PRIORITE_REQUETE
+from millegrilles.urequests2 import STATS_HTTP, STATS_POOL, fermer_connexions
+from millegrilles import urequests2
+from millegrilles.filtre_etat import FiltreEtat, CONST_SILENCE_MAX_S, CONST_INTERVALLE_MIN_S
+
+from io import IOBase
 
 
 def afficher_info():
@@ -57,6 +76,7 @@ async def test_valider_certificat():
     enveloppe_certificat = await valider_certificats(certificat, is_der=True, fingerprint=fingerprint)
     print("test_valider_certificat Certificat cache certificat %d" % time.ticks_diff(time.ticks_ms(), ticks_debut))
     print('Enveloppe cache? %s' % enveloppe_certificat)
+    print('Cache stats %s' % CACHE_STATS)
     
     await entretien_certificat()
     fingerprint = enveloppe_certificat['fingerprint']
@@ -66,6 +86,7 @@ async def test_valider_certificat():
     enveloppe_certificat = await valider_certificats(certificat, is_der=True, fingerprint=fingerprint)
     print("test_valider_certificat Certificat cache certificat %d" % time.ticks_diff(time.ticks_ms(), ticks_debut))
     print('Enveloppe cache? %s' % enveloppe_certificat)
+    print('Cache stats %s' % CACHE_STATS)
 
 
 async def signer_message():
@@ -78,7 +99,7 @@ async def signer_message():
     cle_publique = 'b92eafcce1d99315556ba552190a03f3541155c546b3ca858bcac5c9f71fa6ab'
     
     try:
-        verifier_signature_2023_5(id_message, signature, cle_publique)
+        await verifier_signature_2023_5(id_message, signature, cle_publique)
         print("Resultat verification signature : OK")
     except:
         print("Resultat verification signature : ECHEC")
@@ -159,6 +180,695 @@ def chiffrage_chacha20poly1305():
     print("resultat dechiffrage plaintext : %s" % buf_message.decode('utf-8'))
     
 
+ETAT_BENCH = {
+    'lectures_senseurs': {
+        'dht/p28/temperature': {'valeur': 21.4, 'timestamp': 1700000000, 'type': 'temperature'},
+        'dht/p28/humidite': {'valeur': 45.1, 'timestamp': 1700000000, 'type': 'humidite'},
+        'bmp/p8/pression': {'valeur': 1013.2, 'timestamp': 1700000000, 'type': 'pression'},
+        'rp2pico/temperature': {'valeur': 27.9, 'timestamp': 1700000000, 'type': 'temperature'},
+        'switch/p17': {'valeur': 1, 'timestamp': 1700000000, 'type': 'switch'},
+    },
+    'displays': [{'name': 'lcd1602', 'format': 'text', 'width': 16, 'height': 2}],
+    'senseurs': ['z2i3Xjx9wYAqZ5zkk4kZkGSEsWcNHQp:dht/p28/temperature'],
+    'http_timeout': 60,
+}
+
+
+def bench_buffer_message():
+    print('\n********************\nbench_buffer_message()\n')
+    contenu = json.dumps(ETAT_BENCH)
+    taille = len(contenu)
+    buffer = BufferMessage()
+    nb_iterations = 20
+
+    # Ancienne implementation : un encode('utf-8') par caractere
+    debut = time.ticks_us()
+    for _ in range(0, nb_iterations):
+        buffer.clear()
+        for c in contenu:
+            buffer.write(c.encode('utf-8'))
+    duree_caractere = time.ticks_diff(time.ticks_us(), debut)
+
+    debut = time.ticks_us()
+    for _ in range(0, nb_iterations):
+        buffer.clear()
+        buffer.write(contenu)
+    duree_bloc = time.ticks_diff(time.ticks_us(), debut)
+
+    debut = time.ticks_us()
+    for _ in range(0, nb_iterations):
+        buffer.clear()
+        json.dump(ETAT_BENCH, buffer)
+    duree_dump = time.ticks_diff(time.ticks_us(), debut)
+
+    total = taille * nb_iterations * 1_000_000
+    print("bench_buffer_message etat %d bytes" % taille)
+    print("par caractere : %d bytes/sec" % (total // max(duree_caractere, 1)))
+    print("en bloc : %d bytes/sec" % (total // max(duree_bloc, 1)))
+    print("json.dump : %d bytes/sec" % (total // max(duree_dump, 1)))
+
+
+async def test_json_canonique():
+    print('\n********************\ntest_json_canonique()\n')
+    buffer = BufferMessage()
+
+    # Message reel enregistre : le id doit correspondre au hachage recalcule
+    message = MESSAGE_TEST.copy()
+    del message['certificat']
+    id_calcule = await hacher_message_2023_5(message)
+    print("Message enregistre id OK : %s" % (id_calcule == MESSAGE_TEST['id']))
+
+    for valeur, attendu in JSON_CANONIQUE_ATTENDU:
+        resultat = bytes(message_stringify(valeur, buffer))
+        print("Canonique OK : %s (%s)" % (resultat == attendu, resultat))
+
+
+def bench_json_canonique():
+    print('\n********************\nbench_json_canonique()\n')
+    buffer = BufferMessage()
+
+    collect()
+    debut_alloc = mem_alloc()
+    debut = time.ticks_us()
+    message_stringify(ETAT_BENCH, buffer)
+    duree = time.ticks_diff(time.ticks_us(), debut)
+    print("json canonique : %d us, %d bytes alloues" % (duree, mem_alloc() - debut_alloc))
+
+    collect()
+    debut_alloc = mem_alloc()
+    debut = time.ticks_us()
+    buffer.clear()
+    json.dump(ETAT_BENCH, buffer, separators=(',', ':'))
+    duree = time.ticks_diff(time.ticks_us(), debut)
+    print("json.dump (non trie) : %d us, %d bytes alloues" % (duree, mem_alloc() - debut_alloc))
+
+
+async def bench_lag_crypto():
+    print('\n********************\nbench_lag_crypto()\n')
+    id_message = '00112233445566778899aabbccddeeff00112233445566778899aabbccddeeff'
+    cle_publique = IDENTITE_LOCALE.pubkey
+
+    for actif in (False, True):
+        EXECUTEUR_CRYPTO.actif = actif
+        mesure = MesureLagAsyncio()
+        task_mesure = asyncio.create_task(mesure.run())
+        await asyncio.sleep_ms(50)
+        mesure.reset()
+        for _ in range(5):
+            signature = await signer_message_2023_5(id_message)
+            await verifier_signature_2023_5(id_message, signature, cle_publique)
+        mesure.stop()
+        await task_mesure
+        print("Crypto core1 %s : lag asyncio max %d ms, moyen %d ms (%d mesures)" % (
+            actif, mesure.lag_max, mesure.lag_moyen, mesure.nb_mesures))
+
+    EXECUTEUR_CRYPTO.actif = True
+
+
+class SocketNulle:
+    """ Socket qui ignore les donnees (mesure du cout de framing/masquage seulement) """
+
+    def write(self, data):
+        return len(data)
+
+
+def bench_websocket_send():
+    print('\n********************\nbench_websocket_send()\n')
+    websocket = Websocket(SocketNulle())
+    websocket.is_client = True  # Masquage actif
+    buffer = BufferMessage(16*1024)
+
+    for taille in (1024, 8*1024, 16*1024):
+        buffer.set_len(taille)
+        data = buffer.get_data()
+        collect()
+        debut = time.ticks_us()
+        for _ in range(10):
+            websocket.send(data)
+        duree = time.ticks_diff(time.ticks_us(), debut) // 10
+        print("websocket send %d bytes : %d us (%d KB/s)" % (taille, duree, taille * 1000 // max(duree, 1)))
+
+
+class SocketFragments:
+    """ Socket de remplacement qui sert des frames serveur (non masquees) fragmentees. """
+
+    def __init__(self, frames):
+        self.__data = bytearray()
+        for fin, opcode, payload in frames:
+            self.__data.extend(bytes([(0x80 if fin else 0) | opcode]))
+            if len(payload) < 126:
+                self.__data.extend(bytes([len(payload)]))
+            else:
+                self.__data.extend(bytes([126, len(payload) >> 8, len(payload) & 0xff]))
+            self.__data.extend(payload)
+        self.__position = 0
+        self.ecrit = bytearray()
+
+    def read(self, taille):
+        data = self.__data[self.__position:self.__position+taille]
+        self.__position += len(data)
+        return bytes(data)
+
+    def readinto(self, buf):
+        # Lectures partielles (max 100 bytes) pour simuler le reseau
+        taille = min(len(buf), 100, len(self.__data) - self.__position)
+        buf[:taille] = self.__data[self.__position:self.__position+taille]
+        self.__position += taille
+        return taille
+
+    def write(self, data):
+        self.ecrit.extend(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+async def test_websocket_fragments():
+    print('\n********************\ntest_websocket_fragments()\n')
+    message = json.dumps({'contenu': 'x' * 600}).encode('utf-8')
+    frames = [
+        (False, OP_BYTES, message[:200]),
+        (True, OP_PING, b'ping'),  # Frame de controle entre les fragments
+        (False, OP_CONT, message[200:450]),
+        (True, OP_CONT, message[450:]),
+    ]
+
+    buffer = BufferMessage(1024)
+    websocket = Websocket(SocketFragments(frames))
+    reponse = await websocket.recv(buffer.buffer)
+    print("Reassemblage OK : %s (%d bytes)" % (bytes(reponse) == message, len(reponse)))
+
+    # Message trop gros pour le buffer : ignore, le message suivant est recu sur la meme connexion
+    buffer = BufferMessage(512)
+    websocket = Websocket(SocketFragments(frames + [(True, OP_TEXT, b'suivant')]))
+    try:
+        await websocket.recv(buffer.buffer)
+        print("Message trop gros : ECHEC (aucune erreur)")
+    except MessageTooBig:
+        reponse = await websocket.recv(buffer.buffer)
+        print("Message trop gros : OK, ignore, message suivant %s, ouvert %s" % (reponse == 'suivant', websocket.open))
+
+
+class RelaiLocal(IOBase):
+    """
+    Relai de remplacement : une frame de commande devient disponible apres delai_ms.
+    Supporte le poll (ioctl) pour le reveil uasyncio.
+    """
+
+    def __init__(self, frame, delai_ms):
+        super().__init__()
+        self.__frame = frame
+        self.__position = 0
+        self.heure_pret = time.ticks_add(time.ticks_ms(), delai_ms)
+
+    def __pret(self):
+        return time.ticks_diff(time.ticks_ms(), self.heure_pret) >= 0 and self.__position < len(self.__frame)
+
+    def read(self, taille):
+        if not self.__pret():
+            return None
+        data = self.__frame[self.__position:self.__position+taille]
+        self.__position += len(data)
+        return data
+
+    def readinto(self, buf):
+        if not self.__pret():
+            return None
+        taille = min(len(buf), len(self.__frame) - self.__position)
+        buf[:taille] = self.__frame[self.__position:self.__position+taille]
+        self.__position += taille
+        return taille
+
+    def write(self, data):
+        return len(data)
+
+    def ioctl(self, req, arg):
+        if req == 3:  # MP_STREAM_POLL
+            reponse = arg & 0x0004  # POLLOUT
+            if arg & 0x0001 and self.__pret():
+                reponse |= 0x0001  # POLLIN
+            return reponse
+        return 0
+
+    def close(self):
+        pass
+
+
+async def bench_reception_commande():
+    print('\n********************\nbench_reception_commande()\n')
+    commande = json.dumps({'routage': {'action': 'setSwitchValue'}, 'contenu': {'valeur': 1}}).encode('utf-8')
+    frame = bytes([0x80 | OP_BYTES, len(commande)]) + commande
+
+    for delai_ms in (500, 1000, 2000):
+        relai = RelaiLocal(frame, delai_ms)
+        websocket = Websocket(relai)
+        STATS_POLL['cycles'] = 0
+        # Aucune emission d'etat avant 2.5 secs, appareil non requis
+        reponse = await poll(None, websocket, asyncio.Event(), BufferMessage(), timeout_http=5)
+        latence = time.ticks_diff(time.ticks_ms(), relai.heure_pret)
+        print("Commande recue apres %d ms : latence %d ms, cycles poll %d, reveils socket %d, OK %s" % (
+            delai_ms, latence, STATS_POLL['cycles'], websocket.nb_reveils, bytes(reponse) == commande))
+
+
+async def bench_reconnexion_tls():
+    print('\n********************\nbench_reconnexion_tls()\n')
+    url_connexion = get_relais()[0].replace('https://', 'wss://') + '/ws'
+
+    # Handshake complet a chaque connexion (aucune reprise de session), SSLContext partage
+    for essai in range(0, 3):
+        collect()
+        debut_alloc = mem_alloc()
+        debut = time.ticks_ms()
+        websocket = await connect(url_connexion)
+        duree = time.ticks_diff(time.ticks_ms(), debut)
+        pic_alloc = mem_alloc() - debut_alloc
+        websocket.close()
+        print("Connexion %d : %d ms, heap +%d bytes, stats %s" % (essai, duree, pic_alloc, STATS_TLS))
+
+
+async def relai_upgrade(reader, writer):
+    """ Relai de remplacement : repond 101 a l'upgrade websocket puis ferme. """
+    while True:
+        ligne = await reader.readline()
+        if not ligne or ligne == b'\r\n':
+            break
+    writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n\r\n')
+    await writer.drain()
+    await asyncio.sleep(1)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def relai_ferme(reader, writer):
+    """ Relai en panne : accepte la connexion TCP puis ferme sans repondre a l'upgrade. """
+    writer.close()
+    await writer.wait_closed()
+
+
+async def test_course_relais():
+    print('\n********************\ntest_course_relais()\n')
+    from network import WLAN, STA_IF
+    adresse = WLAN(STA_IF).ifconfig()[0]
+    serveurs = [await asyncio.start_server(relai_upgrade, adresse, port) for port in (8501, 8502)]
+    serveurs.append(await asyncio.start_server(relai_ferme, adresse, 8503))
+
+    url_injoignable = 'ws://10.255.255.1:8500/ws'  # Aucune reponse au SYN (timeout TCP complet si sequentiel)
+    url_refuse = 'ws://%s:8509/ws' % adresse  # Aucun serveur sur le port (RST)
+    scenarios = (
+        ('premier relai injoignable', [url_injoignable, 'ws://%s:8501/ws' % adresse, 'ws://%s:8502/ws' % adresse]),
+        ('premier relai refuse', [url_refuse, 'ws://%s:8501/ws' % adresse]),
+        ('deux relais injoignables', [url_injoignable, 'ws://10.255.255.2:8500/ws', 'ws://%s:8502/ws' % adresse]),
+        # Gagnant TCP en echec au handshake : la course reprend avec les relais restants
+        ('premier relai en panne', ['ws://%s:8503/ws' % adresse, 'ws://%s:8501/ws' % adresse]),
+    )
+
+    try:
+        for nom, urls in scenarios:
+            collect()
+            debut_alloc = mem_alloc()
+            url, websocket = await course_relais(urls)
+            websocket.close()
+            print("%s : connecte a %s en %d ms, tentatives %d, echecs %d, heap +%d bytes" % (
+                nom, url, STATS_COURSE['duree_ms'], STATS_COURSE['tentatives'], STATS_COURSE['echecs'],
+                mem_alloc() - debut_alloc))
+    finally:
+        for serveur in serveurs:
+            serveur.close()
+            await serveur.wait_closed()
+
+
+def test_scores_relais():
+    print('\n********************\ntest_scores_relais()\n')
+    # Scores en memoire seulement (sauvegarder_scores_relais non appele)
+    relai_lent, relai_rapide, relai_echec, relai_inconnu = (
+        'https://test-lent:443/r', 'https://test-rapide:443/r', 'https://test-echec:443/r', 'https://test-inconnu:443/r')
+    noter_relai(relai_lent, 900)
+    noter_relai(relai_rapide, 150)
+    noter_relai(relai_echec, 100)
+    noter_relai(relai_echec)
+    ordre = ordonner_relais([relai_echec, relai_inconnu, relai_lent, relai_rapide])
+    print("Ordre %s : OK %s" % (ordre, ordre == [relai_rapide, relai_lent, relai_inconnu, relai_echec]))
+    for relai in (relai_lent, relai_rapide, relai_echec):
+        del get_scores_relais()[relai]
+
+
+async def bench_file_emission():
+    print('\n********************\nbench_file_emission()\n')
+    websocket = Websocket(RelaiLocal(b'', 0))
+    emetteur = FileEmission(websocket)
+    emetteur.demarrer()
+    buffer = BufferMessage()
+    requete = b'{"routage":{"action":"getAppareilDisplayConfiguration"}}' * 20
+
+    # Rafale : requetes de configuration, etats consecutifs (fusionnes) et confirmation prioritaire
+    debut = time.ticks_ms()
+    for i in range(0, 5):
+        buffer.set_bytes(requete)
+        await emetteur.emettre(buffer.get_data(), PRIORITE_REQUETE)
+        buffer.set_text('{"lectures_senseurs":{},"sequence":%d}' % i)
+        await emetteur.emettre(buffer.get_data(), PRIORITE_ETAT)
+    buffer.set_text('{"fingerprint":"abcd"}')
+    await emetteur.emettre(buffer.get_data(), PRIORITE_REPONSE)
+    while STATS_EMISSION['profondeur'] > 0:
+        await asyncio.sleep_ms(1)
+    duree = time.ticks_diff(time.ticks_ms(), debut)
+    emetteur.arreter()
+    print("Rafale emise en %d ms : %s" % (duree, STATS_EMISSION))
+
+
+async def test_journal_lectures(heures=6):
+    print('\n********************\ntest_journal_lectures()\n')
+    import os
+    from millegrilles.websocket_messages import televerser_journal
+    from millegrilles.chiffrage import ChiffrageMessages
+    for fichier in ('test_lectures.jrn', 'test_lectures_senseurs.json'):
+        try:
+            os.remove(fichier)
+        except OSError:
+            pass
+    journal = JournalLectures('test_lectures.jrn', 'test_lectures_senseurs.json')
+
+    # Panne de plusieurs heures : 4 senseurs lus aux 20 secondes (cadence DeviceHandler)
+    collect()
+    debut_alloc = mem_alloc()
+    ts = time.time()
+    debut = time.ticks_ms()
+    for i in range(0, heures * 180):
+        ts += 20
+        journal.ajouter({
+            'dht/p17/temperature': {'valeur': 20 + (i % 50) / 10, 'type': 'temperature', 'timestamp': ts},
+            'dht/p17/humidite': {'valeur': 45.5, 'type': 'humidite', 'timestamp': ts},
+            'bmp/p2/pression': {'valeur': 1013.2, 'type': 'pression', 'timestamp': ts},
+            'bmp/p2/temperature': {'valeur': 21.25, 'type': 'temperature', 'timestamp': ts},
+            'rp2picow/wifi': {'valeur_str': 'ip', 'timestamp': ts},
+        })
+    print("Panne %d h : %d enregistrements en %d ms, heap +%d bytes, %s" % (
+        heures, journal.nombre, time.ticks_diff(time.ticks_ms(), debut), mem_alloc() - debut_alloc, STATS_JOURNAL))
+
+    # Reconnexion : televersement par lots chiffres vers un relai local
+    chiffrage_messages = ChiffrageMessages()
+    chiffrage_messages.generer_cle()
+    cle_relai = binascii.hexlify(oryx_crypto.x25519generatepubkey(rnd_bytes(32))).decode('utf-8')
+    await chiffrage_messages.calculer_secret_exchange(cle_relai, charger_info_app=False)
+    websocket = Websocket(RelaiLocal(b'', 0))
+    emetteur = FileEmission(websocket)
+    emetteur.demarrer()
+    debut = time.ticks_ms()
+    await televerser_journal(chiffrage_messages, emetteur, journal, BufferMessage(16*1024))
+    while STATS_EMISSION['profondeur'] > 0:
+        await asyncio.sleep_ms(1)
+    emetteur.arreter()
+    print("Televersement %d ms, restant %d, emission %s" % (
+        time.ticks_diff(time.ticks_ms(), debut), journal.nombre, STATS_EMISSION))
+
+
+def bench_emission_etat(heures=1, timeout_http=60):
+    print('\n********************\nbench_emission_etat()\n')
+    import random
+    filtre = FiltreEtat()
+    silence_max = min(CONST_SILENCE_MAX_S, timeout_http)
+
+    # Avant : etat emis a chaque cycle de poll (timeout_http). Apres : deadbands, battement et limite de frequence.
+    # Lectures aux 20 secondes (cadence DeviceHandler) avec bruit de mesure, temps simule.
+    messages_avant, octets_avant = 0, 0
+    messages_apres, octets_apres = 0, 0
+    derniere_emission = None
+    temperature, humidite = 20.0, 45.0
+    debut = time.ticks_ms()
+    for t in range(0, heures * 3600, 20):
+        temperature += random.choice((-0.1, 0.0, 0.0, 0.1))
+        humidite += random.choice((-0.5, 0.0, 0.0, 0.5))
+        lectures = {
+            'dht/p17/temperature': {'valeur': round(temperature, 1), 'type': 'temperature', 'timestamp': t},
+            'dht/p17/humidite': {'valeur': round(humidite, 1), 'type': 'humidite', 'timestamp': t},
+            'bmp/p2/pression': {'valeur': 1013.2 + random.choice((-0.1, 0.0, 0.1)), 'type': 'pression', 'timestamp': t},
+            'switch_p18/switch': {'valeur': 1 if t % 1800 < 900 else 0, 'type': 'switch', 'timestamp': t},
+            'rp2picow/wifi': {'valeur_str': '192.168.2.10', 'type': 'ip', 'timestamp': t},
+        }
+        taille = len(json.dumps({'lectures_senseurs': lectures, 'http_timeout': timeout_http}))
+
+        if t % timeout_http == 0:
+            messages_avant += 1
+            octets_avant += taille
+
+        if derniere_emission is None or t - derniere_emission >= silence_max or \
+                (t - derniere_emission >= CONST_INTERVALLE_MIN_S and filtre.changement(lectures)):
+            filtre.marquer_emis(lectures, taille)
+            derniere_emission = t
+            messages_apres += 1
+            octets_apres += taille
+
+    print("Simulation %d h en %d ms" % (heures, time.ticks_diff(time.ticks_ms(), debut)))
+    print("Avant : %d messages/h, %d bytes/h" % (messages_avant // heures, octets_avant // heures))
+    print("Apres : %d messages/h, %d bytes/h" % (messages_apres // heures, octets_apres // heures))
+
+
+FICHE_LOCALE = b'{"id": "fiche", "contenu": "%s"}' % (b'x' * 6000)
+
+
+async def fiche_locale(reader, writer):
+    """ Serveur http de remplacement : sert FICHE_LOCALE, chunked si le path est /chunked. """
+    requete = await reader.readline()
+    while True:
+        ligne = await reader.readline()
+        if not ligne or ligne == b'\r\n':
+            break
+    if b'/chunked' in requete:
+        writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+        for i in range(0, len(FICHE_LOCALE), 1000):
+            morceau = FICHE_LOCALE[i:i+1000]
+            writer.write(b'%x\r\n' % len(morceau) + morceau + b'\r\n')
+            await writer.drain()
+            await asyncio.sleep_ms(20)
+        writer.write(b'0\r\n\r\n')
+    else:
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n' % len(FICHE_LOCALE))
+        writer.write(FICHE_LOCALE)
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+
+async def bench_urequests2():
+    print('\n********************\nbench_urequests2()\n')
+    from network import WLAN, STA_IF
+    adresse = WLAN(STA_IF).ifconfig()[0]
+    serveur = await asyncio.start_server(fiche_locale, adresse, 8510)  # Meme boucle : urequests bloquant exclu
+    buffer = BufferMessage(8*1024)
+    mesure = MesureLagAsyncio()
+    tache_mesure = asyncio.create_task(mesure.run())
+    try:
+        # Avant : corps complet en memoire (content) puis copie dans le buffer. Apres : lu directement dans le buffer.
+        for path, direct in (('fiche.json', False), ('fiche.json', True), ('chunked', True)):
+            collect()
+            mesure.reset()
+            debut_alloc = mem_alloc()
+            debut = time.ticks_ms()
+            reponse = await urequests2.get('http://%s:8510/%s' % (adresse, path))
+            if direct is True:
+                await reponse.lire_into(buffer)
+            else:
+                buffer.set_bytes(await reponse.content())
+            print("%s (direct:%s) : %d bytes en %d ms (ttfb %d ms), heap +%d bytes, lag asyncio max %d ms" % (
+                path, direct, len(buffer), time.ticks_diff(time.ticks_ms(), debut), STATS_HTTP['ttfb_ms'],
+                mem_alloc() - debut_alloc, mesure.lag_max))
+            reponse = None
+    finally:
+        mesure.stop()
+        await tache_mesure
+        serveur.close()
+        await serveur.wait_closed()
+
+
+async def relai_http_keepalive(reader, writer):
+    """ Serveur http de remplacement HTTP/1.1 : repond a plusieurs requetes sur la meme connexion. """
+    while True:
+        requete = await reader.readline()
+        if not requete:
+            break
+        taille = 0
+        while True:
+            ligne = await reader.readline()
+            if not ligne or ligne == b'\r\n':
+                break
+            if ligne.lower().startswith(b'content-length:'):
+                taille = int(ligne[15:].strip())
+        if taille > 0:
+            await reader.readexactly(taille)
+        corps = b'{"ok": true}'
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(corps) + corps)
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+
+async def bench_pool_http():
+    print('\n********************\nbench_pool_http()\n')
+    from network import WLAN, STA_IF
+    adresse = WLAN(STA_IF).ifconfig()[0]
+    serveur = await asyncio.start_server(relai_http_keepalive, adresse, 8511)
+    url = 'http://%s:8511' % adresse
+    buffer = BufferMessage(1024)
+    # Sequence d'inscription : /inscrire, attente du certificat signe, /renouveler, fiche.json
+    sequence = (('POST', '/inscrire'), ('POST', '/inscrire'), ('POST', '/renouveler'), ('GET', '/fiche.json'))
+    try:
+        for keep_alive in (False, True):
+            fermer_connexions()
+            STATS_POOL['nouvelles'] = STATS_POOL['reutilisations'] = STATS_POOL['economie_ms'] = 0
+            debut = time.ticks_ms()
+            for methode, path in sequence:
+                reponse = await urequests2.request(methode, url + path, data=b'{}', keep_alive=keep_alive)
+                await reponse.lire_into(buffer)
+                print("%s %s : ttfb %d ms, connexion %d ms" % (methode, path, STATS_HTTP['ttfb_ms'], STATS_HTTP['connexion_ms']))
+            print("keep_alive %s : sequence en %d ms, pool %s" % (keep_alive, time.ticks_diff(time.ticks_ms(), debut), STATS_POOL))
+    finally:
+        fermer_connexions()
+        serveur.close()
+        await serveur.wait_closed()
+
+
+async def bench_cache_fiche(nb_refresh=3):
+    print('\n********************\nbench_cache_fiche()\n')
+    import os
+    from millegrilles.message_inscription import charger_fiche, STATS_FICHE
+    from millegrilles.constantes import CONST_PATH_FICHE, CONST_PATH_FICHE_META
+    for fichier in (CONST_PATH_FICHE, CONST_PATH_FICHE_META):
+        try:
+            os.remove(fichier)
+        except OSError:
+            pass
+    buffer = BufferMessage(16*1024)
+
+    # Premier chargement : telechargement complet et verification. Suivants : 304 (ETag) et verification evitee.
+    # Relais configures (relais.json), la fiche est servie par le serveur web du relai.
+    for i in range(0, nb_refresh + 1):
+        collect()
+        debut = time.ticks_ms()
+        fiche, certificat = await charger_fiche(buffer=buffer)
+        print("Refresh %d : %d ms, %d relais, %s" % (
+            i, time.ticks_diff(time.ticks_ms(), debut), len(fiche['instances']), STATS_FICHE))
+        fiche = None
+
+    # Refresh aux heures (_CONST_INTERVALLE_REFRESH_FICHE), plus un refresh force par erreur de la boucle principale
+    if STATS_FICHE['non_modifiees'] > 0:
+        print("Economie par refresh : %d bytes, %d ms CPU (verification)" % (
+            STATS_FICHE['octets_economises'] // STATS_FICHE['non_modifiees'],
+            STATS_FICHE['cpu_economise_ms'] // max(STATS_FICHE['verifications_evitees'], 1)))
+
+
+async def serveur_dns_local(sock, adresse_ip: str, delai_ms: int):
+    """ Resolveur DNS de remplacement : repond adresse_ip (TTL 60 s) a toute requete A apres delai_ms. """
+    import struct
+    from millegrilles.attente_socket import attendre_lecture
+    while True:
+        await attendre_lecture(sock)
+        requete, client = sock.recvfrom(512)
+        await asyncio.sleep_ms(delai_ms)  # Latence du resolveur
+        reponse = bytearray(requete[:2]) + struct.pack('>HHHHH', 0x8180, 1, 1, 0, 0) + requete[12:]
+        reponse += b'\xc0\x0c' + struct.pack('>HHIH', 1, 1, 60, 4) + bytes([int(o) for o in adresse_ip.split('.')])
+        sock.sendto(reponse, client)
+
+
+async def test_resolveur_dns(hote_reel='google.com', delai_ms=200):
+    print('\n********************\ntest_resolveur_dns()\n')
+    import usocket
+    from network import WLAN, STA_IF
+    from millegrilles.resolveur_dns import resoudre, set_serveur_dns, clear_cache, CACHE_DNS, STATS_DNS
+    adresse = WLAN(STA_IF).ifconfig()[0]
+
+    mesure = MesureLagAsyncio()
+    tache_mesure = asyncio.create_task(mesure.run())
+    await asyncio.sleep_ms(50)
+
+    # Avant : getaddrinfo du firmware (bloque la boucle pendant l'aller-retour DNS)
+    mesure.reset()
+    debut = time.ticks_ms()
+    usocket.getaddrinfo(hote_reel, 443)
+    duree = time.ticks_diff(time.ticks_ms(), debut)
+    await asyncio.sleep_ms(50)
+    print("getaddrinfo %s : %d ms, blocage boucle max %d ms" % (hote_reel, duree, mesure.lag_max))
+
+    sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+    sock.bind(usocket.getaddrinfo(adresse, 5353)[0][-1])
+    sock.setblocking(False)
+    tache_serveur = asyncio.create_task(serveur_dns_local(sock, '10.1.2.3', delai_ms))
+    set_serveur_dns((adresse, 5353))
+    clear_cache()
+    try:
+        # Apres : requete UDP non-bloquante (resolveur local avec latence), puis cache
+        for essai in ('resolveur', 'cache'):
+            mesure.reset()
+            debut = time.ticks_ms()
+            ip = await resoudre('relai.test')
+            print("resoudre %s : %s en %d ms, blocage boucle max %d ms" % (
+                essai, ip, time.ticks_diff(time.ticks_ms(), debut), mesure.lag_max))
+
+        # Resolveur injoignable, entree expiree : derniere adresse connue
+        tache_serveur.cancel()
+        CACHE_DNS['relai.test'][0] = 0
+        mesure.reset()
+        debut = time.ticks_ms()
+        ip = await resoudre('relai.test')
+        print("resoudre repli : %s en %d ms, blocage boucle max %d ms, stats %s" % (
+            ip, time.ticks_diff(time.ticks_ms(), debut), mesure.lag_max, STATS_DNS))
+    finally:
+        tache_serveur.cancel()
+        sock.close()
+        set_serveur_dns(None)
+        clear_cache()
+        mesure.stop()
+        await tache_mesure
+
+
+def bench_config_store(secondes=3600):
+    print('\n********************\nbench_config_store()\n')
+    import os
+    from millegrilles.config_store import ConfigStore, STATS_CONFIG
+    chemin_tz, chemin_display = 'test_tzoffset.json', 'test_displays.json'
+    with open(chemin_tz, 'wb') as fichier:
+        json.dump({'offset': -14400, 'timezone': 'America/Toronto'}, fichier)
+    with open(chemin_display, 'wb') as fichier:
+        json.dump({'ssd1306': {'lignes': [{'variable': 'dht/p17/temperature', 'masque': 'T {:.1f}C'}] * 4}}, fichier)
+
+    # Acces simules : display (offset et configuration) chaque seconde, horaire chaque minute.
+    # Avant : un open() sur flash par acces. Apres : ConfigStore, ecriture (write-through) a chaque heure.
+    try:
+        ouvertures_avant = 0
+        debut = time.ticks_ms()
+        for t in range(0, secondes):
+            for chemin in (chemin_tz, chemin_display):
+                with open(chemin, 'rb') as fichier:
+                    json.load(fichier)
+                ouvertures_avant += 1
+            if t % 60 == 0:
+                with open(chemin_tz, 'rb') as fichier:
+                    json.load(fichier)
+                ouvertures_avant += 1
+        duree_avant = time.ticks_diff(time.ticks_ms(), debut)
+
+        store = ConfigStore()
+        ouvertures_debut = STATS_CONFIG['ouvertures']
+        debut = time.ticks_ms()
+        for t in range(0, secondes):
+            offset = store.lire(chemin_tz)['offset']
+            store.lire(chemin_display)
+            if t % 60 == 0:
+                store.lire(chemin_tz)
+            if t % 3600 == 3599:
+                store.ecrire(chemin_tz, {'offset': offset, 'timezone': 'America/Toronto'})
+        duree_apres = time.ticks_diff(time.ticks_ms(), debut)
+        ouvertures_apres = STATS_CONFIG['ouvertures'] - ouvertures_debut
+        assert store.lire(chemin_tz)['offset'] == -14400
+
+        heures = max(secondes // 3600, 1)
+        print("Avant : %d ouvertures flash/h, %d ms" % (ouvertures_avant // heures, duree_avant))
+        print("Apres : %d ouvertures flash/h, %d ms, stats %s" % (ouvertures_apres // heures, duree_apres, STATS_CONFIG))
+    finally:
+        os.remove(chemin_tz)
+        os.remove(chemin_display)
+
+
 async def run_tests():
     # print("Delai demarrage - 3 secs")
     afficher_info()
@@ -175,6 +885,24 @@ async def run_tests():
     # await test_verifier_message()
     # charger_userid_local()
     chiffrage_chacha20poly1305()
+    # bench_buffer_message()
+    # await test_json_canonique()
+    # bench_json_canonique()
+    # await bench_lag_crypto()
+    # bench_websocket_send()
+    # await test_websocket_fragments()
+    # await bench_reception_commande()
+    # await bench_reconnexion_tls()
+    # await test_course_relais()
+    # test_scores_relais()
+    # await bench_file_emission()
+    # await test_journal_lectures()
+    # bench_emission_etat()
+    # await bench_urequests2()
+    # await bench_pool_http()
+    # await bench_cache_fiche()
+    # await test_resolveur_dns()
+    # bench_config_store()
 
 
 IDMG = "zeYncRqEqZ6eTEmUZ8whJFuHG796eSvCTWE4M432izXrp22bAtwGm7Jf"
@@ -210,6 +938,12 @@ YJfezh6rSzo51qv04rlKQSLfw9owrLbdoqyjNqetjgE9A/z7bVEH
 -----END CERTIFICATE-----
 """
 
+JSON_CANONIQUE_ATTENDU = [
+    ({'b': 2.0, 'a': [1.0, {'d': 1, 'c': 1.5, '_z': 3}], '_x': 1}, b'{"a":[1,{"c":1.5,"d":1}],"b":2}'),
+    ({'lectures_senseurs': {}, 'http_timeout': 60, 'senseurs': None}, b'{"http_timeout":60,"lectures_senseurs":{},"senseurs":null}'),
+    ({'peer': 'abcd', 'version': '2024.1.0'}, b'{"peer":"abcd","version":"2024.1.0"}'),
+]
+
 MESSAGE_TEST = {
   "id": "83b1511d7da1fb49e20ac557b8ce38dcb1d5a429a8c8e0c7bcc216e41bf7e192",
   "pubkey": "f8a8429cb16a4f03103c711c00ceb47bc7a95c0f114b9ef5ad02b31cb4e9fbb2",
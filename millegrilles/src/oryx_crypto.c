@@ -44,6 +44,74 @@ STATIC mp_obj_t python_blake2sCompute(mp_obj_t message_data_obj) {
 }
 STATIC MP_DEFINE_CONST_FUN_OBJ_1(python_blake2sCompute_obj, python_blake2sCompute);
 
+// Blake2s incremental (init/update/final)
+const mp_obj_type_t blake2sContext_type;
+
+typedef struct _blake2sContext_obj_t {
+    mp_obj_base_t base;
+    Blake2sContext context;
+} blake2sContext_obj_t;
+
+const mp_obj_type_t blake2sContext_type = {
+    { &mp_type_type },
+    .name = MP_QSTR_blake2sContext,
+};
+
+STATIC blake2sContext_obj_t *get_blake2s_context(mp_obj_t o_in) {
+    if(!mp_obj_is_type(o_in, &blake2sContext_type)) {
+        mp_raise_TypeError(OPERATION_INVALIDE);
+    }
+    return MP_OBJ_TO_PTR(o_in);
+}
+
+STATIC mp_obj_t python_blake2sInit(void) {
+    blake2sContext_obj_t *result = m_new_obj(blake2sContext_obj_t);
+    result->base.type = &blake2sContext_type;
+
+    int res = blake2sInit(&result->context, NULL, 0, DIGEST_BLAKE2S_LEN);
+    if(res != 0) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_Exception, OPERATION_INVALIDE));
+    }
+
+    return MP_OBJ_FROM_PTR(result);
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_0(python_blake2sInit_obj, python_blake2sInit);
+
+STATIC mp_obj_t python_blake2sUpdate(mp_obj_t context_obj, mp_obj_t message_data_obj) {
+    blake2sContext_obj_t *enveloppe = get_blake2s_context(context_obj);
+
+    mp_buffer_info_t message_bufinfo;
+    mp_get_buffer_raise(message_data_obj, &message_bufinfo, MP_BUFFER_READ);
+
+    blake2sUpdate(&enveloppe->context, message_bufinfo.buf, message_bufinfo.len);
+
+    return mp_const_none;
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_2(python_blake2sUpdate_obj, python_blake2sUpdate);
+
+// Copie de l'etat courant (permet de conserver un prefixe deja hache)
+STATIC mp_obj_t python_blake2sCopy(mp_obj_t context_obj) {
+    blake2sContext_obj_t *enveloppe = get_blake2s_context(context_obj);
+
+    blake2sContext_obj_t *result = m_new_obj(blake2sContext_obj_t);
+    result->base.type = &blake2sContext_type;
+    result->context = enveloppe->context;
+
+    return MP_OBJ_FROM_PTR(result);
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_1(python_blake2sCopy_obj, python_blake2sCopy);
+
+STATIC mp_obj_t python_blake2sFinal(mp_obj_t context_obj) {
+    blake2sContext_obj_t *enveloppe = get_blake2s_context(context_obj);
+
+    uint8_t digest_out[DIGEST_BLAKE2S_LEN];
+    blake2sFinal(&enveloppe->context, (uint8_t *)&digest_out);
+
+    // Return bytes obj
+    return mp_obj_new_bytes(digest_out, DIGEST_BLAKE2S_LEN);
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_1(python_blake2sFinal_obj, python_blake2sFinal);
+
 // Blake2b
 STATIC mp_obj_t python_blake2bCompute(mp_obj_t message_data_obj) {
 
@@ -774,6 +842,309 @@ STATIC mp_obj_t python_chacha20poly1305_decrypt(mp_obj_t key_obj, mp_obj_t nonce
 }
 STATIC MP_DEFINE_CONST_FUN_OBJ_3(python_chacha20poly1305_decrypt_obj, python_chacha20poly1305_decrypt);
 
+// ChaCha20Poly1305 en mode streaming (RFC 8439, sans donnees authentifiees additionnelles)
+// Permet de chiffrer un message par blocs, en place, sans copie complete du contenu.
+const mp_obj_type_t chacha20Poly1305Context_type;
+
+typedef struct _chacha20Poly1305Context_obj_t {
+    mp_obj_base_t base;
+    ChachaContext chacha_context;
+    Poly1305Context poly1305_context;
+    uint64_t length;
+} chacha20Poly1305Context_obj_t;
+
+const mp_obj_type_t chacha20Poly1305Context_type = {
+    { &mp_type_type },
+    .name = MP_QSTR_chacha20Poly1305Context,
+};
+
+STATIC chacha20Poly1305Context_obj_t *get_chacha20poly1305_context(mp_obj_t o_in) {
+    if(!mp_obj_is_type(o_in, &chacha20Poly1305Context_type)) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_Exception, OPERATION_INVALIDE));
+    }
+    return MP_OBJ_TO_PTR(o_in);
+}
+
+STATIC mp_obj_t python_chacha20poly1305_init(mp_obj_t key_obj, mp_obj_t nonce_obj) {
+    uint8_t temp[32];
+    mp_buffer_info_t key_bufinfo;
+    mp_buffer_info_t nonce_bufinfo;
+    error_t result;
+
+    mp_get_buffer_raise(key_obj, &key_bufinfo, MP_BUFFER_READ);
+    if(key_bufinfo.len != 32) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_Exception, LEN_INVALIDE));
+    }
+    mp_get_buffer_raise(nonce_obj, &nonce_bufinfo, MP_BUFFER_READ);
+    if(nonce_bufinfo.len != 12) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_Exception, LEN_INVALIDE));
+    }
+
+    chacha20Poly1305Context_obj_t *contexte = m_new_obj(chacha20Poly1305Context_obj_t);
+    contexte->base.type = &chacha20Poly1305Context_type;
+    contexte->length = 0;
+
+    result = chachaInit(&contexte->chacha_context, 20, key_bufinfo.buf, key_bufinfo.len,
+        nonce_bufinfo.buf, nonce_bufinfo.len);
+    if(result != 0) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_Exception, OPERATION_INVALIDE));
+    }
+
+    // Cle Poly1305 : premiers 32 bytes du bloc 0, le reste du bloc est ignore
+    chachaCipher(&contexte->chacha_context, NULL, temp, 32);
+    poly1305Init(&contexte->poly1305_context, temp);
+    chachaCipher(&contexte->chacha_context, NULL, temp, 32);
+
+    return MP_OBJ_FROM_PTR(contexte);
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_2(python_chacha20poly1305_init_obj, python_chacha20poly1305_init);
+
+STATIC mp_obj_t python_chacha20poly1305_update(mp_obj_t context_obj, mp_obj_t data_obj) {
+    chacha20Poly1305Context_obj_t *contexte = get_chacha20poly1305_context(context_obj);
+    mp_buffer_info_t data_bufinfo;
+    mp_get_buffer_raise(data_obj, &data_bufinfo, MP_BUFFER_RW);
+
+    // Chiffrage en place, MAC sur le ciphertext
+    chachaCipher(&contexte->chacha_context, data_bufinfo.buf, data_bufinfo.buf, data_bufinfo.len);
+    poly1305Update(&contexte->poly1305_context, data_bufinfo.buf, data_bufinfo.len);
+    contexte->length += data_bufinfo.len;
+
+    return mp_const_none;
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_2(python_chacha20poly1305_update_obj, python_chacha20poly1305_update);
+
+STATIC void chacha20poly1305_calculer_tag(chacha20Poly1305Context_obj_t *contexte, uint8_t *tag) {
+    uint8_t temp[16];
+    size_t padding_len = (16 - (size_t)(contexte->length & 0x0F)) & 0x0F;
+
+    memset(temp, 0, 16);
+    if(padding_len > 0) {
+        poly1305Update(&contexte->poly1305_context, temp, padding_len);
+    }
+    // Longueur des donnees additionnelles (0) et du ciphertext
+    STORE64LE(0, temp);
+    STORE64LE(contexte->length, temp + 8);
+    poly1305Update(&contexte->poly1305_context, temp, 16);
+    poly1305Final(&contexte->poly1305_context, tag);
+}
+
+STATIC mp_obj_t python_chacha20poly1305_final(mp_obj_t context_obj) {
+    chacha20Poly1305Context_obj_t *contexte = get_chacha20poly1305_context(context_obj);
+    uint8_t tag[16];
+    chacha20poly1305_calculer_tag(contexte, tag);
+    return mp_obj_new_bytes(tag, 16);
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_1(python_chacha20poly1305_final_obj, python_chacha20poly1305_final);
+
+// Keystream ChaCha20 brut (generateur pseudo-aleatoire, voir millegrilles.aleatoire)
+const mp_obj_type_t chacha20Context_type;
+
+typedef struct _chacha20Context_obj_t {
+    mp_obj_base_t base;
+    ChachaContext context;
+} chacha20Context_obj_t;
+
+const mp_obj_type_t chacha20Context_type = {
+    { &mp_type_type },
+    .name = MP_QSTR_chacha20Context,
+};
+
+STATIC mp_obj_t python_chacha20_init(mp_obj_t key_obj, mp_obj_t nonce_obj) {
+    mp_buffer_info_t key_bufinfo;
+    mp_buffer_info_t nonce_bufinfo;
+
+    mp_get_buffer_raise(key_obj, &key_bufinfo, MP_BUFFER_READ);
+    if(key_bufinfo.len != 32) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_Exception, LEN_INVALIDE));
+    }
+    mp_get_buffer_raise(nonce_obj, &nonce_bufinfo, MP_BUFFER_READ);
+    if(nonce_bufinfo.len != 12) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_Exception, LEN_INVALIDE));
+    }
+
+    chacha20Context_obj_t *contexte = m_new_obj(chacha20Context_obj_t);
+    contexte->base.type = &chacha20Context_type;
+    if(chachaInit(&contexte->context, 20, key_bufinfo.buf, key_bufinfo.len, nonce_bufinfo.buf, nonce_bufinfo.len) != 0) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_Exception, OPERATION_INVALIDE));
+    }
+
+    return MP_OBJ_FROM_PTR(contexte);
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_2(python_chacha20_init_obj, python_chacha20_init);
+
+STATIC mp_obj_t python_chacha20_keystream(mp_obj_t context_obj, mp_obj_t output_obj) {
+    if(!mp_obj_is_type(context_obj, &chacha20Context_type)) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_Exception, OPERATION_INVALIDE));
+    }
+    chacha20Context_obj_t *contexte = MP_OBJ_TO_PTR(context_obj);
+    mp_buffer_info_t output_bufinfo;
+    mp_get_buffer_raise(output_obj, &output_bufinfo, MP_BUFFER_WRITE);
+
+    // Input NULL : le keystream est copie directement dans output
+    chachaCipher(&contexte->context, NULL, output_bufinfo.buf, output_bufinfo.len);
+
+    return mp_const_none;
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_2(python_chacha20_keystream_obj, python_chacha20_keystream);
+
+// Base64 (standard, avec padding) vers/depuis un buffer fourni par l'appelant
+STATIC const char BASE64_ALPHABET[] = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+
+STATIC int base64_valeur(uint8_t c) {
+    if(c >= 'A' && c <= 'Z') return c - 'A';
+    if(c >= 'a' && c <= 'z') return c - 'a' + 26;
+    if(c >= '0' && c <= '9') return c - '0' + 52;
+    if(c == '+') return 62;
+    if(c == '/') return 63;
+    return -1;
+}
+
+STATIC mp_obj_t python_base64_encode(mp_obj_t data_obj, mp_obj_t output_obj) {
+    mp_buffer_info_t data_bufinfo;
+    mp_buffer_info_t output_bufinfo;
+    mp_get_buffer_raise(data_obj, &data_bufinfo, MP_BUFFER_READ);
+    mp_get_buffer_raise(output_obj, &output_bufinfo, MP_BUFFER_WRITE);
+
+    const uint8_t *data = data_bufinfo.buf;
+    uint8_t *output = output_bufinfo.buf;
+    size_t len_data = data_bufinfo.len;
+    size_t len_output = (len_data + 2) / 3 * 4;
+
+    if(len_output > output_bufinfo.len) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_ValueError, LEN_INVALIDE));
+    }
+
+    size_t i = 0, j = 0;
+    for(; i + 3 <= len_data; i += 3) {
+        uint32_t v = (data[i] << 16) | (data[i+1] << 8) | data[i+2];
+        output[j++] = BASE64_ALPHABET[(v >> 18) & 0x3F];
+        output[j++] = BASE64_ALPHABET[(v >> 12) & 0x3F];
+        output[j++] = BASE64_ALPHABET[(v >> 6) & 0x3F];
+        output[j++] = BASE64_ALPHABET[v & 0x3F];
+    }
+    if(i < len_data) {
+        uint32_t v = data[i] << 16;
+        if(i + 1 < len_data) {
+            v |= data[i+1] << 8;
+        }
+        output[j++] = BASE64_ALPHABET[(v >> 18) & 0x3F];
+        output[j++] = BASE64_ALPHABET[(v >> 12) & 0x3F];
+        output[j++] = (i + 1 < len_data) ? BASE64_ALPHABET[(v >> 6) & 0x3F] : '=';
+        output[j++] = '=';
+    }
+
+    return mp_obj_new_int(j);
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_2(python_base64_encode_obj, python_base64_encode);
+
+// Le decodage peut etre fait en place (output == data) : l'ecriture est toujours derriere la lecture.
+STATIC mp_obj_t python_base64_decode(mp_obj_t data_obj, mp_obj_t output_obj) {
+    mp_buffer_info_t data_bufinfo;
+    mp_buffer_info_t output_bufinfo;
+    mp_get_buffer_raise(data_obj, &data_bufinfo, MP_BUFFER_READ);
+    mp_get_buffer_raise(output_obj, &output_bufinfo, MP_BUFFER_WRITE);
+
+    const uint8_t *data = data_bufinfo.buf;
+    uint8_t *output = output_bufinfo.buf;
+    uint32_t accumulateur = 0;
+    int nb_bits = 0;
+    size_t j = 0;
+
+    size_t i = 0;
+    for(; i < data_bufinfo.len; i++) {
+        uint8_t c = data[i];
+        if(c == '=') {
+            break;
+        }
+        if(c == '\n' || c == '\r') {
+            continue;
+        }
+        int v = base64_valeur(c);
+        if(v < 0) {
+            nlr_raise(mp_obj_new_exception_msg(&mp_type_ValueError, OPERATION_INVALIDE));
+        }
+        accumulateur = (accumulateur << 6) | v;
+        nb_bits += 6;
+        if(nb_bits >= 8) {
+            nb_bits -= 8;
+            if(j >= output_bufinfo.len) {
+                nlr_raise(mp_obj_new_exception_msg(&mp_type_ValueError, LEN_INVALIDE));
+            }
+            output[j++] = (accumulateur >> nb_bits) & 0xFF;
+        }
+    }
+
+    // Dernier groupe : 0, 4 (2 caracteres) ou 2 bits (3 caracteres) restants. 6 : caractere isole, invalide.
+    // Les bits restants doivent etre a 0 (encodage canonique, comme binascii.a2b_base64).
+    if(nb_bits == 6 || (accumulateur & ((1 << nb_bits) - 1)) != 0) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_ValueError, OPERATION_INVALIDE));
+    }
+
+    // Padding optionnel mais exact (nb_bits / 2 '='), aucune donnee apres
+    int nb_padding = 0;
+    for(; i < data_bufinfo.len; i++) {
+        uint8_t c = data[i];
+        if(c == '\n' || c == '\r') {
+            continue;
+        }
+        if(c != '=') {
+            nlr_raise(mp_obj_new_exception_msg(&mp_type_ValueError, OPERATION_INVALIDE));
+        }
+        nb_padding++;
+    }
+    if(nb_padding != 0 && nb_padding != nb_bits / 2) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_ValueError, OPERATION_INVALIDE));
+    }
+
+    return mp_obj_new_int(j);
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_2(python_base64_decode_obj, python_base64_decode);
+
+// Masquage websocket (RFC 6455 section 5.3) en place, 32 bits a la fois.
+// Le masquage est une operation XOR : la meme fonction sert a demasquer.
+STATIC mp_obj_t python_websocket_mask(mp_obj_t data_obj, mp_obj_t mask_obj) {
+    mp_buffer_info_t data_bufinfo;
+    mp_buffer_info_t mask_bufinfo;
+    mp_get_buffer_raise(data_obj, &data_bufinfo, MP_BUFFER_RW);
+    mp_get_buffer_raise(mask_obj, &mask_bufinfo, MP_BUFFER_READ);
+    if(mask_bufinfo.len != 4) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_Exception, LEN_INVALIDE));
+    }
+
+    uint8_t *data = data_bufinfo.buf;
+    const uint8_t *mask = mask_bufinfo.buf;
+    size_t len = data_bufinfo.len;
+    size_t i = 0;
+
+    // Octets jusqu'a l'alignement 32 bits (memoryview avec offset)
+    while(i < len && ((uintptr_t)(data + i) & 3) != 0) {
+        data[i] ^= mask[i & 3];
+        i++;
+    }
+
+    if(i + 4 <= len) {
+        // Masque aligne sur la position courante
+        uint8_t mask_rotation[4] = { mask[i & 3], mask[(i + 1) & 3], mask[(i + 2) & 3], mask[(i + 3) & 3] };
+        uint32_t mask32;
+        memcpy(&mask32, mask_rotation, 4);
+
+        uint32_t *data32 = (uint32_t *)(data + i);
+        size_t nb_mots = (len - i) >> 2;
+        for(size_t k = 0; k < nb_mots; k++) {
+            data32[k] ^= mask32;
+        }
+        i += nb_mots << 2;
+    }
+
+    while(i < len) {
+        data[i] ^= mask[i & 3];
+        i++;
+    }
+
+    return mp_const_none;
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_2(python_websocket_mask_obj, python_websocket_mask);
+
 // Define all properties of the module.
 // Table entries are key/value pairs of the attribute name (a string)
 // and the MicroPython object reference.
@@ -782,6 +1153,11 @@ STATIC MP_DEFINE_CONST_FUN_OBJ_3(python_chacha20poly1305_decrypt_obj, python_cha
 STATIC const mp_rom_map_elem_t oryxcrypto_module_globals_table[] = {
     { MP_ROM_QSTR(MP_QSTR___name__), MP_ROM_QSTR(MP_QSTR_oryx_crypto) },
     { MP_ROM_QSTR(MP_QSTR_blake2s), MP_ROM_PTR(&python_blake2sCompute_obj) },
+    { MP_ROM_QSTR(MP_QSTR_blake2sinit), MP_ROM_PTR(&python_blake2sInit_obj) },
+    { MP_ROM_QSTR(MP_QSTR_blake2supdate), MP_ROM_PTR(&python_blake2sUpdate_obj) },
+    { MP_ROM_QSTR(MP_QSTR_blake2scopy), MP_ROM_PTR(&python_blake2sCopy_obj) },
+    { MP_ROM_QSTR(MP_QSTR_blake2sfinal), MP_ROM_PTR(&python_blake2sFinal_obj) },
+    { MP_OBJ_NEW_QSTR(MP_QSTR_blake2sContext), (mp_obj_t)&blake2sContext_type },
     { MP_ROM_QSTR(MP_QSTR_blake2b), MP_ROM_PTR(&python_blake2bCompute_obj) },
     { MP_ROM_QSTR(MP_QSTR_ed25519sign), MP_ROM_PTR(&python_ed25519Sign_obj) },
     { MP_ROM_QSTR(MP_QSTR_ed25519verify), MP_ROM_PTR(&python_ed25519Verify_obj) },
@@ -794,6 +1170,17 @@ STATIC const mp_rom_map_elem_t oryxcrypto_module_globals_table[] = {
 
     { MP_ROM_QSTR(MP_QSTR_cipherchacha20poly1305encrypt), MP_ROM_PTR(&python_chacha20poly1305_encrypt_obj) },
     { MP_ROM_QSTR(MP_QSTR_cipherchacha20poly1305decrypt), MP_ROM_PTR(&python_chacha20poly1305_decrypt_obj) },
+    { MP_ROM_QSTR(MP_QSTR_chacha20poly1305init), MP_ROM_PTR(&python_chacha20poly1305_init_obj) },
+    { MP_ROM_QSTR(MP_QSTR_chacha20poly1305update), MP_ROM_PTR(&python_chacha20poly1305_update_obj) },
+    { MP_ROM_QSTR(MP_QSTR_chacha20poly1305final), MP_ROM_PTR(&python_chacha20poly1305_final_obj) },
+    { MP_OBJ_NEW_QSTR(MP_QSTR_chacha20Poly1305Context), (mp_obj_t)&chacha20Poly1305Context_type },
+    { MP_ROM_QSTR(MP_QSTR_chacha20init), MP_ROM_PTR(&python_chacha20_init_obj) },
+    { MP_ROM_QSTR(MP_QSTR_chacha20keystream), MP_ROM_PTR(&python_chacha20_keystream_obj) },
+    { MP_OBJ_NEW_QSTR(MP_QSTR_chacha20Context), (mp_obj_t)&chacha20Context_type },
+    { MP_ROM_QSTR(MP_QSTR_base64encode), MP_ROM_PTR(&python_base64_encode_obj) },
+    { MP_ROM_QSTR(MP_QSTR_base64decode), MP_ROM_PTR(&python_base64_decode_obj) },
+
+    { MP_ROM_QSTR(MP_QSTR_websocketmask), MP_ROM_PTR(&python_websocket_mask_obj) },
 
     { MP_OBJ_NEW_QSTR(MP_QSTR_x509CertInfo), (mp_obj_t)&x509CertInfo_type },
     { MP_ROM_QSTR(MP_QSTR_x509certificatinfo), MP_ROM_PTR(&python_x509_certificat_info_obj) },